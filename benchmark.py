@@ -0,0 +1,415 @@
+import json
+import time
+import asyncio
+import argparse
+import contextlib
+import subprocess
+import tracemalloc
+
+import aiohttp
+
+import dsl
+import parser
+import offline
+import workload
+import join_prefixes
+import example_source_dsl
+from ensure_transpiler_ready import (
+    open_session, read_transpiler_sql, ensure_transpiler_pipeline_is_ready, resolve_serving_pipeline,
+    transpiler_fingerprint, PROFILES)
+from ensure_tests_transpiled import (
+    insert_coalesced_records, fetch_pipeline_stats, fetch_outputs_bulk, CompletionWaiter, ResidentPrograms)
+
+
+
+def generate_grasp_program(num_rules, num_facts=4):
+    lines = []
+    for i in range(num_facts):
+        lines.append(f'fact(a: {i}, b: {i+1})')
+    lines.append('')
+    for i in range(num_rules):
+        key = 'ab'[i % 2]
+        lines.append(f'derived_{i}({key}:) <- fact({key}:)')
+    return '\n'.join(lines) + '\n'
+
+def generate_wide_table_program(num_rules):
+    # a single table defined by `num_rules` alternative rules
+    lines = []
+    for i in range(num_rules):
+        lines.append(f'fact_{i}(a: {i})')
+    lines.append('')
+    for i in range(num_rules):
+        lines.append(f'wide(a:) <- fact_{i}(a:)')
+    return '\n'.join(lines) + '\n'
+
+def generate_chain_program(depth, cyclic=False):
+    # chain_{i} depends on chain_{i-1}; with `cyclic`, chain_0 also
+    # depends on the last table, which makes the whole chain one component
+    lines = ['chain_base(a: 1)', '']
+    lines.append('chain_0(a:) <- chain_base(a:)')
+    for i in range(1, depth):
+        lines.append(f'chain_{i}(a:) <- chain_{i-1}(a:)')
+    if cyclic:
+        lines.append(f'chain_0(a:) <- chain_{depth-1}(a:)')
+    return '\n'.join(lines) + '\n'
+
+def generate_dsl_rules(num_rules, body_len=3):
+    rules = []
+    for i in range(num_rules):
+        body = [dsl.fact(f'table_{i}_{j}', 'a', ('b', f'b{j}')) for j in range(body_len)]
+        rules.append(dsl.rule(f'derived_{i % 10}', ['a', ('b', 'b0')], body))
+    return rules
+
+def measure_memory(fn):
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def measure(fn, repeat=3):
+    timings = []
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - started_at)
+    return min(timings)
+
+
+
+def bench_parser(sizes=(10, 100, 1000)):
+    for num_rules in sizes:
+        text = generate_grasp_program(num_rules)
+
+        # cold Earley: build a new parser for every call, as parse() used to
+        parser.get_parser.cache_clear()
+        earley = measure(lambda: [parser.get_parser.cache_clear(), parser.parse(text, algorithm='earley')])
+
+        parser.get_parser.cache_clear()
+        lalr_cold = measure(lambda: [parser.get_parser.cache_clear(), parser.parse(text)])
+        lalr_warm = measure(lambda: parser.parse(text))
+
+        print(
+            f"parser rules={num_rules} lines={text.count(chr(10))}: "
+            f"earley={earley*1000:.1f}ms "
+            f"lalr_cold={lalr_cold*1000:.1f}ms "
+            f"lalr_cached={lalr_warm*1000:.1f}ms")
+
+
+
+def bench_records(sizes=(100, 1000, 2000)):
+    for num_rules in sizes:
+        rules = generate_dsl_rules(num_rules)
+        text = generate_grasp_program(num_rules)
+        dsl_time = measure(lambda: dsl.rules_to_records(rules))
+        parser.parse(text)
+        parser_time = measure(lambda: parser.parse(text))
+        records, _ = dsl.rules_to_records(rules)
+        print(
+            f"records rules={num_rules} rows={len(records)}: "
+            f"dsl.rules_to_records={dsl_time*1000:.1f}ms "
+            f"parser.parse={parser_time*1000:.1f}ms")
+
+
+
+def bench_output_assembly(sizes=(100, 1000, 5000)):
+    # one table per rule, all of them in the same stratum
+    for num_tables in sizes:
+        records = parser.parse(generate_grasp_program(num_tables))
+        records.set_column('pipeline_id', 'bench')
+        latency = measure(lambda: offline.evaluate(records), repeat=1)
+        peak_memory = measure_memory(lambda: offline.evaluate(records))
+        ([output], _) = offline.evaluate(records)
+        # pipeline_views_sql used to keep a prefix of the output per table
+        lines_per_view = len(output['sql_lines']) // num_tables
+        prefix_lines = lines_per_view * num_tables * (num_tables + 1) // 2
+        print(
+            f"output tables={num_tables} lines={len(output['sql_lines'])}: "
+            f"offline.evaluate={latency*1000:.1f}ms peak_memory={peak_memory/2**20:.1f}MiB "
+            f"view_output_line_rows={len(output['sql_lines'])} "
+            f"pipeline_views_sql_prefix_lines={prefix_lines}")
+
+
+
+def bench_rules_per_table(sizes=(10, 100, 1000)):
+    for num_rules in sizes:
+        records = parser.parse(generate_wide_table_program(num_rules))
+        records.set_column('pipeline_id', 'bench')
+        latency = measure(lambda: offline.evaluate(records), repeat=1)
+        peak_memory = measure_memory(lambda: offline.evaluate(records))
+        ([output], _) = offline.evaluate(records)
+        # the table_view_sql chain used to keep one growing prefix per rule
+        lines_per_rule = (len(output['sql_lines']) - 2) // num_rules
+        chain_lines = lines_per_rule * num_rules * (num_rules + 1) // 2
+        print(
+            f"rules_per_table rules={num_rules} lines={len(output['sql_lines'])}: "
+            f"offline.evaluate={latency*1000:.1f}ms peak_memory={peak_memory/2**20:.1f}MiB "
+            f"rule_output_line_rows={len(output['sql_lines']) - 2} "
+            f"table_view_sql_chain_lines={chain_lines}")
+
+
+
+def bench_dependency_chain(sizes=(10, 100, 500)):
+    for depth in sizes:
+        for cyclic in (False, True):
+            records = parser.parse(generate_chain_program(depth, cyclic))
+            records.set_column('pipeline_id', 'bench')
+            latency = measure(lambda: offline.evaluate(records), repeat=1)
+            body_facts_by_rule = offline.group_by(records.to_dict()['body_fact'], key=lambda f: f['rule_id'])
+            direct_dependencies = offline.table_direct_dependency(records.to_dict()['rule'], body_facts_by_rule)
+            dependencies = offline.table_dependency(direct_dependencies)
+            ([output], _) = offline.evaluate(records)
+            print(
+                f"dependency_chain depth={depth} cyclic={cyclic}: "
+                f"offline.evaluate={latency*1000:.1f}ms "
+                f"table_dependency_rows={len(dependencies)} "
+                f"declared_recursive_views={sum(line.startswith('DECLARE') for line in output['sql_lines'])}")
+
+
+
+def generated_join_count(rules):
+    # joins of the tables the transpiler generates, the rules of pruned
+    # tables cost no join state
+    (records, pipeline_id) = dsl.rules_to_records(rules)
+    pruned = set(offline.pruned_tables(records).get(pipeline_id, []))
+    return join_prefixes.join_count([r for r in rules if r['table_name'] not in pruned])
+
+def bench_join_prefixes(sizes=(100, 1000)):
+    # every join keeps both of its inputs arranged, so each join a shared
+    # prefix view removes is two arrangements of join state less. Only
+    # generated tables count: the example program only outputs active_node,
+    # "all outputs" makes every table of it an output
+    example_rules = example_source_dsl.get_rules()
+    programs = [
+        ('example', example_rules),
+        ('example all outputs', [{**r, 'materialized': True} for r in example_rules]),
+    ]
+    programs += [
+        (f'workload rules={num_rules} body_len={body_len}',
+         workload.generate_rules(workload.program_shape(num_rules=num_rules, body_len=body_len)))
+        for num_rules in sizes for body_len in (2, 3)
+    ]
+    for name, rules in programs:
+        latency = measure(lambda: join_prefixes.share_join_prefixes(rules))
+        (optimized, shared) = join_prefixes.share_join_prefixes(rules)
+        (joins, optimized_joins) = (generated_join_count(rules), generated_join_count(optimized))
+        print(
+            f"join_prefixes {name}: share_join_prefixes={latency*1000:.1f}ms "
+            f"prefix_views={len(shared)} generated_joins={joins}->{optimized_joins} "
+            f"arrangements_saved={2 * (joins - optimized_joins)}")
+
+
+
+async def measure_profile_memory(corpus_sizes, feldera_url, rules_per_program):
+    async with open_session(feldera_url) as session:
+        try:
+            async with session.get('/v0/pipelines') as resp:
+                resp.raise_for_status()
+        except aiohttp.ClientError as e:
+            print(f"profile_memory: no Feldera at {feldera_url}, skipped ({e})")
+            return
+        for profile in PROFILES:
+            # every profile gets its own pipeline, so switching between
+            # them does not recompile the other one
+            pipeline_name = f'transpiler_bench_{profile}'
+            await ensure_transpiler_pipeline_is_ready(session, pipeline_name, profile)
+            resident = ResidentPrograms(session, pipeline_name)
+            waiter = CompletionWaiter(session, pipeline_name)
+            for num_programs in corpus_sizes:
+                records_by_owner = {}
+                for i in range(num_programs - len(resident.programs)):
+                    pipeline_id = f'bench:{len(resident.programs) + i}'
+                    records = parser.parse(generate_grasp_program(rules_per_program))
+                    records_by_owner[pipeline_id] = records.set_column('pipeline_id', pipeline_id)
+                tokens = await insert_coalesced_records(session, pipeline_name, records_by_owner)
+                await waiter.wait(set().union(*tokens.values()))
+                for pipeline_id, records in records_by_owner.items():
+                    resident.add(pipeline_id, records)
+                stats = await fetch_pipeline_stats(session, pipeline_name)
+                rss_bytes = stats.get('global_metrics', {}).get('rss_bytes') or 0
+                print(
+                    f"profile_memory profile={profile} programs={num_programs} "
+                    f"input_rows={resident.report()['rows']} rss={rss_bytes/2**20:.1f}MiB")
+            # leave the pipeline empty for the next run
+            await waiter.wait(await resident.forget(list(resident.programs)))
+
+def bench_profile_memory(corpus_sizes=(100, 1000), feldera_url='http://localhost:8080', rules_per_program=20):
+    for profile in PROFILES:
+        lines = read_transpiler_sql(profile).splitlines()
+        materialized_views = sum(line.startswith('CREATE MATERIALIZED VIEW') for line in lines)
+        materialized_tables = sum(line == ") WITH ('materialized' = 'true');" for line in lines)
+        print(
+            f"profile_memory profile={profile}: "
+            f"materialized_views={materialized_views} materialized_tables={materialized_tables}")
+    # the resident memory can only be measured on a running transpiler pipeline
+    asyncio.run(measure_profile_memory(corpus_sizes, feldera_url, rules_per_program))
+
+
+
+# one program per shape, each varying a single parameter of DEFAULT_SHAPE
+E2E_SHAPES = [
+    {},
+    {'num_rules': 1000},
+    {'body_len': 4},
+    {'tables_per_stratum': 50},
+    {'rules_per_table': 20},
+    {'negation_ratio': 0.3},
+    {'expr_depth': 3},
+    {'sql_cond_ratio': 0.5},
+]
+
+@contextlib.contextmanager
+def stage(timings, name):
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = time.perf_counter() - started_at
+
+def build_workload(shape, seed, timings, share_join_prefixes=False):
+    # parse times parser.parse on the same program in .grasp syntax, left
+    # out for shapes that syntax cannot express; rules_to_records builds
+    # the program from its DSL rules
+    parsed_rows = None
+    if workload.grasp_expressible(shape):
+        text = workload.generate_grasp_text(shape, seed)
+        with stage(timings, 'parse'):
+            parsed = parser.parse(text)
+        parsed_rows = len(parsed)
+    rules = workload.generate_rules(shape, seed)
+    with stage(timings, 'rules_to_records'):
+        (records, pipeline_id) = dsl.rules_to_records(rules, share_join_prefixes=share_join_prefixes)
+        dsl.schemas_to_records(workload.generate_schemas(shape), pipeline_id, records)
+    return (records, pipeline_id, parsed_rows)
+
+def end_to_end_result(shape, seed, pipeline_id, records, parsed_rows, sql_lines, errors, timings):
+    return {
+        'shape': shape,
+        'seed': seed,
+        'pipeline_id': pipeline_id,
+        'parsed_rows': parsed_rows,
+        'input_rows': len(records),
+        'output_lines': len(sql_lines.get(pipeline_id, [])),
+        'errors': sorted(errors.get(pipeline_id, [])),
+        'stages': timings,
+    }
+
+def run_end_to_end_offline(shapes, seed, share_join_prefixes=False):
+    # offline.py stands in for the pipeline: ingestion, completion wait
+    # and output fetch collapse into a single evaluate stage
+    results = []
+    for shape in shapes:
+        timings = {}
+        (records, pipeline_id, parsed_rows) = build_workload(shape, seed, timings, share_join_prefixes)
+        with stage(timings, 'evaluate'):
+            (sql_lines, errors) = offline.transpile(records)
+        results.append(end_to_end_result(shape, seed, pipeline_id, records, parsed_rows, sql_lines, errors, timings))
+    return results
+
+async def run_end_to_end_on_pipeline(session, pipeline_name, shapes, seed, share_join_prefixes=False):
+    results = []
+    waiter = CompletionWaiter(session, pipeline_name)
+    resident = ResidentPrograms(session, pipeline_name)
+    for shape in shapes:
+        timings = {}
+        (records, pipeline_id, parsed_rows) = build_workload(shape, seed, timings, share_join_prefixes)
+        with stage(timings, 'ingest'):
+            tokens = await insert_coalesced_records(session, pipeline_name, {pipeline_id: records})
+        resident.add(pipeline_id, records)
+        with stage(timings, 'completion_wait'):
+            await waiter.wait(tokens[pipeline_id])
+        with stage(timings, 'output_fetch'):
+            (sql_lines, errors) = await fetch_outputs_bulk(session, pipeline_name, [pipeline_id])
+        results.append(end_to_end_result(shape, seed, pipeline_id, records, parsed_rows, sql_lines, errors, timings))
+        # every shape starts from an empty pipeline
+        await waiter.wait(await resident.forget([pipeline_id]))
+    return results
+
+async def run_end_to_end(shapes, seed, feldera_url, backend, share_join_prefixes=False):
+    if backend == 'offline':
+        return ('offline', run_end_to_end_offline(shapes, seed, share_join_prefixes))
+    async with open_session(feldera_url) as session:
+        try:
+            async with session.get('/v0/pipelines') as resp:
+                resp.raise_for_status()
+        except aiohttp.ClientError as e:
+            if backend == 'feldera':
+                raise
+            print(f"end_to_end: no Feldera at {feldera_url}, running offline ({e})")
+            return ('offline', run_end_to_end_offline(shapes, seed, share_join_prefixes))
+        # expects a deployed transpiler (make ensure_transpiler_ready)
+        pipeline_name = await resolve_serving_pipeline(session, 'transpiler', transpiler_fingerprint())
+        return ('feldera', await run_end_to_end_on_pipeline(
+            session, pipeline_name, shapes, seed, share_join_prefixes))
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def bench_end_to_end(
+        shapes=E2E_SHAPES, seed=0, feldera_url='http://localhost:8080', backend='auto', results_path=None,
+        share_join_prefixes=False):
+    shapes = [workload.program_shape(**overrides) for overrides in shapes]
+    (backend, results) = asyncio.run(run_end_to_end(shapes, seed, feldera_url, backend, share_join_prefixes))
+    for result in results:
+        overrides = {k: v for k, v in result['shape'].items() if v != workload.DEFAULT_SHAPE[k]}
+        stages = ' '.join(f"{name}={seconds*1000:.1f}ms" for name, seconds in result['stages'].items())
+        print(
+            f"end_to_end backend={backend} shape={overrides or 'default'} share_join_prefixes={share_join_prefixes} "
+            f"rows={result['input_rows']} lines={result['output_lines']}: {stages}")
+    if results_path:
+        with open(results_path, 'w') as f:
+            json.dump({
+                'commit': git_commit(),
+                'transpiler_fingerprint': transpiler_fingerprint(),
+                'backend': backend,
+                'share_join_prefixes': share_join_prefixes,
+                'results': results,
+            }, f, indent=2)
+        print(f"end_to_end: results written to {results_path}")
+
+
+
+BENCHMARKS = {
+    'parser': bench_parser,
+    'records': bench_records,
+    'output_assembly': bench_output_assembly,
+    'rules_per_table': bench_rules_per_table,
+    'dependency_chain': bench_dependency_chain,
+    'join_prefixes': bench_join_prefixes,
+    'profile_memory': bench_profile_memory,
+    'end_to_end': bench_end_to_end,
+}
+
+def main(names, feldera_url='http://localhost:8080', backend='auto', results_path=None, share_join_prefixes=False):
+    options = {
+        'profile_memory': {'feldera_url': feldera_url},
+        'end_to_end': {
+            'feldera_url': feldera_url, 'backend': backend, 'results_path': results_path,
+            'share_join_prefixes': share_join_prefixes,
+        },
+    }
+    for name in (names or BENCHMARKS.keys()):
+        BENCHMARKS[name](**options.get(name, {}))
+
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('names', nargs='*', help=f"benchmarks to run, all by default: {', '.join(BENCHMARKS)}")
+    arg_parser.add_argument('--feldera-url', default='http://localhost:8080')
+    arg_parser.add_argument(
+        '--backend', choices=['auto', 'feldera', 'offline'], default='auto',
+        help="where end_to_end transpiles: auto uses Feldera if it is reachable and offline.py otherwise")
+    arg_parser.add_argument(
+        '--results', dest='results_path',
+        help="write the end_to_end results as JSON to this file")
+    arg_parser.add_argument(
+        '--share-join-prefixes', action='store_true',
+        help="build the end_to_end programs with join prefixes shared across rules (join_prefixes.py)")
+    args = arg_parser.parse_args()
+    main(args.names, args.feldera_url, args.backend, args.results_path, args.share_join_prefixes)
@@ -0,0 +1,117 @@
+import os
+import glob
+import json
+import shutil
+import asyncio
+import argparse
+import tempfile
+
+import ensure_tests_transpiled
+from file_hashes import FileHashes
+
+
+
+# Runs the watch loop of ensure_tests_transpiled.py against the deployed
+# transpiler, edits a watched test file twice and checks that every
+# version gets exactly one output (an edit that changes the output
+# retracts the previous one), then deletes the file, which retracts it.
+# Outputs and resident state go to a temporary cache dir, so the check
+# leaves test/.grasp_cache alone.
+
+BASE_PROGRAM = '''fact(a: 1, b: 3)
+fact(a: 2, b: 5)
+
+only_a(a:) <- fact(a:)
+'''
+
+EDITS = [
+    'only_b(b:) <- fact(b:)\n',
+    'only_ab(a:, b:) <- fact(a:, b:)\n',
+]
+
+TESTCASE_NAME = 'watch_check'
+
+
+
+def output_entries(cache_dir, testcase_path):
+    # cache entries of the current version of testcase_path, whatever
+    # transpiler wrote them
+    content_hash = FileHashes().hash(testcase_path)
+    return glob.glob(f'{cache_dir}/{TESTCASE_NAME}.{content_hash}.*.sql')
+
+def is_resident(cache_dir, pipeline_id):
+    # whether the state of any transpiler pipeline still holds the program
+    for index_path in glob.glob(f'{cache_dir}/resident.*/index.json'):
+        with open(index_path, 'r') as f:
+            if pipeline_id in json.load(f)['programs']:
+                return True
+    return False
+
+async def poll(check, watch_task, timeout, message):
+    # returns the first truthy check(), fails if the watch loop died
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while loop.time() < deadline:
+        if watch_task.done():
+            watch_task.result()
+            raise Exception("Watch loop stopped")
+        result = check()
+        if result:
+            return result
+        await asyncio.sleep(0.05)
+    raise Exception(f"{message} after {timeout}s")
+
+def single_output(cache_dir, testcase_path, view_name):
+    # an output is only written if the transpiler had exactly one for
+    # the program, and it must be the one of the current version
+    for entry_path in output_entries(cache_dir, testcase_path):
+        if f'CREATE MATERIALIZED VIEW "{view_name}"' not in open(entry_path, 'r').read():
+            raise Exception(f"Output of {testcase_path} misses {view_name}: {entry_path}")
+        return entry_path
+    return None
+
+async def main(profile='debug', num_shards=1, polling=False, timeout=30):
+    cache_dir = tempfile.mkdtemp(prefix='grasp_watch_check_cache.')
+    watch_dir = tempfile.mkdtemp(prefix='grasp_watch_check.')
+    testcase_path = f'{watch_dir}/{TESTCASE_NAME}.test.grasp'
+    pipeline_id = ensure_tests_transpiled.testcase_pipeline_id(testcase_path, incremental=True)
+    with open(testcase_path, 'w') as f:
+        f.write(BASE_PROGRAM)
+    watch_task = asyncio.create_task(ensure_tests_transpiled.watch(
+        [watch_dir], profile=profile, num_shards=num_shards, polling=polling, cache_dir=cache_dir))
+    try:
+        entry_path = await poll(
+            lambda: single_output(cache_dir, testcase_path, 'only_a'), watch_task, timeout,
+            f"No output for {testcase_path}")
+        print(f"Initial version: {entry_path}")
+        for edit in EDITS:
+            with open(testcase_path, 'a') as f:
+                f.write(edit)
+            view_name = edit.split('(')[0]
+            entry_path = await poll(
+                lambda: single_output(cache_dir, testcase_path, view_name), watch_task, timeout,
+                f"No output for {testcase_path} with {view_name}")
+            print(f"Edited, added {view_name}: {entry_path}")
+        os.remove(testcase_path)
+        await poll(lambda: not is_resident(cache_dir, pipeline_id), watch_task, timeout, f"{testcase_path} not retracted")
+        print("Deleted, retracted")
+    finally:
+        watch_task.cancel()
+        try:
+            await watch_task
+        except asyncio.CancelledError:
+            pass
+        shutil.rmtree(watch_dir)
+        shutil.rmtree(cache_dir)
+    print("Watch check passed")
+
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--profile', default='debug')
+    arg_parser.add_argument('--shards', type=int, default=1)
+    arg_parser.add_argument('--poll', action='store_true', help="use the polling watcher instead of inotify")
+    arg_parser.add_argument('--timeout', type=float, default=30, help="seconds to wait for each output")
+    args = arg_parser.parse_args()
+    asyncio.run(main(args.profile, args.shards, args.poll, args.timeout))
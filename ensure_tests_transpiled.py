@@ -1,12 +1,29 @@
 import os
 import sys
+import json
 import hashlib
+import time
+import collections
 import asyncio
+import difflib
+import fcntl
+import contextlib
+import argparse
 
 import aiohttp
 import json5
 
 import parser
+import offline
+import tracing
+import join_prefixes
+from output_cache import OutputCache, atomic_write
+from file_hashes import FileHashes, scan_files
+from watcher import open_watcher
+from records import record_delta, row_key, content_id
+from ensure_transpiler_ready import (
+    transpiler_fingerprint, deployed_fingerprint, open_session, backoff_delays, poll_until,
+    fetch_pipeline_status, shard_pipeline_names, ShardRing, resolve_serving_pipeline, PROFILES)
 
 
 
@@ -29,203 +46,1201 @@ async def commit_transaction(session, pipeline_name):
             body = await resp.text()
             raise Exception(f"Unexpected response {resp.status}: {body}")
 
-    while True:
-        stats = await fetch_pipeline_stats(session, pipeline_name)
+    def is_committed(stats):
         match stats:
             case {'global_metrics': {'transaction_status': 'NoTransaction'}}:
-                return
+                return True
             case {'global_metrics': {'transaction_status': 'TransactionInProgress'}}:
-                pass
+                return False
             case {'global_metrics': {'transaction_status': 'CommitInProgress'}}:
-                pass
+                return False
             case _:
                 raise Exception(f"Unexpected stats: {stats}")
-        await asyncio.sleep(1)
+    await poll_until(lambda: fetch_pipeline_stats(session, pipeline_name), is_committed)
 
-async def insert_records(session, pipeline_name, records):
-    insert_tokens = set()
+async def insert_table_rows(session, pipeline_name, table_name, body, num_rows, update_format, semaphore):
+    url = f'/v0/pipelines/{pipeline_name}/ingress/{table_name}'
+    params = {'update_format': update_format, 'array': 'true', 'format': 'json'}
+    headers = {'Content-Type': 'application/json'}
+    async with semaphore:
+        with tracing.span(
+                'ingress', table=table_name, rows=num_rows, bytes=len(body), update_format=update_format) as span:
+            async with session.post(url, params=params, data=body, headers=headers) as resp:
+                if resp.status not in [200, 201]:
+                    resp_body = await resp.text()
+                    raise Exception(f"Unexpected response {resp.status}: {resp_body}")
+                json_resp = await resp.json()
+    print(f"Inserted {num_rows} records ({len(body)} bytes) into {table_name} in {span.duration*1000:.1f}ms: {json_resp}")
+    return json_resp['token']
 
-    for table_name, rows in records.items():
-        url = f'/v0/pipelines/{pipeline_name}/ingress/{table_name}'
-        params = {'update_format': 'raw', 'array': 'true', 'format': 'json'}
+def chunk_rows(owned_rows, max_chunk_rows, max_chunk_bytes):
+    # owned_rows is a list of (owner, row). Yields (owners, num_rows, body),
+    # where body is a JSON array of at most max_chunk_rows rows and
+    # max_chunk_bytes bytes (a single row larger than that is sent alone)
+    owners, encoded_rows, size = set(), [], 2
+    for owner, row in owned_rows:
+        encoded_row = json.dumps(row).encode('utf-8')
+        if encoded_rows and (len(encoded_rows) >= max_chunk_rows or size + len(encoded_row) + 1 > max_chunk_bytes):
+            yield (owners, len(encoded_rows), b'[' + b','.join(encoded_rows) + b']')
+            owners, encoded_rows, size = set(), [], 2
+        owners.add(owner)
+        encoded_rows.append(encoded_row)
+        size += len(encoded_row) + 1
+    if encoded_rows:
+        yield (owners, len(encoded_rows), b'[' + b','.join(encoded_rows) + b']')
 
-        # for row in rows:
-        #     rows0 = [row]
+async def insert_coalesced_records(
+        session, pipeline_name, records_by_owner, update_format='raw',
+        max_concurrency=8, max_chunk_rows=10000, max_chunk_bytes=4*1024*1024):
+    # rows of all programs go to the same input tables (they are told apart
+    # by pipeline_id), so merge them per table and post each table in a few
+    # big chunks, instead of one request per table per program
+    table_rows = {}
+    for owner, records in records_by_owner.items():
+        for table_name, rows in records.items():
+            table_rows.setdefault(table_name, []).extend((owner, row) for row in rows)
 
-        #     print(f"Inserting {table_name}({row})")
+    # every table has its own ingress endpoint, so post them all at once
+    # instead of paying one round trip per table
+    semaphore = asyncio.Semaphore(max_concurrency)
+    chunks_owners = []
+    requests = []
+    for table_name, owned_rows in table_rows.items():
+        for (owners, num_rows, body) in chunk_rows(owned_rows, max_chunk_rows, max_chunk_bytes):
+            chunks_owners.append(owners)
+            requests.append(insert_table_rows(
+                session, pipeline_name, table_name, body, num_rows, update_format, semaphore))
+    tokens = await asyncio.gather(*requests)
 
-        async with session.post(url, params=params, json=rows) as resp:
-            if resp.status not in [200, 201]:
-                body = await resp.text()
-                raise Exception(f"Unexpected response {resp.status}: {body}")
-            json_resp = await resp.json()
-            insert_tokens.add(json_resp['token'])
-            print(f"Inserted {len(rows)} records into {table_name}: {json_resp}")
-
-            # token = json_resp['token']
-            # while True:
-            #     status = await fetch_ingest_status(session, pipeline_name, token)
-            #     match status:
-            #         case {'status': 'inprogress'}:
-            #             await asyncio.sleep(1)
-            #         case {'status': 'complete'}:
-            #             break
-            #             # print(f"Insert completed: {token}")
-            #             # tokens.remove(token)
-            #         case _:
-            #             raise Exception(f"Unknown ingest status: {status}")
-
-            # input(f"Next?")
-
-    return insert_tokens
+    # a program is ingested once every chunk holding any of its rows is
+    tokens_by_owner = {owner: set() for owner in records_by_owner}
+    for owners, token in zip(chunks_owners, tokens):
+        for owner in owners:
+            tokens_by_owner[owner].add(token)
+    return tokens_by_owner
+
+async def insert_records(session, pipeline_name, records, update_format='raw', **kwargs):
+    tokens_by_owner = await insert_coalesced_records(
+        session, pipeline_name, {None: records}, update_format, **kwargs)
+    return tokens_by_owner[None]
 
 async def fetch_ingest_status(session, pipeline_name, token):
     url = f'/v0/pipelines/{pipeline_name}/completion_status'
     async with session.get(url, params={'token': token}) as resp:
         return await resp.json()
 
-async def adhoc_query(session, pipeline_name, sql):
+class CompletionWaiter:
+    """
+    Resolves a future per group of ingress tokens once all of them complete.
+
+    A single background task polls every outstanding token concurrently,
+    starting with millisecond delays and backing off while nothing changes,
+    so a small program is noticed in milliseconds and a big batch does not
+    flood completion_status. Tokens shared by several groups (coalesced
+    chunks) are polled once.
+    """
+
+    def __init__(self, session, pipeline_name, initial_delay=0.002, max_delay=0.5):
+        self.session = session
+        self.pipeline_name = pipeline_name
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.waiters = []
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    def wait(self, tokens):
+        future = asyncio.get_running_loop().create_future()
+        tokens = set(tokens)
+        if not tokens:
+            future.set_result(None)
+            return future
+        self.waiters.append((tokens, future))
+        self.wakeup.set()
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+        return future
+
+    async def fetch_completed(self, tokens):
+        tokens = list(tokens)
+        statuses = await asyncio.gather(*[
+            fetch_ingest_status(self.session, self.pipeline_name, token)
+            for token in tokens
+        ])
+        completed = set()
+        for token, status in zip(tokens, statuses):
+            match status:
+                case {'status': 'inprogress'}:
+                    pass
+                case {'status': 'complete'}:
+                    completed.add(token)
+                case _:
+                    raise Exception(f"Unknown ingest status: {status}")
+        return completed
+
+    async def run(self):
+        try:
+            delays = backoff_delays(self.initial_delay, self.max_delay)
+            while self.waiters:
+                self.wakeup.clear()
+                completed = await self.fetch_completed(set().union(*[t for t, _ in self.waiters]))
+                for tokens, future in self.waiters:
+                    tokens -= completed
+                    if not tokens and not future.done():
+                        future.set_result(None)
+                self.waiters = [(t, f) for t, f in self.waiters if t]
+                if completed:
+                    # progress was made, the rest is likely to follow soon
+                    delays = backoff_delays(self.initial_delay, self.max_delay)
+                if not self.waiters:
+                    break
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=next(delays))
+                    # new tokens were queued, look at them right away
+                    delays = backoff_delays(self.initial_delay, self.max_delay)
+                except asyncio.TimeoutError:
+                    pass
+        except Exception as e:
+            for _, future in self.waiters:
+                if not future.done():
+                    future.set_exception(e)
+            self.waiters = []
+
+class ResidentPrograms:
+    """
+    Input rows of the programs the transpiler pipeline currently holds.
+
+    Every input table and view is keyed by pipeline_id, so retracting the
+    input rows of a program (insert_delete deletes) also retracts all of
+    its derived rows. forget() does that for given programs, evict() for
+    the ones past the TTL or beyond max_programs (least recently used
+    first), so a long-running transpiler does not grow without bound.
+
+    With a state_dir the set is kept on disk, a file of rows per program
+    and an index of their sizes and last use, shared by every run and the
+    watch daemon on the same pipeline, so report() and evict() also cover
+    the programs earlier runs ingested. It is only valid for the transpiler
+    version `fingerprint`, recompiling the pipeline clears its storage.
+    The rows of a program are also what incremental runs compute its next
+    delta against.
+
+    Incremental runs mark their programs pending before sending a delta
+    (mark_pending()), 'sending' with the rows of the new version, then
+    'posted' once every ingress request returned, until save() stores the
+    new rows. A program an interrupted run left pending is not diffed
+    against, recover() retracts the rows the pipeline holds for it: the
+    new version's once posted, the ones queried from the pipeline if the
+    run stopped while sending.
+    """
+
+    def __init__(
+            self, session, pipeline_name, ttl=None, max_programs=None, clock=time.time,
+            state_dir=None, fingerprint=None):
+        self.session = session
+        self.pipeline_name = pipeline_name
+        self.ttl = ttl
+        self.max_programs = max_programs
+        self.clock = clock
+        self.state_dir = state_dir
+        self.fingerprint = fingerprint
+        # pipeline_id -> {'records': {table_name: [row]}, 'last_used': ...,
+        # 'rows': ..., 'bytes': ...}, in least recently used first order.
+        # Records of programs loaded from state_dir are read on demand
+        self.programs = collections.OrderedDict()
+        # pipeline_ids added or forgotten since loaded, for save()
+        self.changed = set()
+        self.removed = set()
+        if state_dir is not None:
+            self.load()
+
+    def state_path(self):
+        return f'{self.state_dir}/resident.{self.pipeline_name}'
+
+    def program_path(self, pipeline_id):
+        return f'{self.state_path()}/{content_id(pipeline_id)}.json'
+
+    def pending_path(self, pipeline_id):
+        return f'{self.state_path()}/{content_id(pipeline_id)}.pending.json'
+
+    @contextlib.contextmanager
+    def locked(self):
+        with open(f'{self.state_path()}/index.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def read_index(self):
+        try:
+            with open(f'{self.state_path()}/index.json', 'r') as f:
+                index = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+        if index.get('transpiler') != self.fingerprint:
+            return {}
+        return index['programs']
+
+    def load(self):
+        os.makedirs(self.state_path(), exist_ok=True)
+        index = self.read_index()
+        for pipeline_id in sorted(index, key=lambda pipeline_id: index[pipeline_id]['last_used']):
+            self.programs[pipeline_id] = {**index[pipeline_id], 'records': None}
+
+    def records(self, pipeline_id):
+        # None if another run forgot the program in the meantime
+        program = self.programs[pipeline_id]
+        if program['records'] is None:
+            try:
+                with open(self.program_path(pipeline_id), 'r') as f:
+                    program['records'] = json.load(f)
+            except FileNotFoundError:
+                return None
+        return program['records']
+
+    def add(self, pipeline_id, records, replace=False):
+        # input tables are multisets: ingesting the same rows twice keeps
+        # two copies, unless they replace the previous rows (incremental)
+        program = self.programs.get(pipeline_id)
+        if program is None or replace or self.records(pipeline_id) is None:
+            program = self.programs[pipeline_id] = {'records': {}, 'last_used': None, 'rows': 0, 'bytes': 0}
+        for table_name, rows in records.items():
+            program['records'].setdefault(table_name, []).extend(rows)
+            program['rows'] += len(rows)
+            program['bytes'] += sum(len(json.dumps(row)) for row in rows)
+        self.changed.add(pipeline_id)
+        self.removed.discard(pipeline_id)
+        self.touch(pipeline_id)
+
+    def mark_pending(self, pipeline_ids, phase, records_by_id=None):
+        # written through to state_dir right away, an interrupted run
+        # does not get to save()
+        if self.state_dir is None:
+            return
+        with self.locked():
+            index = self.read_index()
+            for pipeline_id in pipeline_ids:
+                if records_by_id is not None:
+                    atomic_write(
+                        self.pending_path(pipeline_id),
+                        json.dumps(records_by_id[pipeline_id].to_dict()).encode('utf-8'))
+                program = index.get(pipeline_id) or {'last_used': self.clock(), 'rows': 0, 'bytes': 0}
+                index[pipeline_id] = {**program, 'pending': phase}
+                if pipeline_id in self.programs:
+                    self.programs[pipeline_id]['pending'] = phase
+            self.write_index(index)
+
+    def pending(self):
+        return [pipeline_id for pipeline_id, program in self.programs.items() if program.get('pending')]
+
+    async def ingested_records(self, pipeline_id):
+        # rows the pipeline holds for the program, None if unknown
+        match self.programs[pipeline_id].get('pending'):
+            case None:
+                return self.records(pipeline_id)
+            case 'posted':
+                with open(self.pending_path(pipeline_id), 'r') as f:
+                    return json.load(f)
+            case 'sending':
+                # the previous rows plus whichever requests of the delta
+                # made it, so ask the pipeline. Its input tables are only
+                # materialized with the debug profile
+                table_names = set(self.records(pipeline_id) or {})
+                with open(self.pending_path(pipeline_id), 'r') as f:
+                    table_names |= set(json.load(f))
+                records = {}
+                for table_name in sorted(table_names):
+                    rows = await adhoc_query_rows(self.session, self.pipeline_name,
+                        f"SELECT * FROM {table_name} WHERE pipeline_id = {sql_string(pipeline_id)}")
+                    if rows:
+                        records[table_name] = rows
+                return records
+            case phase:
+                raise Exception(f"Unknown pending phase {phase} of {pipeline_id}")
+
+    def touch(self, pipeline_id):
+        self.programs[pipeline_id]['last_used'] = self.clock()
+        self.programs.move_to_end(pipeline_id)
+
+    def expired(self):
+        now = self.clock()
+        expired = [
+            pipeline_id
+            for pipeline_id, program in self.programs.items()
+            if self.ttl is not None and now - program['last_used'] > self.ttl
+        ]
+        remaining = [pipeline_id for pipeline_id in self.programs if pipeline_id not in expired]
+        if self.max_programs is not None and len(remaining) > self.max_programs:
+            expired += remaining[:len(remaining) - self.max_programs]
+        return expired
+
+    async def forget(self, pipeline_ids, **kwargs):
+        # returns the ingress tokens of the retractions
+        deletes_by_owner = {}
+        for pipeline_id in pipeline_ids:
+            if pipeline_id not in self.programs:
+                continue
+            records = await self.ingested_records(pipeline_id)
+            del self.programs[pipeline_id]
+            self.changed.discard(pipeline_id)
+            self.removed.add(pipeline_id)
+            if records is None:
+                continue
+            deletes_by_owner[pipeline_id] = {
+                table_name: [{'delete': row} for row in rows]
+                for table_name, rows in records.items()
+            }
+        if not deletes_by_owner:
+            return set()
+        tokens_by_owner = await insert_coalesced_records(
+            self.session, self.pipeline_name, deletes_by_owner, 'insert_delete', **kwargs)
+        print(f"Forgot {len(deletes_by_owner)} programs")
+        return set().union(*tokens_by_owner.values())
+
+    async def recover(self, **kwargs):
+        # returns the ingress tokens of the retractions
+        pipeline_ids = self.pending()
+        if not pipeline_ids:
+            return set()
+        print(f"Recovering {len(pipeline_ids)} programs an interrupted run left pending")
+        tokens = await self.forget(pipeline_ids, **kwargs)
+        # saved right away, retracting them twice would be as wrong
+        self.save()
+        return tokens
+
+    async def evict(self, **kwargs):
+        # returns the pipeline_ids of the evicted programs
+        pipeline_ids = self.expired()
+        await self.forget(pipeline_ids, **kwargs)
+        return pipeline_ids
+
+    def write_index(self, index):
+        atomic_write(
+            f'{self.state_path()}/index.json',
+            json.dumps({'transpiler': self.fingerprint, 'programs': index}).encode('utf-8'))
+
+    def save(self):
+        # merged with what other runs saved since this one loaded: their
+        # programs are kept, unless this run forgot them
+        if self.state_dir is None:
+            return
+        with self.locked():
+            index = self.read_index()
+            for pipeline_id in self.changed:
+                program = self.programs[pipeline_id]
+                atomic_write(self.program_path(pipeline_id), json.dumps(program['records']).encode('utf-8'))
+                index[pipeline_id] = {k: program[k] for k in ('last_used', 'rows', 'bytes')}
+            for pipeline_id in self.removed:
+                index.pop(pipeline_id, None)
+            self.write_index(index)
+            # rows files of forgotten programs, or of another transpiler version
+            kept = {f'{content_id(pipeline_id)}.json' for pipeline_id in index}
+            kept |= {f'{content_id(pipeline_id)}.pending.json' for pipeline_id in index if index[pipeline_id].get('pending')}
+            with os.scandir(self.state_path()) as it:
+                for entry in it:
+                    if entry.name.endswith('.json') and entry.name != 'index.json' and entry.name not in kept:
+                        os.remove(entry.path)
+        self.changed = set()
+        self.removed = set()
+
+    def report(self):
+        return {
+            'programs': len(self.programs),
+            'rows': sum(program['rows'] for program in self.programs.values()),
+            'bytes': sum(program['bytes'] for program in self.programs.values()),
+        }
+
+    async def fetch_report(self):
+        # report() plus the memory the transpiler pipeline reports for itself
+        stats = await fetch_pipeline_stats(self.session, self.pipeline_name)
+        return {**self.report(), 'pipeline_rss_bytes': stats.get('global_metrics', {}).get('rss_bytes')}
+
+class EgressSubscriber:
+    """
+    Follows the change streams of the full_pipeline_sql and "error" views.
+
+    Both views are subscribed to before any input is sent, and every
+    insert/delete is applied to the current rows of its pipeline_id, so once
+    a program's ingress tokens complete its output and errors are already
+    here, without an ad-hoc query per program. The streams only carry
+    changes made after subscribing, so the rows programs already have
+    (from earlier runs) are seeded from a snapshot with seed(), otherwise
+    the retraction of an old output would leave a row counted -1.
+
+    Seeded rows belong to the version ingested before, so they are only
+    taken as a program's output once the streams changed it, see
+    wait_for_output().
+    """
+
+    VIEWS = ('full_pipeline_sql', 'error')
+
+    def __init__(self, session, pipeline_name):
+        self.session = session
+        self.pipeline_name = pipeline_name
+        # view -> pipeline_id -> row key -> count
+        self.rows = {view_name: {} for view_name in self.VIEWS}
+        self.waiters = {}
+        # pipeline_ids the streams changed, as opposed to seeded
+        self.streamed = set()
+        self.responses = []
+        self.tasks = []
+
+    async def start(self):
+        for view_name in self.VIEWS:
+            url = f'/v0/pipelines/{self.pipeline_name}/egress/{view_name}'
+            params = {'format': 'json', 'array': 'true', 'backpressure': 'false'}
+            resp = await self.session.post(url, params=params)
+            if resp.status != 200:
+                body = await resp.text()
+                resp.release()
+                await self.close()
+                raise Exception(f"Unexpected response {resp.status}: {body}")
+            self.responses.append(resp)
+            self.tasks.append(asyncio.create_task(self.follow(view_name, resp)))
+
+    async def follow(self, view_name, resp):
+        async for line in resp.content:
+            if not line.strip():
+                continue
+            chunk = json.loads(line)
+            for update in chunk.get('json_data', None) or []:
+                match update:
+                    case {'insert': row}:
+                        self.apply(view_name, row, 1, streamed=True)
+                    case {'delete': row}:
+                        self.apply(view_name, row, -1, streamed=True)
+                    case _:
+                        raise Exception(f"Unknown egress update: {update}")
+
+    async def seed(self, pipeline_ids):
+        # current rows of `pipeline_ids`, queried after start(): nothing is
+        # ingested for them in between, so no change is counted twice
+        for view_name in self.VIEWS:
+            for in_list in sql_in_lists(sorted(set(pipeline_ids))):
+                rows = await adhoc_query_rows(self.session, self.pipeline_name,
+                    f"SELECT * FROM {sql_view_name(view_name)} WHERE pipeline_id IN ({in_list})")
+                for row in rows:
+                    self.apply(view_name, row, 1)
+
+    def apply(self, view_name, row, weight, streamed=False):
+        pipeline_id = row['pipeline_id']
+        if streamed:
+            self.streamed.add(pipeline_id)
+        counts = self.rows[view_name].setdefault(pipeline_id, collections.Counter())
+        counts[row_key(row)] += weight
+        if counts[row_key(row)] == 0:
+            del counts[row_key(row)]
+        for future in self.waiters.pop(pipeline_id, []):
+            if not future.done():
+                future.set_result(None)
+
+    def current_rows(self, view_name, pipeline_id):
+        # rows retracted more often than seen (a stream lagging behind the
+        # snapshot) are not current either
+        counts = self.rows[view_name].get(pipeline_id, {})
+        return [json.loads(key) for key, count in sorted(counts.items()) if count > 0]
+
+    def has_output(self, pipeline_id):
+        return any(self.current_rows(view_name, pipeline_id) for view_name in self.VIEWS)
+
+    def has_streamed_output(self, pipeline_id):
+        return pipeline_id in self.streamed and self.has_output(pipeline_id)
+
+    async def wait_for_output(self, pipeline_id, timeout):
+        # rows of a completed program normally arrive before its tokens
+        # complete, this only covers the stream lagging behind. False if
+        # the streams did not change the program within timeout (an
+        # unchanged output, or a stream lagging further): its current rows
+        # may still be the seeded ones of the previous version, the caller
+        # has to query them
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while not self.has_streamed_output(pipeline_id):
+            future = loop.create_future()
+            self.waiters.setdefault(pipeline_id, []).append(future)
+            try:
+                await asyncio.wait_for(future, max(0, deadline - loop.time()))
+            except asyncio.TimeoutError:
+                return False
+        return True
+
+    async def close(self):
+        for task in self.tasks:
+            task.cancel()
+        for resp in self.responses:
+            resp.close()
+        self.tasks = []
+        self.responses = []
+
+async def adhoc_query_rows(session, pipeline_name, sql):
+    # the json format is one object per line, one line per row
     url = f'/v0/pipelines/{pipeline_name}/query'
-    async with session.get(url, params={'sql': sql, 'format': 'json', 'array': 'true'}) as resp:
-        return await resp.json()
+    async with session.get(url, params={'sql': sql, 'format': 'json'}) as resp:
+        if resp.status != 200:
+            body = await resp.text()
+            raise Exception(f"Unexpected response {resp.status}: {body}")
+        text = await resp.text()
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+def sql_string(value):
+    return "'" + value.replace("'", "''") + "'"
+
+def sql_view_name(view_name):
+    # "error" is a reserved word
+    return f'"{view_name}"' if view_name == 'error' else view_name
+
+def sql_in_lists(values, max_list_len=4000):
+    # split values into IN lists short enough to keep the query url bounded
+    batch, batch_len = [], 0
+    for value in values:
+        literal = sql_string(value)
+        if batch and batch_len + len(literal) + 2 > max_list_len:
+            yield ', '.join(batch)
+            batch, batch_len = [], 0
+        batch.append(literal)
+        batch_len += len(literal) + 2
+    if batch:
+        yield ', '.join(batch)
+
+async def fetch_outputs_bulk(session, pipeline_name, pipeline_ids):
+    # returns {pipeline_id: sql_lines} and {pipeline_id: [error_type]},
+    # with two queries per IN list instead of two queries per program
+    sql_lines = {}
+    errors = {}
+    async def traced_query(span_name, sql):
+        with tracing.span(span_name, query_bytes=len(sql)) as attributes:
+            rows = await adhoc_query_rows(session, pipeline_name, sql)
+            attributes['rows'] = len(rows)
+            return rows
+
+    for in_list in sql_in_lists(sorted(set(pipeline_ids))):
+        (output_rows, error_rows) = await asyncio.gather(
+            traced_query('sql_fetch',
+                f"SELECT pipeline_id, sql_lines FROM full_pipeline_sql WHERE pipeline_id IN ({in_list})"),
+            traced_query('error_check',
+                f"SELECT pipeline_id, error_type FROM \"error\" WHERE pipeline_id IN ({in_list})"))
+        for row in output_rows:
+            if row['pipeline_id'] in sql_lines:
+                raise Exception(f"Expected one output for {row['pipeline_id']}")
+            sql_lines[row['pipeline_id']] = row['sql_lines']
+        for row in error_rows:
+            errors.setdefault(row['pipeline_id'], []).append(row['error_type'])
+    return (sql_lines, errors)
+
+async def fetch_pruned_tables(session, pipeline_name, pipeline_ids):
+    # {pipeline_id: [table_name]} of the tables no output depends on
+    pruned = {}
+    for in_list in sql_in_lists(sorted(set(pipeline_ids))):
+        with tracing.span('pruned_report') as attributes:
+            rows = await adhoc_query_rows(session, pipeline_name,
+                f"SELECT pipeline_id, table_name FROM pruned_table WHERE pipeline_id IN ({in_list})")
+            attributes['rows'] = len(rows)
+        for row in rows:
+            pruned.setdefault(row['pipeline_id'], []).append(row['table_name'])
+    return {pipeline_id: sorted(table_names) for pipeline_id, table_names in pruned.items()}
 
-async def fetch_output_sql_lines(session, pipeline_name, pipeline_id):
-    sql = f"SELECT sql_lines FROM full_pipeline_sql WHERE pipeline_id = '{pipeline_id}'"
-    result = await adhoc_query(session, pipeline_name, sql)
-    assert result
-    # print(f"REUSLT: {result}")
-    # assert len(result) == 1
-    return result['sql_lines']
+def report_pruned_tables(pruned, pipeline_ids):
+    for testcase_path, pipeline_id in pipeline_ids.items():
+        if pipeline_id in pruned:
+            print(f"Pruned tables in {testcase_path}: {', '.join(pruned[pipeline_id])}")
+
+# replaced by main() with one persisted in the cache directory
+file_hashes = FileHashes()
 
 def file_hash(path):
-    return hashlib.sha256(open(path, 'rb').read()).hexdigest()[:10]
+    return file_hashes.hash(path)
 
 def testcase_key(path):
     filename = os.path.basename(path)
     assert filename[-11:] == '.test.grasp'
     return filename[:-11]
 
-def testcase_dest_path(testcase_path, cache_dir):
-    return f'{cache_dir}/{testcase_key(testcase_path)}.{file_hash(testcase_path)}.sql'
-
-def need_to_transpile(testcase_path, cache_dir):
-    return not os.path.exists(testcase_dest_path(testcase_path, cache_dir))
-
-async def enqueue_transpilation(testcase_path, pipeline_name, session):
-    records0 = parser.parse(open(testcase_path, 'r').read())
-    pipeline_id = f'{testcase_key(testcase_path)}:{file_hash(testcase_path)}'
-    records = {}
-    for table_name, rows in records0.items():
-        records[table_name] = [{**r, 'pipeline_id': pipeline_id} for r in rows]
-    tokens = await insert_records(session, pipeline_name, records)
-    return (pipeline_id, tokens)
-
-async def report_errors_if_any(session, pipeline_name, pipeline_id, testcase_path):
-    sql = f"SELECT error_type FROM \"error\" WHERE pipeline_id = '{pipeline_id}'"
-    result = await adhoc_query(session, pipeline_name, sql)
-    if result:
-        print(f"Error in {testcase_path}: {', '.join([x['error_type'] for x in result])}")
-        return True
-    return False 
+def testcase_cache_key(testcase_path, fingerprint):
+    # a new transpiler version misses every entry of the previous one
+    return f'{testcase_key(testcase_path)}.{file_hash(testcase_path)}.{fingerprint}'
+
+def need_to_transpile(testcase_path, cache, fingerprint):
+    return cache.lookup(testcase_cache_key(testcase_path, fingerprint)) is None
+
+def testcase_pipeline_id(testcase_path, incremental=False):
+    if not incremental:
+        return f'{testcase_key(testcase_path)}:{file_hash(testcase_path)}'
+    # pipeline_id names the logical program, so a new version replaces
+    # the rows of the previous one instead of being ingested next to it.
+    # Directories are searched recursively, test files of the same name
+    # in different directories are told apart by their absolute path
+    return f'{testcase_key(testcase_path)}:{content_id(os.path.abspath(testcase_path))}'
+
+
+def prepare_transpilation(testcase_path, incremental=False, resident=None, share_join_prefixes=False):
+    # returns (pipeline_id, records, updates), where updates are the rows
+    # to send in the update format given by ingress_update_format().
+    # Incremental updates are the delta against the rows `resident`
+    # (ResidentPrograms) holds for the program. share_join_prefixes
+    # rewrites the program with join_prefixes.py first
+    with tracing.span('parse', path=testcase_path) as attributes:
+        text = open(testcase_path, 'r').read()
+        records = parser.parse(text)
+        attributes.update(bytes=len(text), rows=len(records))
+    if share_join_prefixes:
+        with tracing.span('join_prefixes', path=testcase_path) as attributes:
+            (records, shared) = join_prefixes.share_parsed_join_prefixes(records)
+            attributes.update(views=len(shared), saved_joins=sum(prefix['saved_joins'] for prefix in shared))
+    with tracing.span('record_build', path=testcase_path, incremental=incremental) as attributes:
+        pipeline_id = testcase_pipeline_id(testcase_path, incremental)
+        records.set_column('pipeline_id', pipeline_id)
+        if not incremental:
+            attributes['rows'] = len(records)
+            return (pipeline_id, records, records)
+
+        if resident is None:
+            raise Exception(f"Incremental transpilation of {testcase_path} needs the resident programs")
+        prev_records = resident.records(pipeline_id) if pipeline_id in resident.programs else None
+        # with nothing ingested yet the delta inserts every row, so all
+        # programs of an incremental run share the insert_delete format
+        updates = record_delta(prev_records or {}, records)
+        attributes['rows'] = sum(len(rows) for rows in updates.values())
+        return (pipeline_id, records, updates)
+
+def ingress_update_format(incremental):
+    return 'insert_delete' if incremental else 'raw'
 
-async def write_output_sql(session, pipeline_name, pipeline_id, dest_path):
+def output_fingerprint(fingerprint, share_join_prefixes=False):
+    # outputs of programs rewritten by join_prefixes.py hold the prefix
+    # views, they are cached apart from the outputs of the programs as written
+    return f'{fingerprint}-shared-prefixes' if share_join_prefixes else fingerprint
+
+def ingested_fingerprint(pipeline_name, profile='debug'):
+    return f'{transpiler_fingerprint(profile)}:{pipeline_name}'
+
+async def enqueue_transpilation(
+        testcase_path, pipeline_name, session, incremental=False, resident=None, share_join_prefixes=False):
+    (pipeline_ids, queued_tokens) = await enqueue_transpilations(
+        [testcase_path], pipeline_name, session, incremental, resident, share_join_prefixes)
+    return (pipeline_ids[testcase_path], queued_tokens[testcase_path])
+
+async def enqueue_transpilations(
+        testcases_paths, pipeline_name, session, incremental=False, resident=None, share_join_prefixes=False,
+        **kwargs):
+    # parse every program first, then ingest all of them together,
+    # so N programs cost about as many requests as one.
+    # Ingested programs are added to `resident` (ResidentPrograms) if
+    # given, incremental runs need it. Returns (pipeline_ids, queued_tokens)
+    pipeline_ids = {}
+    records_by_path = {}
+    updates_by_path = {}
+    for testcase_path in testcases_paths:
+        (pipeline_id, records, updates) = prepare_transpilation(
+            testcase_path, incremental, resident, share_join_prefixes)
+        pipeline_ids[testcase_path] = pipeline_id
+        records_by_path[testcase_path] = records
+        updates_by_path[testcase_path] = updates
+
+    # a delta is only valid against the rows it was computed from, an
+    # interrupted run leaves its programs pending for recover()
+    pending_records = {pipeline_ids[p]: records for p, records in records_by_path.items()} if incremental else {}
+    if pending_records:
+        resident.mark_pending(pending_records, 'sending', pending_records)
+    queued_tokens = await insert_coalesced_records(
+        session, pipeline_name, updates_by_path, ingress_update_format(incremental), **kwargs)
+    if pending_records:
+        resident.mark_pending(pending_records, 'posted')
+    if resident is not None:
+        for testcase_path, records in records_by_path.items():
+            resident.add(pipeline_ids[testcase_path], records, replace=incremental)
+    return (pipeline_ids, queued_tokens)
+
+def write_output_sql(cache, key, sql_lines):
+    dest_path = cache.entry_path(key)
     print(f"Writing {dest_path}")
-    sql_lines = await fetch_output_sql_lines(session, pipeline_name, pipeline_id)
-    print(f"SQL LINES: {sql_lines}")
-    with open(dest_path, 'w') as f:
-        for line in sql_lines:
-            f.write(line + '\n')
+    with tracing.span('file_write', path=dest_path, lines=len(sql_lines)) as attributes:
+        data = ''.join(line + '\n' for line in sql_lines).encode('utf-8')
+        cache.store(key, data)
+        attributes['bytes'] = len(data)
+
+def save_result(testcase_path, cache, fingerprint, sql_lines, error_types):
+    # returns False if the program failed to transpile. Without a
+    # fingerprint the output is not cached, its transpiler is unknown
+    if error_types:
+        print(f"Error in {testcase_path}: {', '.join(error_types)}")
+        return False
+    if sql_lines is None:
+        raise Exception(f"No output for {testcase_path}")
+    if fingerprint is None:
+        print(f"Not caching the output of {testcase_path}, it comes from another transpiler version")
+        return True
+    write_output_sql(cache, testcase_cache_key(testcase_path, fingerprint), sql_lines)
+    return True
+
+def offline_fingerprint():
+    # offline.py orders unordered aggregates (ARRAY_AGG) by value, so its
+    # outputs may legitimately differ from the transpiler pipeline's, they
+    # are cached apart, keyed on offline.py itself
+    source = open(offline.__file__, 'rb').read()
+    return f'offline-{hashlib.sha256(source).hexdigest()[:10]}'
+
+def cached_result(testcase_path, cache, fingerprint):
+    # (sql_lines, error_types) of a cached output, None on a miss.
+    # Only outputs are cached, programs with errors are never hits
+    entry_path = cache.lookup(testcase_cache_key(testcase_path, fingerprint))
+    if entry_path is None:
+        return None
+    return (open(entry_path, 'r').read().splitlines(), [])
+
+def transpile_offline(testcases_paths, share_join_prefixes=False):
+    # {testcase_path: (sql_lines, error_types)} computed by offline.py,
+    # without a running transpiler pipeline
+    results = {}
+    for testcase_path in testcases_paths:
+        (pipeline_id, records, _) = prepare_transpilation(testcase_path, share_join_prefixes=share_join_prefixes)
+        with tracing.span('offline_evaluate', path=testcase_path, rows=len(records)):
+            (sql_lines, errors) = offline.transpile(records)
+        report_pruned_tables(offline.pruned_tables(records), {testcase_path: pipeline_id})
+        results[testcase_path] = (sql_lines.get(pipeline_id), sorted(errors.get(pipeline_id, [])))
+    return results
+
+def report_offline_mismatches(results, offline_results):
+    mismatched_paths = []
+    def split_lines(sql_lines):
+        # as written to the cache, where a line may hold several
+        return None if sql_lines is None else ''.join(line + '\n' for line in sql_lines).splitlines()
+
+    for testcase_path, (sql_lines, error_types) in sorted(results.items()):
+        (offline_sql_lines, offline_error_types) = offline_results[testcase_path]
+        (sql_lines, offline_sql_lines) = (split_lines(sql_lines), split_lines(offline_sql_lines))
+        if (sql_lines, sorted(error_types)) == (offline_sql_lines, offline_error_types):
+            continue
+        mismatched_paths.append(testcase_path)
+        print(f"Offline result differs for {testcase_path}:")
+        print(f"  transpiler errors: {sorted(error_types)}, offline errors: {offline_error_types}")
+        for line in difflib.unified_diff(
+                sql_lines or [], offline_sql_lines or [], 'transpiler', 'offline', lineterm=''):
+            print(f"  {line}")
+    return mismatched_paths
+
+
+
+async def transpile_on_pipeline(
+        session, pipeline_name, testcases_paths, cache_dir, finish,
+        incremental=False, use_egress=True, forget=False, profile='debug',
+        resident_ttl=None, max_resident_programs=None, evict=False, share_join_prefixes=False, **kwargs):
+    # transpiles testcases_paths on one transpiler pipeline, calling
+    # finish(testcase_path, sql_lines, error_types) for each of them.
+    # With evict, then evicts the programs past resident_ttl seconds or
+    # beyond max_resident_programs, whichever run ingested them.
+    # Returns the ResidentPrograms report of the pipeline
+    resident = ResidentPrograms(
+        session, pipeline_name, resident_ttl, max_resident_programs,
+        state_dir=cache_dir, fingerprint=ingested_fingerprint(pipeline_name, profile))
+    await CompletionWaiter(session, pipeline_name).wait(await resident.recover(**kwargs))
+
+    # subscribe before sending anything, so no output change is missed
+    subscriber = None
+    if use_egress and testcases_paths:
+        subscriber = EgressSubscriber(session, pipeline_name)
+        try:
+            await subscriber.start()
+            await subscriber.seed([testcase_pipeline_id(p, incremental) for p in testcases_paths])
+        except Exception as e:
+            print(f"Egress subscription is not available, falling back to queries: {e}")
+            await subscriber.close()
+            subscriber = None
+
+    # await start_transaction(session, pipeline_name)
+    # insert all inputs at once, so it would transpile in parallel
+    (pipeline_ids, queued_tokens) = await enqueue_transpilations(
+        testcases_paths, pipeline_name, session, incremental, resident, share_join_prefixes, **kwargs)
+    # await commit_transaction(session, pipeline_name)
+
+    # print(f"Queued: {queued}")
+
+    waiter = CompletionWaiter(session, pipeline_name)
+
+    # programs whose outputs did not come through egress,
+    # they are fetched together once everything is ingested
+    unfetched_paths = []
+
+    async def finish_transpilation(testcase_path):
+        pipeline_id = pipeline_ids[testcase_path]
+        with tracing.span('completion_wait', path=testcase_path, tokens=len(queued_tokens[testcase_path])):
+            await waiter.wait(queued_tokens[testcase_path])
+        print(f"Insert completed: {testcase_path}")
+        if not subscriber:
+            unfetched_paths.append(testcase_path)
+            return
+        with tracing.span('sql_fetch', path=testcase_path, via='egress') as attributes:
+            # with no rows sent the seeded rows are still current
+            attributes['received'] = (
+                (not queued_tokens[testcase_path] and subscriber.has_output(pipeline_id))
+                or await subscriber.wait_for_output(pipeline_id, timeout=1))
+        if not attributes['received']:
+            unfetched_paths.append(testcase_path)
+            return
+        error_types = sorted(x['error_type'] for x in subscriber.current_rows('error', pipeline_id))
+        match subscriber.current_rows('full_pipeline_sql', pipeline_id):
+            case []:
+                finish(testcase_path, None, error_types)
+            case [output]:
+                finish(testcase_path, output['sql_lines'], error_types)
+            case outputs:
+                raise Exception(f"Expected one output for {pipeline_id}, got {len(outputs)}")
 
+    # outputs are written as soon as their own inputs are ingested,
+    # not after the slowest program of the batch
+    try:
+        await asyncio.gather(*[
+            finish_transpilation(testcase_path)
+            for testcase_path in pipeline_ids
+        ])
+    finally:
+        if subscriber:
+            await subscriber.close()
 
+    (sql_lines, errors) = await fetch_outputs_bulk(
+        session, pipeline_name, [pipeline_ids[p] for p in unfetched_paths])
+    for testcase_path in unfetched_paths:
+        pipeline_id = pipeline_ids[testcase_path]
+        finish(testcase_path, sql_lines.get(pipeline_id), sorted(errors.get(pipeline_id, [])))
+    if pipeline_ids:
+        report_pruned_tables(await fetch_pruned_tables(session, pipeline_name, pipeline_ids.values()), pipeline_ids)
 
-async def main(testcases_paths):
+    if forget:
+        # outputs are saved, the transpiler does not need the programs anymore
+        await resident.forget(pipeline_ids.values(), **kwargs)
+    if evict:
+        evicted = await resident.evict(**kwargs)
+        if evicted:
+            print(f"Evicted {len(evicted)} programs from {pipeline_name}")
+    resident.save()
+    return await resident.fetch_report()
+
+async def fetch_pool_health(session, pipeline_names):
+    # per shard deployment status and the load counters of its stats
+    async def fetch_shard_health(pipeline_name):
+        (status, stats) = await asyncio.gather(
+            fetch_pipeline_status(session, pipeline_name),
+            fetch_pipeline_stats(session, pipeline_name))
+        global_metrics = stats.get('global_metrics', {})
+        return {
+            'pipeline_name': pipeline_name,
+            'deployment_status': status.get('deployment_status'),
+            'total_input_records': global_metrics.get('total_input_records'),
+            'total_processed_records': global_metrics.get('total_processed_records'),
+            'buffered_input_records': global_metrics.get('buffered_input_records'),
+            'rss_bytes': global_metrics.get('rss_bytes'),
+        }
+    return await asyncio.gather(*[fetch_shard_health(pipeline_name) for pipeline_name in pipeline_names])
+
+
+
+def route_testcases(testcases_paths, pipeline_names, incremental=False):
+    # programs are spread over the shards by pipeline_id, so the same
+    # program always goes to the same shard (incremental updates, forget)
+    ring = ShardRing(pipeline_names)
+    paths_by_shard = {}
+    for testcase_path in testcases_paths:
+        shard = ring.shard_for(testcase_pipeline_id(testcase_path, incremental))
+        paths_by_shard.setdefault(shard, []).append(testcase_path)
+    return paths_by_shard
+
+async def resolve_serving_pipelines(session, shards, profile='debug'):
+    # {shard: serving pipeline}, after a blue/green redeploy
+    # a shard is served by its other slot
+    fingerprint = transpiler_fingerprint(profile)
+    serving = await asyncio.gather(*[resolve_serving_pipeline(session, shard, fingerprint) for shard in shards])
+    return dict(zip(shards, serving))
+
+async def outdated_pipelines(session, pipeline_names, profile='debug'):
+    # serving pipelines not deployed with the local transpiler: during a
+    # blue/green switchover, or when transpiler/ changed without a redeploy,
+    # resolve_serving_pipeline() falls back to them. Their outputs must not
+    # be cached under the local fingerprint
+    fingerprint = transpiler_fingerprint(profile)
+    pipeline_names = sorted(set(pipeline_names))
+    statuses = await asyncio.gather(*[fetch_pipeline_status(session, name) for name in pipeline_names])
+    outdated = {name for name, status in zip(pipeline_names, statuses) if deployed_fingerprint(status) != fingerprint}
+    for name in sorted(outdated):
+        print(f"Warning: {name} is not running transpiler {fingerprint}, its outputs are not cached")
+    return outdated
+
+def routed_fingerprints(paths_by_shard, serving, outdated, fingerprint):
+    # {testcase_path: cache fingerprint}, None for paths served by an
+    # outdated pipeline
+    return {
+        testcase_path: None if serving[shard] in outdated else fingerprint
+        for shard, paths in paths_by_shard.items()
+        for testcase_path in paths
+    }
+
+async def retract_testcases(session, pipeline_name, testcases_paths, cache_dir, profile='debug', **kwargs):
+    # retracts the rows an incremental run ingested for deleted test files,
+    # returns the ingress tokens of the retractions
+    resident = ResidentPrograms(
+        session, pipeline_name, state_dir=cache_dir, fingerprint=ingested_fingerprint(pipeline_name, profile))
+    pipeline_ids = [testcase_pipeline_id(testcase_path, incremental=True) for testcase_path in testcases_paths]
+    tokens = await resident.forget(pipeline_ids, **kwargs)
+    resident.save()
+    return tokens
+
+async def watch(
+        testcases_paths, max_chunk_rows=10000, max_chunk_bytes=4*1024*1024, use_egress=True, profile='debug',
+        num_shards=1, cache_max_bytes=256*1024*1024, debounce=0.05, polling=False,
+        resident_ttl=None, max_resident_programs=None, cache_dir=None, share_join_prefixes=False):
+    # long-running incremental mode: the session, the serving pipelines,
+    # the cache and the file hashes are set up once, then every batch of
+    # edited test files is re-parsed, ingested as a delta against the rows
+    # of its previous version, and only its outputs are rewritten
+    feldera_url = 'http://localhost:8080'
+    pipeline_name = 'transpiler'
+
+    if cache_dir is None:
+        curr_dir = os.path.abspath(os.path.dirname(__file__))
+        cache_dir = f'{curr_dir}/test/.grasp_cache'
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    global file_hashes
+    file_hashes = FileHashes(f'{cache_dir}/file_hashes.json')
+    cache = OutputCache(cache_dir, cache_max_bytes)
+    cache_fingerprint = output_fingerprint(transpiler_fingerprint(), share_join_prefixes)
+    pipeline_names = shard_pipeline_names(pipeline_name, num_shards)
+
+    # testcase_path -> fingerprint its output is cached under, per batch
+    fingerprints = {}
+
+    def finish(testcase_path, sql_lines, error_types):
+        save_result(testcase_path, cache, fingerprints.get(testcase_path), sql_lines, error_types)
+
+    watcher = open_watcher(testcases_paths, '.test.grasp', debounce, polling)
+    print(f"Watching {', '.join(testcases_paths)} with {type(watcher).__name__}")
+    try:
+        async with open_session(feldera_url, max_connections=16*num_shards) as session:
+            changed_paths = {p for p, _ in scan_files(testcases_paths, '.test.grasp')}
+            while True:
+                started_at = time.perf_counter()
+                # resolved per batch, a blue/green redeploy may have
+                # switched the serving slots since the last one
+                serving = await resolve_serving_pipelines(session, pipeline_names, profile)
+                outdated = await outdated_pipelines(session, serving.values(), profile)
+                deleted_paths = sorted(p for p in changed_paths if not os.path.exists(p))
+                for testcase_path in changed_paths:
+                    file_hashes.invalidate(testcase_path)
+                pending_paths = sorted(
+                    p for p in changed_paths
+                    if p not in deleted_paths and need_to_transpile(p, cache, cache_fingerprint))
+                try:
+                    for shard, paths in route_testcases(deleted_paths, pipeline_names, incremental=True).items():
+                        tokens = await retract_testcases(
+                            session, serving[shard], paths, cache_dir, profile,
+                            max_chunk_rows=max_chunk_rows, max_chunk_bytes=max_chunk_bytes)
+                        await CompletionWaiter(session, serving[shard]).wait(tokens)
+                        print(f"Retracted {len(paths)} deleted programs from {shard}")
+                    paths_by_shard = route_testcases(pending_paths, pipeline_names, incremental=True)
+                    fingerprints.update(routed_fingerprints(paths_by_shard, serving, outdated, cache_fingerprint))
+                    await asyncio.gather(*[
+                        transpile_on_pipeline(
+                            session, serving[shard], paths_by_shard.get(shard, []), cache_dir, finish,
+                            True, use_egress, False, profile, resident_ttl, max_resident_programs, evict=True,
+                            share_join_prefixes=share_join_prefixes,
+                            max_chunk_rows=max_chunk_rows, max_chunk_bytes=max_chunk_bytes)
+                        # every batch evicts from every shard, not only from
+                        # the ones the batch was routed to
+                        for shard in pipeline_names
+                    ])
+                except Exception as e:
+                    # keep watching, the next edit may fix it
+                    print(f"Failed to transpile {', '.join(pending_paths)}: {e}")
+                file_hashes.save()
+                cache.save()
+                if pending_paths or deleted_paths:
+                    print(
+                        f"Transpiled {len(pending_paths)} and retracted {len(deleted_paths)} programs "
+                        f"in {(time.perf_counter() - started_at)*1000:.1f}ms")
+                changed_paths = await watcher.changes()
+    finally:
+        watcher.close()
+
+
+
+async def main(
+        testcases_paths, incremental=False, max_chunk_rows=10000, max_chunk_bytes=4*1024*1024,
+        use_egress=True, offline_only=False, check_offline=False, forget=False, profile='debug',
+        num_shards=1, trace_path=None, cache_max_bytes=256*1024*1024,
+        resident_ttl=None, max_resident_programs=None, evict=False, share_join_prefixes=False):
     feldera_url = 'http://localhost:8080'
     pipeline_name = 'transpiler'
+    if trace_path:
+        tracing.start(trace_path)
 
     curr_dir = os.path.abspath(os.path.dirname(__file__))
     cache_dir = f'{curr_dir}/test/.grasp_cache'
     if not os.path.exists(cache_dir):
         os.makedirs(cache_dir)
 
-    pipeline_ids = {}
-    queued_tokens = {}
-    # fin_tokens = {}
-    with_errors = {}
-    async with aiohttp.ClientSession(feldera_url, timeout=aiohttp.ClientTimeout(sock_read=0,total=0)) as session:
-        # await start_transaction(session, pipeline_name)
-        for testcase_path in testcases_paths:
-            if need_to_transpile(testcase_path, cache_dir):
-                # insert all inputs at once, so it would transpile in parallel
-                (pipeline_id, tokens) = await enqueue_transpilation(testcase_path, pipeline_name, session)
-                queued_tokens[testcase_path] = tokens
-                pipeline_ids[testcase_path] = pipeline_id
-        # await commit_transaction(session, pipeline_name)
-
-        # print(f"Queued: {queued}")
-
-        # while queued_tokens or fin_tokens:
-        while queued_tokens:
-            for testcase_path, tokens in {**queued_tokens}.items():
-                pipeline_id = pipeline_ids[testcase_path]
-                for token in list(tokens):
-                    status = await fetch_ingest_status(session, pipeline_name, token)
-                    match status:
-                        case {'status': 'inprogress'}:
-                            pass
-                        case {'status': 'complete'}:
-                            print(f"Insert completed: {token}")
-                            tokens.remove(token)
-                        case _:
-                            raise Exception(f"Unknown ingest status: {status}")
-                
-                # fin_token = fin_tokens.get(testcase_path, None)
-                # if (not tokens) and (not fin_token):
-                #     # del queued[testcase_path]
-                #     # pass
-                #     ftokens = await insert_records(session, pipeline_name, {
-                #         'all_records_inserted': [{'pipeline_id': pipeline_id}]
-                #     })
-                #     assert len(ftokens) == 1
-                #     fin_tokens[testcase_path] = ftokens.pop()
-                #     del queued_tokens[testcase_path]
-                if not tokens:
-                    # del queued[testcase_path]
-                    # pass
-                    # ftokens = await insert_records(session, pipeline_name, {
-                    #     'all_records_inserted': [{'pipeline_id': pipeline_id}]
-                    # })
-                    # assert len(ftokens) == 1
-                    # fin_tokens[testcase_path] = ftokens.pop()
-                    del queued_tokens[testcase_path]
-
-            # for testcase_path, fin_token in {**fin_tokens}.items():
-            #     if fin_token:
-            #         status = await fetch_ingest_status(session, pipeline_name, fin_token)
-            #         match status:
-            #             case {'status': 'inprogress'}:
-            #                 pass
-            #             case {'status': 'complete'}:
-            #                 print(f"Insert finalized for {testcase_path}")
-            #                 any_errors_happened = await report_errors_if_any(session, pipeline_name, pipeline_id, testcase_path)
-            #                 if any_errors_happened:
-            #                     with_errors[testcase_path] = True
-            #                 del fin_tokens[testcase_path]
-            #             case _:
-            #                 raise Exception(f"Unknown ingest status: {status}")
-
-            # print(f"Queued: {queued}")
-            await asyncio.sleep(1)
-
-        paths_without_errors = (set(testcases_paths) - set(with_errors.keys())) & set(pipeline_ids.keys())
-        for testcase_path in paths_without_errors:
-            dest_path = testcase_dest_path(testcase_path, cache_dir)
-            pipeline_id = pipeline_ids[testcase_path]
-            await write_output_sql(session, pipeline_name, pipeline_id, dest_path)
+    global file_hashes
+    file_hashes = FileHashes(f'{cache_dir}/file_hashes.json')
+    # directories are searched for test files, their stats come with the scan
+    scanned = list(scan_files(testcases_paths, '.test.grasp'))
+    for testcase_path, stat in scanned:
+        file_hashes.remember_stat(testcase_path, stat)
+    testcases_paths = [testcase_path for testcase_path, _ in scanned]
+
+    # profiles only change what the transpiler materializes, not its
+    # outputs, so all of them share the entries of the same transpiler
+    cache = OutputCache(cache_dir, cache_max_bytes)
+    cache_fingerprint = output_fingerprint(
+        offline_fingerprint() if offline_only else transpiler_fingerprint(), share_join_prefixes)
+    pending_paths = [p for p in testcases_paths if need_to_transpile(p, cache, cache_fingerprint)]
+    print(f"Output cache: {len(testcases_paths) - len(pending_paths)} hits, {len(pending_paths)} misses")
+    # testcase_path -> (sql_lines, error_types)
+    results = {}
+    # testcase_path -> fingerprint its output is cached under
+    fingerprints = {p: cache_fingerprint for p in pending_paths}
+
+    def finish(testcase_path, sql_lines, error_types):
+        results[testcase_path] = (sql_lines, error_types)
+        save_result(testcase_path, cache, fingerprints[testcase_path], sql_lines, error_types)
+
+    if offline_only:
+        for testcase_path, (sql_lines, error_types) in transpile_offline(pending_paths, share_join_prefixes).items():
+            finish(testcase_path, sql_lines, error_types)
+        pending_paths = []
+
+    paths_by_shard = route_testcases(pending_paths, shard_pipeline_names(pipeline_name, num_shards), incremental)
+    # a run with every output cached needs no transpiler, unless it
+    # evicts, which it does from every shard
+    shards = sorted(paths_by_shard)
+    if evict and not offline_only:
+        shards = shard_pipeline_names(pipeline_name, num_shards)
+
+    if shards:
+        async with open_session(feldera_url, max_connections=16*num_shards) as session:
+            serving = await resolve_serving_pipelines(session, shards, profile)
+            outdated = await outdated_pipelines(session, serving.values(), profile)
+            fingerprints.update(routed_fingerprints(paths_by_shard, serving, outdated, cache_fingerprint))
+            reports = await asyncio.gather(*[
+                transpile_on_pipeline(
+                    session, serving[shard], paths_by_shard.get(shard, []), cache_dir, finish,
+                    incremental, use_egress, forget, profile, resident_ttl, max_resident_programs, evict,
+                    share_join_prefixes, max_chunk_rows=max_chunk_rows, max_chunk_bytes=max_chunk_bytes)
+                for shard in shards
+            ])
+            for shard, report in zip(shards, reports):
+                print(f"Resident programs on {shard}: {report}, routed {len(paths_by_shard.get(shard, []))} programs")
+            if num_shards > 1 and pending_paths:
+                for health in await fetch_pool_health(session, list(serving.values())):
+                    print(f"Shard health: {health}")
+
+    if check_offline and not offline_only:
+        # the outputs cached by earlier runs are checked as well,
+        # not only the ones transpiled by this run
+        checked_results = {
+            p: results.get(p) or cached_result(p, cache, cache_fingerprint)
+            for p in testcases_paths
+        }
+        checked_results = {p: result for p, result in checked_results.items() if result is not None}
+
+    file_hashes.save()
+    evicted = cache.save()
+    if evicted:
+        print(f"Output cache: evicted {len(evicted)} entries, {cache.report()}")
+
+    if trace_path:
+        tracing.tracer.close()
+        print(f"Stage timings (spans in {trace_path}):")
+        print('\n'.join(tracing.tracer.summary()))
 
+    with_errors = [p for p, (_, error_types) in results.items() if error_types]
+    if check_offline and not offline_only:
+        mismatched_paths = report_offline_mismatches(
+            checked_results, transpile_offline(checked_results.keys(), share_join_prefixes))
+        print(f"Offline check: {len(checked_results) - len(mismatched_paths)} of {len(checked_results)} programs agree")
+        if mismatched_paths:
+            exit(1)
     if with_errors:
         exit(1)
 
 
 
 if __name__ == '__main__':
-    asyncio.run(main(sys.argv[1:]), debug=True)
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument(
+        'testcases_paths', nargs='*',
+        help="test files, or directories to search for *.test.grasp files")
+    arg_parser.add_argument(
+        '--incremental', action='store_true',
+        help="keep one pipeline_id per test file and ingest only the rows that changed since the last run")
+    arg_parser.add_argument(
+        '--max-chunk-rows', type=int, default=10000,
+        help="max rows per ingress request, rows of all test files are merged per table")
+    arg_parser.add_argument(
+        '--max-chunk-bytes', type=int, default=4*1024*1024,
+        help="max JSON body size per ingress request")
+    arg_parser.add_argument(
+        '--no-egress', action='store_true',
+        help="fetch outputs with ad-hoc queries instead of following the output views")
+    arg_parser.add_argument(
+        '--offline', action='store_true',
+        help="transpile with offline.py instead of the transpiler pipeline")
+    arg_parser.add_argument(
+        '--check-offline', action='store_true',
+        help="also transpile every test file with offline.py and fail if it disagrees with the transpiler "
+             "pipeline, outputs cached by earlier runs included")
+    arg_parser.add_argument(
+        '--forget', action='store_true',
+        help="retract the input rows of transpiled programs from the transpiler pipeline once their outputs are saved")
+    arg_parser.add_argument(
+        '--profile', choices=PROFILES, default='debug',
+        help="materialization profile the transpiler pipeline was deployed with (see ensure_transpiler_ready.py)")
+    arg_parser.add_argument(
+        '--shards', type=int, default=1,
+        help="number of transpiler pipelines to spread the test files over (see ensure_transpiler_ready.py --shards)")
+    arg_parser.add_argument(
+        '--trace', dest='trace_path',
+        help="append a JSON line per stage span (parse, ingress, completion wait, fetch, write) to this file, "
+             "and print a summary of the stage timings at the end")
+    arg_parser.add_argument(
+        '--cache-max-bytes', type=int, default=256*1024*1024,
+        help="size bound of test/.grasp_cache outputs, least recently used ones are evicted beyond it")
+    arg_parser.add_argument(
+        '--evict', action='store_true',
+        help="retract programs past --resident-ttl or beyond --max-resident-programs from every transpiler "
+             "pipeline, even if every output is cached (--watch does it after every batch)")
+    arg_parser.add_argument(
+        '--resident-ttl', type=float, default=24*60*60,
+        help="with --evict or --watch, retract programs from the transpiler pipeline "
+             "once unused for this many seconds")
+    arg_parser.add_argument(
+        '--max-resident-programs', type=int,
+        help="with --evict or --watch, retract the least recently used programs "
+             "beyond this many per transpiler pipeline")
+    arg_parser.add_argument(
+        '--share-join-prefixes', action='store_true',
+        help="move join prefixes shared by several rules into views of their own before ingesting "
+             "(see join_prefixes.py), outputs are cached apart from those of the programs as written")
+    arg_parser.add_argument(
+        '--watch', action='store_true',
+        help="keep running and transpile test files incrementally as they change (implies --incremental)")
+    arg_parser.add_argument(
+        '--debounce', type=float, default=0.05,
+        help="seconds without further changes before --watch transpiles a batch of edits")
+    arg_parser.add_argument(
+        '--poll', action='store_true',
+        help="make --watch rescan the test files instead of using inotify")
+    args = arg_parser.parse_args()
+    if args.watch:
+        asyncio.run(watch(
+            args.testcases_paths, max_chunk_rows=args.max_chunk_rows, max_chunk_bytes=args.max_chunk_bytes,
+            use_egress=not args.no_egress, profile=args.profile, num_shards=args.shards,
+            cache_max_bytes=args.cache_max_bytes, debounce=args.debounce, polling=args.poll,
+            resident_ttl=args.resident_ttl, max_resident_programs=args.max_resident_programs,
+            share_join_prefixes=args.share_join_prefixes))
+    else:
+        asyncio.run(main(
+            args.testcases_paths, incremental=args.incremental,
+            max_chunk_rows=args.max_chunk_rows, max_chunk_bytes=args.max_chunk_bytes,
+            use_egress=not args.no_egress, offline_only=args.offline,
+            check_offline=args.check_offline, forget=args.forget, profile=args.profile,
+            num_shards=args.shards, trace_path=args.trace_path, cache_max_bytes=args.cache_max_bytes,
+            resident_ttl=args.resident_ttl, max_resident_programs=args.max_resident_programs,
+            evict=args.evict, share_join_prefixes=args.share_join_prefixes), debug=True)
@@ -1,8 +1,12 @@
 import os
+import re
 import sys
 import json5
+import bisect
+import hashlib
 import asyncio
 import aiohttp
+import argparse
 
 
 
@@ -11,18 +15,45 @@ from dsl import rules_to_records, schemas_to_records
 
 
 
-async def do_need_to_recompile_transpiler(session, pipeline_name, curr_transpiler_sql, curr_udf_rs):
-    url = f'/v0/pipelines/{pipeline_name}'
-    async with session.get(url) as resp:
-        json_resp = await resp.json()
-        match json_resp:
-            case {'error_code': 'UnknownPipelineName'}:
-                print("Transpiler pipeline does not exist")
-                return True
-            case {'program_code': program_code, 'udf_rust': udf_rs}:
-                if program_code != curr_transpiler_sql or udf_rs != curr_udf_rs:
-                    return True
-    return False
+def open_session(feldera_url, max_connections=16):
+    # keep-alive pool shared by all requests of a run,
+    # so concurrent ingress requests do not reconnect every time
+    connector = aiohttp.TCPConnector(
+        limit=max_connections, limit_per_host=max_connections, keepalive_timeout=60)
+    return aiohttp.ClientSession(
+        feldera_url, connector=connector, timeout=aiohttp.ClientTimeout(sock_read=0,total=0))
+
+def backoff_delays(initial_delay=0.002, max_delay=1.0, factor=2):
+    delay = initial_delay
+    while True:
+        yield delay
+        delay = min(delay * factor, max_delay)
+
+async def poll_until(fetch, is_done, initial_delay=0.002, max_delay=1.0):
+    # call fetch() until is_done() accepts its result (is_done may raise
+    # to abort). Starts in the millisecond range, so fast transitions are
+    # noticed right away, and backs off for the slow ones (compilation)
+    for delay in backoff_delays(initial_delay, max_delay):
+        result = await fetch()
+        if is_done(result):
+            return result
+        await asyncio.sleep(delay)
+
+
+
+def pipeline_description(fingerprint):
+    return f'grasp transpiler {fingerprint}'
+
+def deployed_fingerprint(status):
+    # fingerprint of the transpiler a pipeline was deployed with, as stored
+    # in its description, None for unknown or foreign pipelines
+    match status:
+        case {'description': str(description)} if description.startswith('grasp transpiler '):
+            return description[len('grasp transpiler '):]
+    return None
+
+def is_serving(status, fingerprint):
+    return deployed_fingerprint(status) == fingerprint and status.get('deployment_status') == 'Running'
 
 
 
@@ -33,7 +64,7 @@ async def fetch_pipeline_status(session, pipeline_name):
 
 
 
-async def recompile_transpiler(session, pipeline_name, transpiler_sql, udf_rs):
+async def recompile_transpiler(session, pipeline_name, transpiler_sql, udf_rs, fingerprint):
     status = await fetch_pipeline_status(session, pipeline_name)
     # print(f"STATUS: {status}")
     has_prev_version = not (status.get('error_code', None) == 'UnknownPipelineName')
@@ -44,27 +75,24 @@ async def recompile_transpiler(session, pipeline_name, transpiler_sql, udf_rs):
                     body = await resp.text()
                     raise Exception(f"Unexpected response {resp.status}: {body}")
 
-        while True:
-            status = await fetch_pipeline_status(session, pipeline_name)
-            if status['deployment_status'] == 'Stopped':
-                break
-            await asyncio.sleep(1)
-        
+        await poll_until(
+            lambda: fetch_pipeline_status(session, pipeline_name),
+            lambda status: status['deployment_status'] == 'Stopped')
+
         async with session.post(f'/v0/pipelines/{pipeline_name}/clear') as resp:
             if resp.status not in [200, 202]:
                 body = await resp.text()
                 raise Exception(f"Unexpected response {resp.status}: {body}")
 
-        while True:
-            status = await fetch_pipeline_status(session, pipeline_name)
-            if status['storage_status'] == 'Cleared':
-                break
-            await asyncio.sleep(1)
+        await poll_until(
+            lambda: fetch_pipeline_status(session, pipeline_name),
+            lambda status: status['storage_status'] == 'Cleared')
 
     url = f'/v0/pipelines/{pipeline_name}'
     data = {
         'program_code': transpiler_sql,
         'name': pipeline_name,
+        'description': pipeline_description(fingerprint),
         'udf_rust': udf_rs,
     }
     async with session.put(url, json=data) as resp:
@@ -75,19 +103,18 @@ async def recompile_transpiler(session, pipeline_name, transpiler_sql, udf_rs):
 
 
 async def wait_till_transpiler_compiled(session, pipeline_name):
-    while True:
-        status = await fetch_pipeline_status(session, pipeline_name)
+    def is_compiled(status):
         # print(f"Status: {status}")
         match status['program_status']:
             case 'Success':
-                break
+                return True
             case 'Pending' | 'CompilingSql' | 'SqlCompiled' | 'CompilingRust':
-                pass
+                return False
             case 'SqlError' | 'RustError' | 'SystemError':
                 raise Exception("Transpiler failed to compile")
             case program_status:
                 raise Exception(f"Unknown transpiler status: {program_status}")
-        await asyncio.sleep(1)
+    await poll_until(lambda: fetch_pipeline_status(session, pipeline_name), is_compiled)
 
 
 
@@ -97,48 +124,162 @@ async def ensure_transpiler_started(session, pipeline_name):
         if resp.status not in [200, 201, 202]:
             body = await resp.text()
             raise Exception(f"Unexpected response {resp.status}: {body}")
-    while True:
-        status = await fetch_pipeline_status(session, pipeline_name)
-        if status['deployment_status'] == 'Running':
-            break
-        await asyncio.sleep(1)
-
-def read_transpiler_sql():
+    await poll_until(
+        lambda: fetch_pipeline_status(session, pipeline_name),
+        lambda status: status['deployment_status'] == 'Running')
+
+# views clients read, through ad-hoc queries or egress,
+# they stay materialized in every profile
+OUTPUT_VIEWS = ('full_pipeline_sql', '"error"', 'pruned_table')
+
+PROFILES = ('debug', 'lean')
+
+def apply_profile(transpiler_sql, profile):
+    # debug keeps every input table and view materialized, so any of them
+    # can be queried while investigating. lean only materializes OUTPUT_VIEWS,
+    # the internals are computed incrementally but not stored in full
+    match profile:
+        case 'debug':
+            return transpiler_sql
+        case 'lean':
+            transpiler_sql = re.sub(
+                r'^CREATE MATERIALIZED VIEW (\S+) AS$',
+                lambda m: m.group(0) if m.group(1) in OUTPUT_VIEWS else f'CREATE VIEW {m.group(1)} AS',
+                transpiler_sql, flags=re.MULTILINE)
+            return re.sub(r"^\) WITH \('materialized' = 'true'\);$", ');', transpiler_sql, flags=re.MULTILINE)
+        case _:
+            raise Exception(f"Unknown transpiler profile: {profile}")
+
+def read_transpiler_sql(profile='debug'):
     curr_dir = os.path.abspath(os.path.dirname(__file__))
     # select all *.sql files from transpiler/ directory
     # sort by name. Read in order, concatenate content and return
     sql_files = [f for f in os.listdir(f'{curr_dir}/transpiler') if f.endswith('.sql')]
     sql_files.sort()
     sql_files = [open(f'{curr_dir}/transpiler/{f}', 'r').read() for f in sql_files]
-    return '\n'.join(sql_files)
+    return apply_profile('\n'.join(sql_files), profile)
 
 def read_transpiler_udf_rs():
     curr_dir = os.path.abspath(os.path.dirname(__file__))
     return open(f'{curr_dir}/transpiler/udf.rs', 'r').read()
 
-async def ensure_transpiler_pipeline_is_ready(session, pipeline_name):
-    # curr_dir = os.path.abspath(os.path.dirname(__file__))
-    transpiler_sql = read_transpiler_sql()
+def transpiler_fingerprint(profile='debug'):
+    transpiler_sql = read_transpiler_sql(profile)
     udf_rs = read_transpiler_udf_rs()
-    # retrieve current version of program_code for transpiler pipeline
-    # is it is not the same as on on the disc, recompile it
-    if (await do_need_to_recompile_transpiler(session, pipeline_name, transpiler_sql, udf_rs)):
-        await recompile_transpiler(session, pipeline_name, transpiler_sql, udf_rs)
-    print("Waiting for transpiler to be ready")
-    await wait_till_transpiler_compiled(session, pipeline_name)
-    await ensure_transpiler_started(session, pipeline_name)
-
+    return hashlib.sha256((transpiler_sql + udf_rs).encode('utf-8')).hexdigest()[:10]
 
+async def retire_transpiler(session, pipeline_name):
+    # stop a pipeline replaced by a blue/green redeploy and free its storage
+    async with session.post(f'/v0/pipelines/{pipeline_name}/stop', params={'force': 'true'}) as resp:
+        if resp.status not in [200, 202]:
+            body = await resp.text()
+            raise Exception(f"Unexpected response {resp.status}: {body}")
+    await poll_until(
+        lambda: fetch_pipeline_status(session, pipeline_name),
+        lambda status: status['deployment_status'] == 'Stopped')
+    async with session.post(f'/v0/pipelines/{pipeline_name}/clear') as resp:
+        if resp.status not in [200, 202]:
+            body = await resp.text()
+            raise Exception(f"Unexpected response {resp.status}: {body}")
 
-async def main():
+def blue_green_slots(pipeline_name):
+    # a blue/green redeploy compiles into whichever slot is not serving
+    return (pipeline_name, f'{pipeline_name}_green')
+
+async def resolve_serving_pipeline(session, pipeline_name, fingerprint=None):
+    # the slot of pipeline_name that serves transpile traffic: the running
+    # one deployed with `fingerprint` if any, else any running one
+    slots = blue_green_slots(pipeline_name)
+    statuses = await asyncio.gather(*[fetch_pipeline_status(session, slot) for slot in slots])
+    running = [slot for slot, status in zip(slots, statuses) if status.get('deployment_status') == 'Running']
+    for slot, status in zip(slots, statuses):
+        if fingerprint is not None and is_serving(status, fingerprint):
+            return slot
+    return running[0] if running else pipeline_name
+
+async def ensure_transpiler_pipeline_is_ready(session, pipeline_name, profile='debug', blue_green=False):
+    # returns the name of the pipeline that serves transpile traffic
+    # curr_dir = os.path.abspath(os.path.dirname(__file__))
+    transpiler_sql = read_transpiler_sql(profile)
+    udf_rs = read_transpiler_udf_rs()
+    fingerprint = transpiler_fingerprint(profile)
+    # the description holds the fingerprint of the deployed transpiler,
+    # so an up to date pipeline costs a status call per slot. Both slots
+    # are looked at even without blue_green: an earlier blue/green deploy
+    # may have left the other slot serving
+    slots = blue_green_slots(pipeline_name)
+    statuses = dict(zip(slots, await asyncio.gather(*[fetch_pipeline_status(session, slot) for slot in slots])))
+    running = [slot for slot in slots if statuses[slot].get('deployment_status') == 'Running']
+    up_to_date = [slot for slot in slots if is_serving(statuses[slot], fingerprint)]
+    if up_to_date:
+        target = up_to_date[0]
+    elif blue_green:
+        # compile into the idle slot while the other one keeps serving
+        target = next(slot for slot in slots if slot not in running[:1])
+    else:
+        target = pipeline_name
+    # running slots other than the target are retired once it serves, so
+    # resolve_serving_pipeline() cannot fall back to an outdated one
+    others = [slot for slot in running if slot != target]
+
+    if target not in up_to_date:
+        if deployed_fingerprint(statuses[target]) != fingerprint:
+            print(f"Deploying transpiler {fingerprint} to {target}")
+            await recompile_transpiler(session, target, transpiler_sql, udf_rs, fingerprint)
+        print("Waiting for transpiler to be ready")
+        await wait_till_transpiler_compiled(session, target)
+        await ensure_transpiler_started(session, target)
+    # swap: clients resolve to the new slot from now on
+    for other in others:
+        print(f"Retiring {other}")
+        await retire_transpiler(session, other)
+    return target
+
+def shard_pipeline_names(pipeline_name, num_shards=1):
+    # a single shard keeps the plain name, so the default deployment
+    # is the same pipeline as before pools existed
+    if num_shards == 1:
+        return [pipeline_name]
+    return [f'{pipeline_name}_{i}' for i in range(num_shards)]
+
+def ring_hash(key):
+    return int(hashlib.sha256(key.encode('utf-8')).hexdigest()[:16], 16)
+
+class ShardRing:
+    """
+    Consistent hashing of program pipeline_ids onto transpiler pipelines.
+
+    Every shard is placed on the ring `replicas` times, so programs spread
+    evenly, and adding or removing a shard only moves the programs of the
+    ring segments it takes over or gives up.
+    """
+
+    def __init__(self, shards, replicas=64):
+        self.ring = sorted((ring_hash(f'{shard}#{i}'), shard) for shard in shards for i in range(replicas))
+        self.hashes = [h for (h, _) in self.ring]
+
+    def shard_for(self, key):
+        i = bisect.bisect(self.hashes, ring_hash(key)) % len(self.ring)
+        return self.ring[i][1]
+
+async def ensure_transpiler_pool_is_ready(session, pipeline_names, profile='debug', blue_green=False):
+    # all shards are identical and compile and start side by side
+    return await asyncio.gather(*[
+        ensure_transpiler_pipeline_is_ready(session, pipeline_name, profile, blue_green)
+        for pipeline_name in pipeline_names
+    ])
+
+
+
+async def main(profile='debug', num_shards=1, blue_green=False):
     feldera_url = 'http://localhost:8080'
     pipeline_name = 'transpiler'
 
-    async with aiohttp.ClientSession(feldera_url, timeout=aiohttp.ClientTimeout(sock_read=0,total=0)) as session:
-        await ensure_transpiler_pipeline_is_ready(session, pipeline_name)
+    async with open_session(feldera_url) as session:
+        await ensure_transpiler_pool_is_ready(
+            session, shard_pipeline_names(pipeline_name, num_shards), profile, blue_green)
         # records1, pipeline_id = rules_to_records(rules)
-        # records2 = schemas_to_records(tables2, pipeline_id)
-        # records = {**records2, **records1}
+        # records = schemas_to_records(tables2, pipeline_id, records1)
         # tokens = await insert_records(session, pipeline_name, records)
         # await wait_till_complete(session, pipeline_name, tokens)
 
@@ -150,4 +291,15 @@ async def main():
 
 
 if __name__ == '__main__':
-    asyncio.run(main(), debug=True)
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument(
+        '--profile', choices=PROFILES, default='debug',
+        help="lean materializes only the views clients read, debug materializes everything")
+    arg_parser.add_argument(
+        '--shards', type=int, default=1,
+        help="number of identical transpiler pipelines to deploy, programs are spread over them by pipeline_id")
+    arg_parser.add_argument(
+        '--blue-green', action='store_true',
+        help="compile a changed transpiler next to the running one and switch over once it is started")
+    args = arg_parser.parse_args()
+    asyncio.run(main(args.profile, args.shards, args.blue_green), debug=True)
@@ -0,0 +1,96 @@
+import os
+import json
+import time
+import hashlib
+
+from output_cache import atomic_write
+
+
+
+class FileHashes:
+    """
+    Content hashes of files, memoized by (size, mtime_ns, inode).
+
+    A file whose stat did not change since it was last hashed is not read
+    again. The memo is kept in a JSON file across runs if `path` is given.
+    Stats gathered by a directory scan can be handed over with remember_stat(),
+    otherwise a file is stat'ed on its first hash() of the run. Either way
+    its hash is then fixed for the rest of the run.
+    """
+
+    def __init__(self, path=None, racy_window=1.0):
+        self.path = path
+        # a file written in the same mtime tick as it was hashed would keep
+        # its stat, so hashes of files that recent are not persisted
+        self.racy_window = racy_window
+        self.entries = {}
+        self.stats = {}
+        self.hashes = {}
+        self.dirty = False
+        if path and os.path.exists(path):
+            try:
+                with open(path, 'r') as f:
+                    self.entries = json.load(f)
+            except json.JSONDecodeError:
+                self.entries = {}
+
+    def remember_stat(self, file_path, stat):
+        self.stats[os.path.abspath(file_path)] = stat
+
+    def invalidate(self, file_path):
+        # the file changed during the run (watch mode), stat it again
+        file_path = os.path.abspath(file_path)
+        self.stats.pop(file_path, None)
+        self.hashes.pop(file_path, None)
+
+    def hash(self, file_path):
+        file_path = os.path.abspath(file_path)
+        if file_path in self.hashes:
+            return self.hashes[file_path]
+        stat = self.stats.get(file_path)
+        if stat is None:
+            stat = self.stats[file_path] = os.stat(file_path)
+        signature = [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+        entry = self.entries.get(file_path)
+        if entry is not None and entry['stat'] == signature:
+            content_hash = entry['hash']
+        else:
+            content_hash = hashlib.sha256(open(file_path, 'rb').read()).hexdigest()[:10]
+            if time.time() - stat.st_mtime_ns / 1e9 > self.racy_window:
+                self.entries[file_path] = {'stat': signature, 'hash': content_hash}
+            else:
+                self.entries.pop(file_path, None)
+            self.dirty = True
+        self.hashes[file_path] = content_hash
+        return content_hash
+
+    def save(self):
+        if not (self.path and self.dirty):
+            return
+        # entries of deleted files are dropped
+        entries = {p: e for p, e in self.entries.items() if p in self.stats or os.path.exists(p)}
+        atomic_write(self.path, json.dumps(entries).encode('utf-8'))
+        self.dirty = False
+
+
+
+def scan_files(paths, suffix):
+    # yields (path, stat) for the files among `paths` and the files ending
+    # with `suffix` below the directories among them, skipping hidden ones.
+    # os.scandir gets the file types with the listing, so only the matching
+    # files are stat'ed
+    for path in paths:
+        if not os.path.isdir(path):
+            yield (path, os.stat(path))
+            continue
+        pending_dirs = [path]
+        while pending_dirs:
+            with os.scandir(pending_dirs.pop()) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+            for entry in entries:
+                if entry.name.startswith('.'):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    pending_dirs.append(entry.path)
+                elif entry.name.endswith(suffix) and entry.is_file():
+                    yield (entry.path, entry.stat())
@@ -0,0 +1,250 @@
+import collections
+
+import dsl
+from dsl import rule, fact, neg_fact
+from records import content_id
+
+
+
+# Rules whose bodies start with the same positive facts, joined on the same
+# variables, each keep their own copy of that join and of its state. This
+# pass moves such a shared prefix into a rule of its own, the view every
+# one of them then reads as a single fact.
+#
+# Only prefixes that can be shared without changing results qualify:
+# - the facts bind plain variables, no constants or nested expressions,
+# - the rule does not aggregate, since the prefix view is DISTINCT over
+#   its variables and would change counts,
+# - the prefix does not read the rule's own table or anything depending
+#   on it, which would pull the prefix view into a recursive component.
+#
+# dsl.rules_to_records(rules, share_join_prefixes=True) runs the pass,
+# share_parsed_join_prefixes() runs it on programs parsed by parser.py
+# (`ensure_tests_transpiled.py --share-join-prefixes`), `benchmark.py
+# join_prefixes` measures it on the tables that are not pruned.
+
+
+
+def var_bindings(body_stmt):
+    # sorted [(column_name, var_name)] of a positive fact binding only
+    # plain variables, None for any other body statement
+    match body_stmt:
+        case {'type': 'fact', 'negated': False, 'args': args}:
+            bindings = []
+            for arg in args:
+                match arg:
+                    case str(var_name):
+                        bindings.append((var_name, var_name))
+                    case (str(column_name), str(var_name)):
+                        bindings.append((column_name, var_name))
+                    case _:
+                        return None
+            return sorted(bindings)
+        case _:
+            return None
+
+def has_aggr(expr):
+    match expr:
+        case {'type': 'aggr'}:
+            return True
+        case dict():
+            return any(has_aggr(v) for v in expr.values())
+        case list() | tuple():
+            return any(has_aggr(v) for v in expr)
+        case _:
+            return False
+
+def positive_facts(body):
+    # [(body index, table_name)] in body order, the order rules join in
+    return [
+        (i, s['table_name']) for i, s in enumerate(body)
+        if s['type'] == 'fact' and not s['negated']
+    ]
+
+def join_count(rules):
+    # joins a rule compiles to, one between every two adjacent positive facts
+    return sum(max(0, len(positive_facts(r['body'])) - 1) for r in rules)
+
+def table_dependencies(rules):
+    # {table_name: tables it reads, transitively}
+    direct = collections.defaultdict(set)
+    for r in rules:
+        direct[r['table_name']] |= {s['table_name'] for s in r['body'] if s['type'] == 'fact'}
+    dependencies = {}
+    for table_name in direct:
+        seen = set()
+        pending = [table_name]
+        while pending:
+            for dependency in direct.get(pending.pop(), ()):
+                if dependency not in seen:
+                    seen.add(dependency)
+                    pending.append(dependency)
+        dependencies[table_name] = seen
+    return dependencies
+
+def canonical_prefix(body, indexes):
+    # (key, bindings) of the facts at `indexes`: the key is their tables
+    # and the groups of (position, column_name) bound to the same variable,
+    # which are the joins, so prefixes that only differ in variable names
+    # and in the columns they project get the same key. bindings is
+    # {(position, column_name): var_name}
+    bindings = {}
+    groups = collections.defaultdict(list)
+    for position, i in enumerate(indexes):
+        for column_name, var_name in var_bindings(body[i]):
+            bindings[(position, column_name)] = var_name
+            groups[var_name].append((position, column_name))
+    joins = sorted(tuple(group) for group in groups.values() if len(group) > 1)
+    key = (tuple(body[i]['table_name'] for i in indexes), tuple(joins))
+    return (key, bindings)
+
+def prefix_candidates(rules, min_prefix_len):
+    # {key: [(rule index, body indexes of the prefix)]} for every prefix
+    # of at least min_prefix_len facts of every eligible rule
+    dependencies = table_dependencies(rules)
+    candidates = collections.defaultdict(list)
+    for rule_index, r in enumerate(rules):
+        if has_aggr(r['params']):
+            continue
+        indexes = []
+        for i, table_name in positive_facts(r['body']):
+            if not var_bindings(r['body'][i]):
+                break
+            if table_name == r['table_name'] or r['table_name'] in dependencies.get(table_name, ()):
+                break
+            indexes.append(i)
+            if len(indexes) >= min_prefix_len:
+                (key, _) = canonical_prefix(r['body'], indexes)
+                candidates[key].append((rule_index, list(indexes)))
+    return candidates
+
+def prefix_table_name(key):
+    return f"{key[0][0]}__join_prefix_{content_id(repr(key))}"
+
+def prefix_columns(key, users_bindings):
+    # {(position, column_name): view column name} for every column any
+    # user reads, the columns of a join group sharing one view column
+    (_, joins) = key
+    representative = {pair: group[0] for group in joins for pair in group}
+    pairs = sorted({representative.get(pair, pair) for bindings in users_bindings for pair in bindings})
+    counts = collections.Counter(column_name for _, column_name in pairs)
+    names = {
+        (position, column_name): column_name if counts[column_name] == 1 else f'{column_name}_{position}'
+        for position, column_name in pairs
+    }
+    return {pair: names[representative.get(pair, pair)] for bindings in users_bindings for pair in bindings}
+
+def prefix_rule(table_name, key, columns):
+    (tables, _) = key
+    facts = [
+        fact(fact_table, *[
+            column_name if column_name == name else (column_name, name)
+            for (position, column_name), name in sorted(columns.items()) if position == i
+        ])
+        for i, fact_table in enumerate(tables)
+    ]
+    return rule(table_name, sorted(set(columns.values())), facts)
+
+def prefix_fact(table_name, columns, bindings):
+    args = {columns[pair]: var_name for pair, var_name in bindings.items()}
+    return fact(table_name, *[
+        name if name == var_name else (name, var_name)
+        for name, var_name in sorted(args.items())
+    ])
+
+def share_join_prefixes(rules, min_prefix_len=2, min_uses=2):
+    # returns (rules, shared): the rules with shared prefixes replaced by a
+    # fact of their prefix view, and [{'table_name', 'facts', 'uses',
+    # 'saved_joins'}] per prefix view. Longer prefixes are shared first,
+    # every rule reads at most one prefix view
+    candidates = prefix_candidates(rules, min_prefix_len)
+    assigned = {}
+    shared = []
+    prefix_rules = []
+    for key in sorted(candidates, key=lambda key: (-len(key[0]), -len(candidates[key]), repr(key))):
+        users = [(rule_index, indexes) for rule_index, indexes in candidates[key] if rule_index not in assigned]
+        if len(users) < min_uses:
+            continue
+        table_name = prefix_table_name(key)
+        users_bindings = [canonical_prefix(rules[rule_index]['body'], indexes)[1] for rule_index, indexes in users]
+        columns = prefix_columns(key, users_bindings)
+        prefix_rules.append(prefix_rule(table_name, key, columns))
+        for (rule_index, indexes), bindings in zip(users, users_bindings):
+            assigned[rule_index] = prefix_fact(table_name, columns, bindings), indexes
+        shared.append({
+            'table_name': table_name,
+            'facts': list(key[0]),
+            'uses': len(users),
+            # every user but the first saves the joins inside the prefix
+            'saved_joins': (len(users) - 1) * (len(key[0]) - 1),
+        })
+    rewritten = []
+    for rule_index, r in enumerate(rules):
+        if rule_index not in assigned:
+            rewritten.append(r)
+            continue
+        (shared_fact, indexes) = assigned[rule_index]
+        body = []
+        for i, body_stmt in enumerate(r['body']):
+            if i == indexes[0]:
+                body.append(shared_fact)
+            elif i not in indexes:
+                body.append(body_stmt)
+        rewritten.append({**r, 'body': body})
+    return (rewritten + prefix_rules, shared)
+
+def rules_from_parsed(records):
+    # dsl rules of a program parsed by parser.py, whose expressions are
+    # all var_expr or int_expr
+    exprs = {}
+    for table_name, column_name in [('var_expr', 'var_name'), ('int_expr', 'value')]:
+        if table_name in records:
+            for row in records.rows(table_name):
+                exprs[(row['rule_id'], row['expr_id'])] = row[column_name]
+
+    def arg(row):
+        expr = exprs.get((row['rule_id'], row['expr_id']))
+        if expr is None:
+            raise Exception(f"Invalid parsed expr {row}")
+        return row['key'] if expr == row['key'] else (row['key'], expr)
+
+    params = collections.defaultdict(list)
+    fact_args = collections.defaultdict(list)
+    body = collections.defaultdict(list)
+    for row in records.rows('rule_param') if 'rule_param' in records else []:
+        params[row['rule_id']].append(arg(row))
+    for row in records.rows('fact_arg') if 'fact_arg' in records else []:
+        fact_args[(row['rule_id'], row['fact_id'])].append(arg(row))
+    for row in records.rows('body_fact') if 'body_fact' in records else []:
+        make_fact = neg_fact if row['negated'] else fact
+        body[row['rule_id']].append(
+            (row['index'], make_fact(row['table_name'], *fact_args[(row['rule_id'], row['fact_id'])])))
+    return [
+        rule(row['table_name'], params[row['rule_id']], [stmt for _, stmt in sorted(body[row['rule_id']])])
+        for row in records.rows('rule')
+    ]
+
+def share_parsed_join_prefixes(records, **kwargs):
+    # returns (records, shared) for a program parsed by parser.py, the
+    # records rebuilt by dsl.py if any prefix is shared, as they were
+    # otherwise
+    (rules, shared) = share_join_prefixes(rules_from_parsed(records), **kwargs)
+    if not shared:
+        return (records, shared)
+    (records, _) = dsl.rules_to_records(rules)
+    return (records, shared)
+
+
+
+if __name__ == '__main__':
+    from example_source_dsl import get_rules
+
+    rules = get_rules()
+    (optimized, shared) = share_join_prefixes(rules)
+    for prefix in shared:
+        print(
+            f"{prefix['table_name']}: {' JOIN '.join(prefix['facts'])} "
+            f"shared by {prefix['uses']} rules, saves {prefix['saved_joins']} joins")
+    # pruned tables included, see `benchmark.py join_prefixes` for the
+    # joins of generated tables
+    print(f"rule joins: {join_count(rules)} -> {join_count(optimized)}")
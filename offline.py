@@ -0,0 +1,553 @@
+import re
+import sys
+import collections
+
+import parser
+
+
+
+# In-process evaluation of the transpiler views (003_codegen_preparation.sql,
+# 004_codegen.sql, 999_errors.sql) for editor tooling and CI, where starting
+# a Feldera pipeline is not an option.
+#
+# It follows the SQL literally, quirks included, so both backends produce
+# the same full_pipeline_sql and "error" rows. Views that do not feed
+# either of them (match_where_cond, neg_fact_where_cond, ...) are skipped.
+# Every view joins on pipeline_id, so each program is evaluated on its own
+# and pipeline_id is left out of the intermediate rows. ARRAY_AGG without
+# ORDER BY and ARG_MIN ties have no defined order in SQL, here they are
+# ordered by value.
+
+
+
+AGGR_FN_NAMES = {'count': 'COUNT'}
+
+TEMPLATE_VAR_RE = re.compile(r'^\{\{[a-zA-Z_][A-Za-z0-9_:]*\}\}$')
+
+
+
+def group_by(rows, key):
+    groups = collections.defaultdict(list)
+    for row in rows:
+        groups[key(row)].append(row)
+    return groups
+
+def semi_naive(base, step, view_name, max_rounds=100000):
+    # least fixpoint of a monotone recursive view,
+    # step(delta, total) only derives rows from the rows new in the last round
+    total = set(base)
+    delta = set(base)
+    for _ in range(max_rounds):
+        if not delta:
+            return total
+        delta = set(step(delta, total)) - total
+        total |= delta
+    raise Exception(f"{view_name} does not converge")
+
+def naive_fixpoint(step, state, view_name, max_rounds=10000):
+    # recursive views with aggregates over themselves are not monotone,
+    # so they are recomputed from the previous round until nothing changes
+    for _ in range(max_rounds):
+        next_state = step(state)
+        if next_state == state:
+            return state
+        state = next_state
+    raise Exception(f"{view_name} does not converge")
+
+def arg_min(rows, key):
+    return min(rows, key=lambda row: (key(row), row))
+
+
+
+def table_direct_dependency(rules, body_facts_by_rule):
+    # (table_name, parent_table_name, negated)
+    return {
+        (rule['table_name'], body_fact['table_name'], body_fact['negated'])
+        for rule in rules
+        for body_fact in body_facts_by_rule.get(rule['rule_id'], [])
+    }
+
+def table_dependency(direct_dependencies):
+    parents = group_by(direct_dependencies, key=lambda dep: dep[0])
+
+    def step(delta, total):
+        for (table_name, middle_table_name) in delta:
+            for (_, parent_table_name, _) in parents.get(middle_table_name, []):
+                yield (table_name, parent_table_name)
+
+    base = {(table_name, parent_table_name) for (table_name, parent_table_name, _) in direct_dependencies}
+    return semi_naive(base, step, 'table_dependency')
+
+def table_component(schema_tables, rules, dependencies):
+    # table_name -> smallest table name of its strongly connected component
+    components = {schema_table['table_name']: schema_table['table_name'] for schema_table in schema_tables}
+    components |= {rule['table_name']: rule['table_name'] for rule in rules}
+    for (table_name, other_table_name) in dependencies:
+        if (other_table_name, table_name) in dependencies and table_name in components:
+            components[table_name] = min(components[table_name], other_table_name)
+    return components
+
+def recursive_table(dependencies):
+    return {table_name for (table_name, parent_table_name) in dependencies if table_name == parent_table_name}
+
+def table_output_order(components, dependencies):
+    orders = {(table_name, 0) for table_name in components}
+    orders |= {(table_name, 1) for table_name in recursive_table(dependencies) if table_name in components}
+    parent_components = collections.defaultdict(set)
+    for (table_name, parent_table_name) in dependencies:
+        if table_name in components and parent_table_name in components \
+                and components[parent_table_name] != components[table_name]:
+            parent_components[table_name].add(components[parent_table_name])
+    return orders | {(table_name, len(parents) + 1) for table_name, parents in parent_components.items()}
+
+def table_column_type(tables):
+    # (table_name, column_name, data_type)
+    rule_tables = {rule['rule_id']: rule['table_name'] for rule in tables['rule']}
+    var_names = {(e['rule_id'], e['expr_id']): e['var_name'] for e in tables['var_expr']}
+    positive_facts = {(f['rule_id'], f['fact_id']): f['table_name'] for f in tables['body_fact'] if not f['negated']}
+    base = {(c['table_name'], c['column_name'], c['data_type']) for c in tables['schema_table_column']}
+    literal_types = {'int_expr': 'BIGINT', 'str_expr': 'TEXT'}
+    # (fact_table_name, fact_key) -> {(table_name, column_name)} bound to the same variable
+    bound_columns = collections.defaultdict(set)
+    for param in tables['rule_param']:
+        if param['rule_id'] not in rule_tables:
+            continue
+        if param['expr_type'] in literal_types:
+            base.add((rule_tables[param['rule_id']], param['key'], literal_types[param['expr_type']]))
+    params_by_var = group_by(
+        [p for p in tables['rule_param'] if p['expr_type'] == 'var_expr' and p['rule_id'] in rule_tables],
+        key=lambda p: (p['rule_id'], var_names.get((p['rule_id'], p['expr_id']))))
+    for arg in tables['fact_arg']:
+        fact_table_name = positive_facts.get((arg['rule_id'], arg['fact_id']))
+        if arg['expr_type'] != 'var_expr' or fact_table_name is None:
+            continue
+        for param in params_by_var.get((arg['rule_id'], var_names.get((arg['rule_id'], arg['expr_id']))), []):
+            bound_columns[(fact_table_name, arg['key'])].add((rule_tables[param['rule_id']], param['key']))
+
+    def step(delta, total):
+        for (table_name, column_name, data_type) in delta:
+            for (bound_table_name, bound_column_name) in bound_columns.get((table_name, column_name), []):
+                yield (bound_table_name, bound_column_name, data_type)
+
+    return semi_naive(base, step, 'table_column_type')
+
+def recursive_view_declaration(tables, recursive_tables, column_types):
+    # table_name -> DECLARE RECURSIVE VIEW line, and the unresolved
+    # (table_name, column_name), with no type or more than one
+    rule_tables = {rule['rule_id']: rule['table_name'] for rule in tables['rule']}
+    columns = {
+        (rule_tables[param['rule_id']], param['key'])
+        for param in tables['rule_param']
+        if rule_tables.get(param['rule_id']) in recursive_tables
+    }
+    types = collections.defaultdict(set)
+    for (table_name, column_name, data_type) in column_types:
+        if (table_name, column_name) in columns:
+            types[(table_name, column_name)].add(data_type)
+    unresolved = {column for column in columns if len(types.get(column, ())) != 1}
+    unresolved_tables = {table_name for (table_name, _) in unresolved}
+    declarations = {}
+    for table_name, table_columns in group_by(sorted(columns), key=lambda c: c[0]).items():
+        if table_name in unresolved_tables:
+            continue
+        columns_sql = ', '.join(f'"{column_name}" {min(types[(table_name, column_name)])}' for (_, column_name) in table_columns)
+        declarations[table_name] = f'DECLARE RECURSIVE VIEW "{table_name}" ({columns_sql});'
+    return (declarations, unresolved)
+
+def pruned_table(tables, dependencies):
+    # tables with rules no root (output_root) depends on, none without roots
+    roots = {t['table_name'] for t in tables['declared_output']}
+    roots |= {t['table_name'] for t in tables['schema_table'] if t['materialized']}
+    if not roots:
+        return set()
+    live_tables = roots | {parent_table_name for (table_name, parent_table_name) in dependencies if table_name in roots}
+    return {rule['table_name'] for rule in tables['rule']} - live_tables
+
+def table_output_position(orders, pruned_tables):
+    # table_name -> order, (order, table_name) being the output ordering key
+    positions = {}
+    for (table_name, order) in orders:
+        if table_name in pruned_tables:
+            continue
+        positions[table_name] = max(positions.get(table_name, order), order)
+    return {table_name: order for table_name, order in positions.items() if order > 0}
+
+
+
+def fact_aliases(body_facts):
+    # (rule_id, fact_id, fact_index, table_name, negated, alias)
+    return {
+        (f['rule_id'], f['fact_id'], f['index'], f['table_name'], f['negated'], f"{f['fact_id']}:{f['table_name']}")
+        for f in body_facts
+    }
+
+def adjacent_facts(aliases):
+    # (rule_id, prev_fact_id) -> next_fact_id, among facts with the same negated
+    adjacent = {}
+    for facts in group_by(aliases, key=lambda fa: (fa[0], fa[4])).values():
+        for prev_fact in facts:
+            next_facts = [fa for fa in facts if prev_fact[2] < fa[2]]
+            if next_facts:
+                adjacent[(prev_fact[0], prev_fact[1])] = arg_min(next_facts, key=lambda fa: fa[2])[1]
+    return adjacent
+
+def var_mentioned_in_expr(tables):
+    base = {(e['rule_id'], e['expr_id'], 'var_expr', e['var_name'], '') for e in tables['var_expr']}
+    base |= {(e['rule_id'], e['expr_id'], 'aggr_expr', e['arg_var'], '') for e in tables['aggr_expr']}
+    for e in tables['sql_expr']:
+        for part in e['template']:
+            if TEMPLATE_VAR_RE.match(part):
+                base.add((e['rule_id'], e['expr_id'], 'sql_expr', part[2:-2], ''))
+
+    # (rule_id, entry expr_id, entry expr_type) -> [(parent expr, access prefix)]
+    parents = collections.defaultdict(list)
+    array_exprs = group_by(tables['array_expr'], key=lambda e: (e['rule_id'], e['array_id']))
+    for entry in tables['array_entry']:
+        for e in array_exprs.get((entry['rule_id'], entry['array_id']), []):
+            parents[(entry['rule_id'], entry['expr_id'], entry['expr_type'])].append(
+                (e['expr_id'], 'array_expr', f"[{entry['index']}]"))
+    dict_exprs = group_by(tables['dict_expr'], key=lambda e: (e['rule_id'], e['dict_id']))
+    for entry in tables['dict_entry']:
+        for e in dict_exprs.get((entry['rule_id'], entry['dict_id']), []):
+            parents[(entry['rule_id'], entry['expr_id'], entry['expr_type'])].append(
+                (e['expr_id'], 'dict_expr', f"['{entry['key']}']"))
+
+    def step(delta, total):
+        for (rule_id, expr_id, expr_type, var_name, access_prefix) in delta:
+            for (parent_expr_id, parent_expr_type, prefix) in parents.get((rule_id, expr_id, expr_type), []):
+                yield (rule_id, parent_expr_id, parent_expr_type, var_name, prefix + access_prefix)
+
+    return semi_naive(base, step, 'var_mentioned_in_expr')
+
+def var_bound_in_fact(fact_args, mentions, aliases):
+    # (rule_id, fact_id, key, negated, fact_index, var_name, sql),
+    # fact_arg is joined on expr_id and fact_id only, like the view does
+    mentions_by_expr = group_by(mentions, key=lambda m: (m[1], m[2]))
+    aliases_by_fact = group_by(aliases, key=lambda fa: fa[1])
+    return {
+        (fa[0], arg['fact_id'], arg['key'], fa[4], fa[2], m[3], f'"{fa[5]}"."{arg["key"]}"{m[4]}')
+        for arg in fact_args
+        for m in mentions_by_expr.get((arg['expr_id'], arg['expr_type']), [])
+        for fa in aliases_by_fact.get(arg['fact_id'], [])
+    }
+
+def canonical_fact_var_sql(bindings):
+    # (rule_id, var_name) -> (fact_index, sql)
+    groups = group_by([b for b in bindings if not b[3]], key=lambda b: (b[0], b[5]))
+    return {
+        key: (min(b[4] for b in rows), arg_min(rows, key=lambda b: b[4])[6])
+        for key, rows in groups.items()
+    }
+
+
+
+def substitution_step(tables, mentions, canonical_fact_vars, state):
+    # one round of the views that depend on each other through
+    # substituted_expr and var_bound_via_match (004_codegen.sql up to
+    # var_bound_via_match)
+    (bound_via_match, substituted) = state
+
+    canonical_vars = {(rule_id, var_name, sql, False) for (rule_id, var_name), (_, sql) in canonical_fact_vars.items()}
+    for (rule_id, var_name), rows in group_by(bound_via_match, key=lambda b: (b[0], b[2])).items():
+        if (rule_id, var_name) not in canonical_fact_vars:
+            canonical_vars.add((rule_id, var_name, min(b[3] for b in rows), any(b[4] for b in rows)))
+    canonical_vars_by_name = group_by(canonical_vars, key=lambda c: (c[0], c[1]))
+
+    substituted_next = set()
+    for e in tables['sql_expr']:
+        parts = set()
+        for index, part in enumerate(e['template'], 1):
+            if TEMPLATE_VAR_RE.match(part):
+                for c in canonical_vars_by_name.get((e['rule_id'], part[2:-2]), []):
+                    parts.add((c[2], index))
+            else:
+                parts.add((part, index))
+        if parts and len(parts) == len(e['template']):
+            sql = ''.join(part for part, _ in sorted(parts, key=lambda p: (p[1], p[0])))
+            substituted_next.add((e['rule_id'], e['expr_id'], 'sql_expr', sql, False))
+
+    for e in tables['int_expr']:
+        substituted_next.add((e['rule_id'], e['expr_id'], 'int_expr', str(e['value']), False))
+    for e in tables['str_expr']:
+        substituted_next.add((e['rule_id'], e['expr_id'], 'str_expr', f"'{e['value']}'", False))
+    for e in tables['var_expr']:
+        for c in canonical_vars_by_name.get((e['rule_id'], e['var_name']), []):
+            substituted_next.add((e['rule_id'], e['expr_id'], 'var_expr', c[2], c[3]))
+
+    for e in tables['aggr_expr']:
+        if e['fn_name'] == 'count' and e['arg_var'] is None:
+            substituted_next.add((e['rule_id'], e['expr_id'], 'aggr_expr', 'COUNT(*)', True))
+        if e['fn_name'] in AGGR_FN_NAMES:
+            for c in canonical_vars_by_name.get((e['rule_id'], e['arg_var']), []):
+                substituted_next.add((e['rule_id'], e['expr_id'], 'aggr_expr', f"{AGGR_FN_NAMES[e['fn_name']]}({c[2]})", True))
+
+    substituted_by_expr = group_by(substituted, key=lambda s: (s[0], s[1], s[2]))
+    array_entries = group_by(tables['array_entry'], key=lambda entry: (entry['rule_id'], entry['array_id']))
+    for e in tables['array_expr']:
+        elements = [
+            (entry['index'], s[3], s[4])
+            for entry in array_entries.get((e['rule_id'], e['array_id']), [])
+            for s in substituted_by_expr.get((e['rule_id'], entry['expr_id'], entry['expr_type']), [])
+        ]
+        if elements:
+            sql = 'ARRAY[' + ', '.join(sql for _, sql, _ in sorted(elements)) + ']'
+            substituted_next.add((e['rule_id'], e['expr_id'], 'array_expr', sql, any(a for _, _, a in elements)))
+    dict_entries = group_by(tables['dict_entry'], key=lambda entry: (entry['rule_id'], entry['dict_id']))
+    for e in tables['dict_expr']:
+        elements = [
+            (f"'{entry['key']}', {s[3]}", s[4])
+            for entry in dict_entries.get((e['rule_id'], e['dict_id']), [])
+            for s in substituted_by_expr.get((e['rule_id'], entry['expr_id'], entry['expr_type']), [])
+        ]
+        if elements:
+            sql = 'MAP[' + ', '.join(sorted(sql for sql, _ in elements)) + ']'
+            substituted_next.add((e['rule_id'], e['expr_id'], 'dict_expr', sql, any(a for _, a in elements)))
+
+    substituted_next_by_expr = group_by(substituted_next, key=lambda s: (s[0], s[1], s[2]))
+    mentions_by_expr = group_by(mentions, key=lambda m: (m[0], m[1], m[2]))
+    bound_via_match_next = set()
+    for m in tables['body_match']:
+        for right in substituted_next_by_expr.get((m['rule_id'], m['right_expr_id'], m['right_expr_type']), []):
+            for mention in mentions_by_expr.get((m['rule_id'], m['left_expr_id'], m['left_expr_type']), []):
+                bound_via_match_next.add((m['rule_id'], m['match_id'], mention[3], right[3] + mention[4], right[4]))
+    for param in tables['rule_param']:
+        for s in substituted_next_by_expr.get((param['rule_id'], param['expr_id'], param['expr_type']), []):
+            bound_via_match_next.add((param['rule_id'], None, param['key'], s[3], s[4]))
+
+    return (bound_via_match_next, substituted_next)
+
+
+
+def rule_join_sql(aliases, adjacent, bindings, canonical_fact_vars):
+    var_joins = collections.defaultdict(set)
+    for b in bindings:
+        canonical = canonical_fact_vars.get((b[0], b[5]))
+        if canonical and not b[3] and canonical[0] < b[4]:
+            var_joins[(b[0], b[1])].add(f'{b[6]} = {canonical[1]}')
+
+    aliases_by_fact = {(fa[0], fa[1]): fa for fa in aliases}
+    base = set()
+    for facts in group_by([fa for fa in aliases if not fa[4]], key=lambda fa: fa[0]).values():
+        first_fact = arg_min(facts, key=lambda fa: fa[2])
+        base.add((first_fact[0], first_fact[1], (f'  FROM "{first_fact[3]}" AS "{first_fact[5]}"',)))
+
+    def step(delta, total):
+        for (rule_id, fact_id, sql_lines) in delta:
+            next_fact_id = adjacent.get((rule_id, fact_id))
+            if next_fact_id is None:
+                continue
+            next_fact = aliases_by_fact[(rule_id, next_fact_id)]
+            conds = sorted(var_joins.get((rule_id, next_fact_id), []))
+            if not conds:
+                yield (rule_id, next_fact_id, (*sql_lines, f'CROSS JOIN "{next_fact[3]}" AS "{next_fact[5]}"'))
+            else:
+                yield (rule_id, next_fact_id, (
+                    *sql_lines,
+                    f'JOIN "{next_fact[3]}" AS "{next_fact[5]}"',
+                    f'ON {conds[0]}',
+                    *[f'AND {cond}' for cond in conds[1:]],
+                ))
+
+    return semi_naive(base, step, 'rule_join_sql')
+
+def join_sql(rule_joins, adjacent):
+    prev_fact_ids = set(adjacent.keys())
+    next_fact_ids = {(rule_id, next_fact_id) for (rule_id, _), next_fact_id in adjacent.items()}
+    rule_joins_by_fact = group_by(rule_joins, key=lambda r: (r[0], r[1]))
+    joins = {
+        (rule_id, sql_lines)
+        for (rule_id, fact_id, sql_lines) in rule_joins
+        if (rule_id, fact_id) not in prev_fact_ids and (rule_id, fact_id) not in next_fact_ids
+    }
+    # (sic) the second branch takes the fact before the last one,
+    # as join_sql in 004_codegen.sql does
+    for (rule_id, prev_fact_id), next_fact_id in adjacent.items():
+        if (rule_id, next_fact_id) not in prev_fact_ids:
+            joins |= {(rule_id, r[2]) for r in rule_joins_by_fact.get((rule_id, prev_fact_id), [])}
+    return joins
+
+def select_sql(rule_params, substituted, joins):
+    substituted_by_expr = group_by(substituted, key=lambda s: (s[0], s[1], s[2]))
+    columns = collections.defaultdict(list)
+    group_by_exprs = collections.defaultdict(set)
+    for param in rule_params:
+        for s in substituted_by_expr.get((param['rule_id'], param['expr_id'], param['expr_type']), []):
+            columns[param['rule_id']].append((param['key'], f'{s[3]} AS "{param["key"]}"'))
+            if not s[4]:
+                group_by_exprs[param['rule_id']].add((param['key'], param['expr_id'], param['expr_type'], s[3]))
+    return {
+        (rule_id, (
+            'SELECT DISTINCT ' + ', '.join(column for (_, column) in sorted(columns[rule_id])),
+            *sql_lines,
+            'GROUP BY ' + ', '.join(sorted(g[3] for g in group_by_exprs[rule_id])),
+        ))
+        for (rule_id, sql_lines) in joins
+        if columns[rule_id] and group_by_exprs[rule_id]
+    }
+
+def view_full_sql(rules, selects, pruned_tables):
+    rule_ids_by_table = {
+        table_name: sorted({rule['rule_id'] for rule in table_rules})
+        for table_name, table_rules in group_by(rules, key=lambda rule: rule['table_name']).items()
+        if table_name not in pruned_tables
+    }
+    selects_by_rule = group_by(selects, key=lambda s: s[0])
+
+    views = set()
+    for table_name, rule_ids in rule_ids_by_table.items():
+        if any(len(selects_by_rule.get(rule_id, [])) != 1 for rule_id in rule_ids):
+            # incomplete_table_view
+            continue
+        # rule_output_line, aggregated in (rule_id, index) order
+        sql_lines = [f'CREATE MATERIALIZED VIEW "{table_name}" AS']
+        for rule_id in rule_ids:
+            if rule_id != rule_ids[0]:
+                sql_lines.append('UNION')
+            sql_lines.extend(selects_by_rule[rule_id][0][1])
+        sql_lines.append(';')
+        views.add((table_name, tuple(sql_lines)))
+    return views
+
+def full_pipeline_sql(positions, views, recursive_tables, declarations):
+    views_by_table = group_by(views, key=lambda v: v[0])
+    for table_name in positions:
+        if len(views_by_table.get(table_name, [])) != 1:
+            # incomplete_output_table
+            return set()
+        if table_name in recursive_tables and table_name not in declarations:
+            return set()
+    if not positions:
+        return set()
+    # view_output_line, ordered by (order, section, table_name, index)
+    lines = [
+        (order, 0, table_name, 1, declarations[table_name])
+        for table_name, order in positions.items()
+        if table_name in declarations
+    ]
+    lines += [
+        (order, 1, table_name, index, line)
+        for table_name, order in positions.items()
+        for index, line in enumerate(views_by_table[table_name][0][1], 1)
+    ]
+    return {tuple(line[4] for line in sorted(lines))}
+
+
+
+def errors(tables, bindings, substituted, direct_dependencies, components, unresolved_columns):
+    error_types = set()
+    # (sic) the NOT EXISTS subquery only refers to itself, so any positive
+    # binding in the program suppresses the error
+    if any(b[3] for b in bindings) and not any(not b[3] for b in bindings):
+        error_types.add('unbound_var_in_negative_fact')
+    substituted_exprs = {(s[0], s[1], s[2]) for s in substituted}
+    negated_facts = {(f['rule_id'], f['fact_id']) for f in tables['body_fact'] if f['negated']}
+    for arg in tables['fact_arg']:
+        if (arg['rule_id'], arg['fact_id']) in negated_facts \
+                and (arg['rule_id'], arg['expr_id'], arg['expr_type']) not in substituted_exprs:
+            error_types.add('neg_fact_sql_unresolved')
+    for m in tables['body_match']:
+        if (m['rule_id'], m['left_expr_id'], m['left_expr_type']) not in substituted_exprs:
+            error_types.add('match_right_expr_unresolved')
+    for (table_name, parent_table_name, negated) in direct_dependencies:
+        if negated and table_name in components and parent_table_name in components \
+                and components[table_name] == components[parent_table_name]:
+            error_types.add('cycle_through_negation')
+    if unresolved_columns:
+        error_types.add('recursive_view_column_type_unresolved')
+    return error_types
+
+def evaluate_program(pipeline_id, tables):
+    # returns (set of full_pipeline_sql lines, set of error types)
+    tables = collections.defaultdict(list, tables)
+    body_facts_by_rule = group_by(tables['body_fact'], key=lambda f: f['rule_id'])
+
+    direct_dependencies = table_direct_dependency(tables['rule'], body_facts_by_rule)
+    dependencies = table_dependency(direct_dependencies)
+    components = table_component(tables['schema_table'], tables['rule'], dependencies)
+    recursive_tables = recursive_table(dependencies)
+    pruned_tables = pruned_table(tables, dependencies)
+    positions = table_output_position(table_output_order(components, dependencies), pruned_tables)
+    (declarations, unresolved_columns) = recursive_view_declaration(
+        tables, recursive_tables - pruned_tables, table_column_type(tables))
+
+    aliases = fact_aliases(tables['body_fact'])
+    adjacent = adjacent_facts(aliases)
+    mentions = var_mentioned_in_expr(tables)
+    bindings = var_bound_in_fact(tables['fact_arg'], mentions, aliases)
+    canonical_fact_vars = canonical_fact_var_sql(bindings)
+
+    (_, substituted) = naive_fixpoint(
+        lambda state: substitution_step(tables, mentions, canonical_fact_vars, state),
+        (set(), set()), 'substituted_expr')
+
+    rule_joins = rule_join_sql(aliases, adjacent, bindings, canonical_fact_vars)
+    selects = select_sql(tables['rule_param'], substituted, join_sql(rule_joins, adjacent))
+    views = view_full_sql(tables['rule'], selects, pruned_tables)
+    return (
+        full_pipeline_sql(positions, views, recursive_tables, declarations),
+        errors(tables, bindings, substituted, direct_dependencies, components, unresolved_columns),
+    )
+
+def split_programs(records):
+    programs = collections.defaultdict(dict)
+    for table_name, rows in records.items():
+        for row in rows:
+            programs[row['pipeline_id']].setdefault(table_name, []).append(row)
+    return programs
+
+def evaluate(records):
+    """
+    Rows of the full_pipeline_sql and "error" views for `records`,
+    as the transpiler pipeline would produce them after ingesting `records`.
+
+    `records` maps input table names to rows (a RecordBatch or a dict), and
+    may hold several programs told apart by pipeline_id.
+    """
+    programs = split_programs(records)
+
+    output_rows = []
+    error_rows = []
+    for pipeline_id, tables in sorted(programs.items()):
+        (outputs, error_types) = evaluate_program(pipeline_id, tables)
+        output_rows += [{'pipeline_id': pipeline_id, 'sql_lines': list(sql_lines)} for sql_lines in sorted(outputs)]
+        error_rows += [{'pipeline_id': pipeline_id, 'error_type': error_type} for error_type in sorted(error_types)]
+    return (output_rows, error_rows)
+
+def pruned_tables(records):
+    # {pipeline_id: [table_name]}, rows of the pruned_table view
+    pruned = {}
+    for pipeline_id, tables in sorted(split_programs(records).items()):
+        tables = collections.defaultdict(list, tables)
+        body_facts_by_rule = group_by(tables['body_fact'], key=lambda f: f['rule_id'])
+        dependencies = table_dependency(table_direct_dependency(tables['rule'], body_facts_by_rule))
+        table_names = pruned_table(tables, dependencies)
+        if table_names:
+            pruned[pipeline_id] = sorted(table_names)
+    return pruned
+
+def transpile(records):
+    # same shape as ensure_tests_transpiled.fetch_outputs_bulk()
+    (output_rows, error_rows) = evaluate(records)
+    sql_lines = {}
+    errors = {}
+    for row in output_rows:
+        if row['pipeline_id'] in sql_lines:
+            raise Exception(f"Expected one output for {row['pipeline_id']}")
+        sql_lines[row['pipeline_id']] = row['sql_lines']
+    for row in error_rows:
+        errors.setdefault(row['pipeline_id'], []).append(row['error_type'])
+    return (sql_lines, errors)
+
+
+
+if __name__ == '__main__':
+    for path in sys.argv[1:]:
+        records = parser.parse(open(path, 'r').read())
+        records.set_column('pipeline_id', path)
+        (sql_lines, errors) = transpile(records)
+        for table_names in pruned_tables(records).values():
+            print(f"Pruned tables in {path}: {', '.join(table_names)}")
+        if path in errors:
+            print(f"Error in {path}: {', '.join(errors[path])}")
+            continue
+        print('\n'.join(sql_lines.get(path, [])))
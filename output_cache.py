@@ -0,0 +1,133 @@
+import os
+import json
+import time
+import fcntl
+import tempfile
+import contextlib
+
+
+
+def current_umask():
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+# read once, os.umask() can only be read by setting it
+UMASK = current_umask()
+
+def atomic_write(path, data):
+    # readers see either the previous file or the complete new one,
+    # never a partial write, and concurrent writers do not interleave
+    (fd, tmp_path) = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp.')
+    try:
+        # mkstemp creates the file 0600, other runners must be able to
+        # read it like a file written with open()
+        os.fchmod(fd, 0o666 & ~UMASK)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+
+class OutputCache:
+    """
+    Transpiled outputs on disk, shared by concurrent runners.
+
+    An entry is `<key>.sql` in cache_dir, where the key is chosen by the
+    caller (source hash plus transpiler fingerprint), so a changed source
+    or transpiler never hits a stale entry. index.json records the size
+    and last access time of every entry, and save() evicts the least
+    recently used entries beyond max_bytes. Entries and the index are
+    written atomically, the index under a lock, merged with what other
+    runners saved in the meantime.
+    """
+
+    def __init__(self, cache_dir, max_bytes=None, clock=time.time):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.clock = clock
+        # entry file name -> {'size': ..., 'accessed': ...} of this run
+        self.touched = {}
+
+    def entry_path(self, key):
+        return f'{self.cache_dir}/{key}.sql'
+
+    def lookup(self, key):
+        # path of the entry for `key`, None on a miss
+        path = self.entry_path(key)
+        try:
+            size = os.stat(path).st_size
+        except FileNotFoundError:
+            return None
+        self.touched[os.path.basename(path)] = {'size': size, 'accessed': self.clock()}
+        return path
+
+    def store(self, key, data):
+        path = self.entry_path(key)
+        atomic_write(path, data)
+        self.touched[os.path.basename(path)] = {'size': len(data), 'accessed': self.clock()}
+        return path
+
+    def index_path(self):
+        return f'{self.cache_dir}/index.json'
+
+    @contextlib.contextmanager
+    def locked(self):
+        with open(f'{self.cache_dir}/index.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def read_index(self):
+        # the index as saved, reconciled with the entries actually on disk:
+        # entries removed by hand are dropped, unknown ones (written by a
+        # runner that did not save its index) count as accessed at mtime
+        try:
+            with open(self.index_path(), 'r') as f:
+                saved = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            saved = {}
+        index = {}
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if not entry.name.endswith('.sql') or not entry.is_file():
+                    continue
+                stat = entry.stat()
+                accessed = saved.get(entry.name, {}).get('accessed', stat.st_mtime)
+                index[entry.name] = {'size': stat.st_size, 'accessed': accessed}
+        return index
+
+    def evict(self, index):
+        # returns the names of the removed entries
+        total_bytes = sum(entry['size'] for entry in index.values())
+        evicted = []
+        if self.max_bytes is None:
+            return evicted
+        for name in sorted(index, key=lambda name: index[name]['accessed']):
+            if total_bytes <= self.max_bytes:
+                break
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(f'{self.cache_dir}/{name}')
+            total_bytes -= index.pop(name)['size']
+            evicted.append(name)
+        return evicted
+
+    def save(self):
+        with self.locked():
+            index = self.read_index()
+            for name, entry in self.touched.items():
+                if name in index:
+                    index[name]['accessed'] = max(entry['accessed'], index[name]['accessed'])
+            evicted = self.evict(index)
+            atomic_write(self.index_path(), json.dumps(index, indent=1, sort_keys=True).encode('utf-8'))
+        self.touched = {}
+        return evicted
+
+    def report(self):
+        index = self.read_index()
+        return {'entries': len(index), 'bytes': sum(entry['size'] for entry in index.values())}
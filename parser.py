@@ -1,152 +1,193 @@
 import os
+import hashlib
 import functools
+import collections
 
 from lark import Lark, Tree, Token
 
+from records import RecordBatch, content_id
 
 
-def natural_num_generator():
-    n = 1
-    while True:
-        yield n
-        n += 1
 
-def merge_records(records1, records2):
-    result = {}
-    for key, rows in records1.items():
-        if key in records2:
-            result[key] = [*rows, *records2[key]]
-        else:
-            result[key] = rows
-    for key, rows in records2.items():
-        if key not in result:
-            result[key] = rows
-    return result
+def node_id(prefix, rule_id, path):
+    # ids of nodes inside a rule are derived from the rule's content hash
+    # and the node's position in it, so they are stable across runs
+    return f'{prefix}{content_id(rule_id, path)}'
 
 
 
-def records_from_expr(expr, rule_id, expr_id, idgen):
+def records_from_expr(expr, rule_id, expr_id, batch):
     match expr:
         case Token(type='NUMBER', value=value):
-            return 'int_expr', {
-                'int_expr': [{
-                    'rule_id': rule_id,
-                    'expr_id': expr_id,
-                    'value': int(value),
-                }]
-            }
+            batch.append('int_expr', {
+                'rule_id': rule_id,
+                'expr_id': expr_id,
+                'value': int(value),
+            })
+            return 'int_expr'
         case _:
             raise Exception(f"Invalid expr {expr}")
 
 
 
-def records_from_fact_arg(fact_arg, rule_id, fact_id, idgen):
-    expr_id = f'ex{next(idgen)}'
+def records_from_fact_arg(fact_arg, rule_id, fact_id, path, batch):
+    expr_id = node_id('ex', rule_id, path)
     match fact_arg:
         case Tree(data=Token(type='RULE', value='arg'), children=[
             Token(type='IDENTIFIER', value=key),            
         ]):
-            return {
-                'fact_arg': [{ 'rule_id': rule_id, 'fact_id': fact_id, 'key': key, 'expr_id': expr_id, 'expr_type': 'var_expr', }],
-                'var_expr': [{ 'rule_id': rule_id, 'expr_id': expr_id, 'var_name': key, }],
-            }
+            batch.append('fact_arg', { 'rule_id': rule_id, 'fact_id': fact_id, 'key': key, 'expr_id': expr_id, 'expr_type': 'var_expr', })
+            batch.append('var_expr', { 'rule_id': rule_id, 'expr_id': expr_id, 'var_name': key, })
+        case Tree(data=Token(type='RULE', value='arg'), children=[
+            Token(type='IDENTIFIER', value=key),
+            Tree(data='var', children=[Token(type='IDENTIFIER', value=var_name)]),
+        ]):
+            batch.append('fact_arg', { 'rule_id': rule_id, 'fact_id': fact_id, 'key': key, 'expr_id': expr_id, 'expr_type': 'var_expr', })
+            batch.append('var_expr', { 'rule_id': rule_id, 'expr_id': expr_id, 'var_name': var_name, })
+        case Tree(data=Token(type='RULE', value='arg'), children=[
+            Token(type='IDENTIFIER', value=key),
+            Tree(data=Token(type='RULE', value='expr'), children=[expr]),
+        ]):
+            expr_type = records_from_expr(expr, rule_id, expr_id, batch)
+            batch.append('fact_arg', { 'rule_id': rule_id, 'fact_id': fact_id, 'key': key, 'expr_id': expr_id, 'expr_type': expr_type, })
         case _:
             raise Exception(f"Invalid fact arg {fact_arg}")
 
 
 
-def records_from_body_stmt(index, stmt, rule_id, idgen):
+def records_from_body_fact(index, table_name, fact_args, negated, rule_id, batch):
+    fact_id = node_id('ft', rule_id, ('body', index))
+    for (i, fa) in enumerate(fact_args):
+        records_from_fact_arg(fa, rule_id, fact_id, ('body', index, 'arg', i), batch)
+    batch.append('body_fact', { 'rule_id': rule_id, 'fact_id': fact_id, 'index': index, 'table_name': table_name, 'negated': negated })
+
+def records_from_body_stmt(index, stmt, rule_id, batch):
     match stmt:
         case Tree(data=Token(type='RULE', value='fact'), children=[
             Token(type='IDENTIFIER', value=table_name),
             Tree(data=Token(type='RULE', value='args'), children=fact_args),
         ]):
-            fact_id = f'ft{next(idgen)}'
-            args_records = [records_from_fact_arg(fa, rule_id, fact_id, idgen) for fa in fact_args]
-            return functools.reduce(merge_records, [
-                *args_records,
-                { 'body_fact': [{ 'rule_id': rule_id, 'fact_id': fact_id, 'index': index, 'table_name': table_name, 'negated': False }] },
-            ])
+            records_from_body_fact(index, table_name, fact_args, False, rule_id, batch)
+        case Tree(data=Token(type='RULE', value='fact'), children=[
+            Token(type='NOT'),
+            Token(type='IDENTIFIER', value=table_name),
+            Tree(data=Token(type='RULE', value='args'), children=fact_args),
+        ]):
+            records_from_body_fact(index, table_name, fact_args, True, rule_id, batch)
         case _:
             raise Exception(f"Invalid body stmt {stmt}")
 
 
 
-def records_from_rule_param(rule_param, rule_id, idgen):
-    expr_id = f'ex{next(idgen)}'
+def records_from_rule_param(rule_param, rule_id, path, batch):
+    expr_id = node_id('ex', rule_id, path)
     match rule_param:
         case Tree(data=Token(type='RULE', value='arg'), children=[
             Token(type='IDENTIFIER', value=key),
             Tree(data=Token(type='RULE', value='expr'), children=[expr]),
         ]):
-            expr_type, expr_records = records_from_expr(expr, rule_id, expr_id, idgen)
-            return merge_records(
-                expr_records,
-                { 'rule_param': [{ 'rule_id': rule_id, 'key': key, 'expr_id': expr_id, 'expr_type': expr_type, }] },
-            )
+            expr_type = records_from_expr(expr, rule_id, expr_id, batch)
+            batch.append('rule_param', { 'rule_id': rule_id, 'key': key, 'expr_id': expr_id, 'expr_type': expr_type, })
         case Tree(data=Token(type='RULE', value='arg'), children=[
             Token(type='IDENTIFIER', value=key),
+            Tree(data='var', children=[Token(type='IDENTIFIER', value=var_name)]),
         ]):
-            return {
-                'rule_param': [{ 'rule_id': rule_id, 'key': key, 'expr_id': expr_id, 'expr_type': 'var_expr', }],
-                'var_expr': [{ 'rule_id': rule_id, 'expr_id': expr_id, 'var_name': key, }],
-            }
+            batch.append('rule_param', { 'rule_id': rule_id, 'key': key, 'expr_id': expr_id, 'expr_type': 'var_expr', })
+            batch.append('var_expr', { 'rule_id': rule_id, 'expr_id': expr_id, 'var_name': var_name, })
+        case Tree(data=Token(type='RULE', value='arg'), children=[
+            Token(type='IDENTIFIER', value=key),
+        ]):
+            batch.append('rule_param', { 'rule_id': rule_id, 'key': key, 'expr_id': expr_id, 'expr_type': 'var_expr', })
+            batch.append('var_expr', { 'rule_id': rule_id, 'expr_id': expr_id, 'var_name': key, })
         case _:
             raise Exception(f"Invalid rule param {rule_param}")
 
 
 
-def records_from_rule_decl(table_name, rule_params, body_stmts, idgen):
-    rule_id = f'ru{next(idgen)}'
-    param_records = [records_from_rule_param(rp, rule_id, idgen) for rp in rule_params]
-    body_stmts_records = [records_from_body_stmt(i, bs, rule_id, idgen) for (i, bs) in enumerate(body_stmts)]
-    return functools.reduce(merge_records, [
-        *param_records,
-        *body_stmts_records,
-        { 'rule': [{ 'rule_id': rule_id, 'table_name': table_name, }] },
-    ])
+def records_from_rule_decl(rule_id, table_name, rule_params, body_stmts, batch):
+    for (i, rp) in enumerate(rule_params):
+        records_from_rule_param(rp, rule_id, ('param', i), batch)
+    for (i, bs) in enumerate(body_stmts):
+        records_from_body_stmt(i, bs, rule_id, batch)
+    batch.append('rule', { 'rule_id': rule_id, 'table_name': table_name, })
 
 
 
-def records_from_toplevel_decls(toplevel_decl, idgen):
+def records_from_toplevel_decls(toplevel_decl, rule_id, batch):
     # print(toplevel_decl)
     match toplevel_decl:
         case Tree(data=Token(type='RULE', value='rule'), children=[
             Token(type='IDENTIFIER', value=table_name),
             Tree(data=Token(type='RULE', value='args'), children=rule_params),
         ]):
-            return records_from_rule_decl(table_name, rule_params, [], idgen)
+            records_from_rule_decl(rule_id, table_name, rule_params, [], batch)
         case Tree(data=Token(type='RULE', value='rule'), children=[
             Token(type='IDENTIFIER', value=table_name),
             Tree(data=Token(type='RULE', value='args'), children=rule_params),
             Tree(data=Token(type='RULE', value='body_stmt'), children=[body_stmt]),
         ]):
-            return records_from_rule_decl(table_name, rule_params, [body_stmt], idgen)
+            records_from_rule_decl(rule_id, table_name, rule_params, [body_stmt], batch)
+        case Tree(data=Token(type='RULE', value='rule'), children=[
+            Token(type='IDENTIFIER', value=table_name),
+            Tree(data=Token(type='RULE', value='args'), children=rule_params),
+            Tree(data=Token(type='RULE', value='multiline_body'), children=body_stmts),
+        ]):
+            records_from_rule_decl(rule_id, table_name, rule_params, [bs.children[0] for bs in body_stmts], batch)
         case _:
             raise Exception(f"Invalid toplevel decl {toplevel_decl}")
 
 
 
-def records_from_tree(tree, idgen):
+def records_from_tree(tree, batch=None):
+    if batch is None:
+        batch = RecordBatch()
     match tree:
         case Tree(data=Token(type='RULE', value='start'), children=toplevel_decls):
-            return functools.reduce(
-                merge_records,
-                [records_from_toplevel_decls(d, idgen) for d in toplevel_decls])
+            # rule_id is a hash of the rule's syntax tree (token positions are
+            # not part of it); identical rules are told apart by occurrence
+            occurrences = collections.Counter()
+            for d in toplevel_decls:
+                d_repr = repr(d)
+                rule_id = f'ru{content_id(d_repr, occurrences[d_repr])}'
+                occurrences[d_repr] += 1
+                records_from_toplevel_decls(d, rule_id, batch)
+            return batch
         case _:
             raise Exception(f"Invalid tree {tree}")
 
 
 
-def parse(text):
+def grammar_cache_path(grammar_text):
+    scripts_dir = os.path.abspath(os.path.dirname(__file__))
+    cache_dir = f'{scripts_dir}/.grasp_cache'
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    grammar_hash = hashlib.sha256(grammar_text.encode('utf-8')).hexdigest()[:10]
+    return f'{cache_dir}/grammar.{grammar_hash}.lalr'
+
+@functools.cache
+def get_parser(algorithm='lalr'):
     scripts_dir = os.path.abspath(os.path.dirname(__file__))
     grammar_text = open(f'{scripts_dir}/grammar.lark', 'r').read()
     # propagate token positions
     # https://github.com/lark-parser/lark/issues/12#issuecomment-304404835
-    parser = Lark(grammar_text, parser="earley", propagate_positions=True)
-    tree = parser.parse(text)
-    idgen = natural_num_generator()
-    return records_from_tree(tree, idgen)
+    match algorithm:
+        case 'lalr':
+            # analysed parse tables are pickled next to the grammar hash,
+            # so cold starts skip grammar analysis entirely
+            return Lark(
+                grammar_text, parser="lalr", propagate_positions=True,
+                cache=grammar_cache_path(grammar_text))
+        case 'earley':
+            return Lark(grammar_text, parser="earley", propagate_positions=True)
+        case _:
+            raise Exception(f"Invalid parser algorithm {algorithm}")
+
+
+
+def parse(text, algorithm='lalr'):
+    tree = get_parser(algorithm).parse(text)
+    return records_from_tree(tree)
 
 # import importlib
 # import parser
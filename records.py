@@ -0,0 +1,105 @@
+import json
+import hashlib
+import collections
+
+
+
+def content_id(*parts):
+    """
+    Stable id derived from the repr of `parts`.
+
+    Used for rule/fact/expr ids, so that re-transpiling an unchanged rule
+    yields byte-identical rows across runs and processes.
+    """
+    return hashlib.sha256(repr(parts).encode('utf-8')).hexdigest()[:10]
+
+
+
+class RecordBatch:
+    """
+    Append-only set of rows for the transpiler input tables.
+
+    Rows are stored as per-table column buffers, so building a program costs
+    O(total rows) no matter how many rules and expressions contribute to it.
+    Both front ends (parser.py and dsl.py) append into a batch, and
+    insert_records() reads rows straight out of it via items().
+    """
+
+    def __init__(self):
+        self.columns = {}
+        self.row_counts = {}
+
+    def append(self, table_name, row):
+        columns = self.columns.get(table_name)
+        if columns is None:
+            columns = self.columns[table_name] = {column_name: [] for column_name in row}
+            self.row_counts[table_name] = 0
+        if row.keys() != columns.keys():
+            raise Exception(f"Invalid row for {table_name}: {row}, expected columns {list(columns)}")
+        for column_name, value in row.items():
+            columns[column_name].append(value)
+        self.row_counts[table_name] += 1
+
+    def extend(self, other):
+        for table_name, rows in other.items():
+            for row in rows:
+                self.append(table_name, row)
+        return self
+
+    def set_column(self, column_name, value):
+        # add (or overwrite) a column with the same value in every row,
+        # e.g. pipeline_id, which is only known after the records were built
+        for table_name, columns in self.columns.items():
+            columns[column_name] = [value] * self.row_counts[table_name]
+        return self
+
+    def rows(self, table_name):
+        columns = self.columns[table_name]
+        column_names = list(columns)
+        for values in zip(*columns.values()):
+            yield dict(zip(column_names, values))
+
+    def keys(self):
+        return self.columns.keys()
+
+    def items(self):
+        for table_name in self.columns:
+            yield table_name, list(self.rows(table_name))
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def __contains__(self, table_name):
+        return table_name in self.columns
+
+    def __len__(self):
+        return sum(self.row_counts.values())
+
+    def __repr__(self):
+        return f'RecordBatch({self.row_counts})'
+
+
+
+def row_key(row):
+    return json.dumps(row, sort_keys=True)
+
+def record_delta(prev_records, records):
+    """
+    Per-table insert_delete updates that turn `prev_records` into `records`.
+
+    Input tables have no primary keys, so they are multisets: rows are
+    diffed by count, and each update retracts or adds a single copy.
+    """
+    prev_records = dict(prev_records.items())
+    records = dict(records.items())
+    updates = {}
+    for table_name in sorted({*prev_records.keys(), *records.keys()}):
+        prev_counts = collections.Counter(map(row_key, prev_records.get(table_name, [])))
+        counts = collections.Counter(map(row_key, records.get(table_name, [])))
+        table_updates = [
+            *[{'delete': json.loads(key)} for key in (prev_counts - counts).elements()],
+            *[{'insert': json.loads(key)} for key in (counts - prev_counts).elements()],
+        ]
+        if table_updates:
+            updates[table_name] = table_updates
+    return updates
@@ -0,0 +1,105 @@
+import json
+import time
+import uuid
+import contextlib
+import collections
+
+
+
+class SpanAttributes(dict):
+    """
+    Attributes of a span, with its duration in seconds once it ended.
+    """
+
+    duration = None
+
+
+
+class Tracer:
+    """
+    Timed spans of the transpile client stages, as JSON lines.
+
+    Every span is one line: its name, wall clock start, duration and
+    attributes (row counts, byte sizes, table or test file). The caller
+    fills in attributes through the dict span() yields, since most of them
+    are only known once the stage is done; its duration is set on it when
+    the span ends. Durations are also kept per span name for summary().
+    Without a path nothing is written.
+    """
+
+    def __init__(self, path=None, clock=time.perf_counter):
+        self.file = open(path, 'a') if path else None
+        self.clock = clock
+        self.run_id = uuid.uuid4().hex[:10]
+        self.durations = collections.defaultdict(list)
+
+    @contextlib.contextmanager
+    def span(self, name, **attributes):
+        attributes = SpanAttributes(attributes)
+        start_time = time.time()
+        started_at = self.clock()
+        status = 'ok'
+        try:
+            yield attributes
+        except BaseException:
+            status = 'error'
+            raise
+        finally:
+            duration = self.clock() - started_at
+            attributes.duration = duration
+            self.durations[name].append(duration)
+            if self.file:
+                self.file.write(json.dumps({
+                    'run_id': self.run_id,
+                    'name': name,
+                    'start_time': start_time,
+                    'duration_ms': duration * 1000,
+                    'status': status,
+                    'attributes': attributes,
+                }) + '\n')
+
+    def summary(self):
+        # per span name: count, total and percentiles, then a histogram
+        # of the durations in power of two millisecond buckets
+        lines = []
+        for name, durations in sorted(self.durations.items()):
+            durations = sorted(durations)
+            lines.append(
+                f"{name}: count={len(durations)} total={sum(durations)*1000:.1f}ms "
+                f"p50={percentile(durations, 0.5)*1000:.1f}ms "
+                f"p90={percentile(durations, 0.9)*1000:.1f}ms "
+                f"max={durations[-1]*1000:.1f}ms")
+            buckets = collections.Counter(duration_bucket(d) for d in durations)
+            width = max(buckets.values())
+            for bucket in sorted(buckets):
+                bar = '#' * max(1, buckets[bucket] * 40 // width)
+                lines.append(f"  <{bucket:>8g}ms {buckets[bucket]:>6} {bar}")
+        return lines
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+def percentile(sorted_values, q):
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+def duration_bucket(duration):
+    # upper bound of the power of two bucket holding `duration`, in ms
+    bucket = 0.125
+    while duration * 1000 >= bucket:
+        bucket *= 2
+    return bucket
+
+
+
+# spans of the current run, replaced by start() when tracing is enabled
+tracer = Tracer()
+
+def start(path):
+    global tracer
+    tracer = Tracer(path)
+    return tracer
+
+def span(name, **attributes):
+    return tracer.span(name, **attributes)
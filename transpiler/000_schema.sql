@@ -34,6 +34,11 @@ CREATE TABLE rule (
     table_name TEXT NOT NULL
 ) WITH ('materialized' = 'true');
 
+CREATE TABLE declared_output (
+    pipeline_id TEXT NOT NULL,
+    table_name TEXT NOT NULL
+) WITH ('materialized' = 'true');
+
 CREATE TABLE rule_param (
     pipeline_id TEXT NOT NULL,
     rule_id TEXT NOT NULL,
@@ -1,313 +1,342 @@
 /*
-table_dependency(pipeline_id:, table_name:, parent_table_name:) <-
+table_direct_dependency(pipeline_id:, table_name:, parent_table_name:, negated:) <-
     rule(pipeline_id:, table_name:, rule_id:)
-    body_fact(pipeline_id:, rule_id:, table_name: parent_table_name)
+    body_fact(pipeline_id:, rule_id:, table_name: parent_table_name, negated:)
     #all_records_inserted(pipeline_id:)
-table_dependency(pipeline_id:, table_name:, parent_table_name:) <-
-    table_dependency(pipeline_id:, table_name:, parent_table_name:)
-    table_dependency(pipeline_id:, table_name: parent_table_name, parent_table_name:)
 */
-DECLARE RECURSIVE VIEW table_dependency (pipeline_id TEXT, table_name TEXT, parent_table_name TEXT);
-CREATE MATERIALIZED VIEW table_dependency AS
+CREATE MATERIALIZED VIEW table_direct_dependency AS
     SELECT DISTINCT
         rule.pipeline_id,
         rule.table_name,
-        body_fact.table_name AS parent_table_name
+        body_fact.table_name AS parent_table_name,
+        body_fact.negated
     FROM rule
-    JOIN body_fact
-        ON rule.pipeline_id = body_fact.pipeline_id
-        AND rule.rule_id = body_fact.rule_id
     -- JOIN all_records_inserted
     --     ON rule.pipeline_id = all_records_inserted.pipeline_id
+    JOIN body_fact
+        ON rule.pipeline_id = body_fact.pipeline_id
+        AND rule.rule_id = body_fact.rule_id;
+
+/*
+# linear closure: every step extends a path by one direct dependency,
+# so it needs at most as many steps as the longest path without repeated
+# tables and holds at most tables^2 rows per program, cycles included
+table_dependency(pipeline_id:, table_name:, parent_table_name:) <-
+    table_direct_dependency(pipeline_id:, table_name:, parent_table_name:)
+table_dependency(pipeline_id:, table_name:, parent_table_name:) <-
+    table_dependency(pipeline_id:, table_name:, parent_table_name: middle_table_name)
+    table_direct_dependency(pipeline_id:, table_name: middle_table_name, parent_table_name:)
+*/
+DECLARE RECURSIVE VIEW table_dependency (pipeline_id TEXT, table_name TEXT, parent_table_name TEXT);
+CREATE MATERIALIZED VIEW table_dependency AS
+    SELECT DISTINCT
+        table_direct_dependency.pipeline_id,
+        table_direct_dependency.table_name,
+        table_direct_dependency.parent_table_name
+    FROM table_direct_dependency
+
+    UNION
+
+    SELECT DISTINCT
+        table_dependency.pipeline_id,
+        table_dependency.table_name,
+        table_direct_dependency.parent_table_name
+    FROM table_dependency
+    JOIN table_direct_dependency
+        ON table_dependency.pipeline_id = table_direct_dependency.pipeline_id
+        AND table_dependency.parent_table_name = table_direct_dependency.table_name;
+
+/*
+table_node(pipeline_id:, table_name:) <-
+    schema_table(pipeline_id:, table_name:)
+table_node(pipeline_id:, table_name:) <-
+    rule(pipeline_id:, table_name:)
+*/
+CREATE MATERIALIZED VIEW table_node AS
+    SELECT DISTINCT
+        schema_table.pipeline_id,
+        schema_table.table_name
+    FROM schema_table
+
+    UNION
+
+    SELECT DISTINCT
+        rule.pipeline_id,
+        rule.table_name
+    FROM rule;
+
+/*
+# tables that depend on each other, directly or not,
+# belong to the same strongly connected component
+table_same_component(pipeline_id:, table_name:, other_table_name: table_name) <-
+    table_node(pipeline_id:, table_name:)
+table_same_component(pipeline_id:, table_name:, other_table_name:) <-
+    table_dependency(pipeline_id:, table_name:, parent_table_name: other_table_name)
+    table_dependency(pipeline_id:, table_name: other_table_name, parent_table_name: table_name)
+*/
+CREATE MATERIALIZED VIEW table_same_component AS
+    SELECT DISTINCT
+        table_node.pipeline_id,
+        table_node.table_name,
+        table_node.table_name AS other_table_name
+    FROM table_node
 
     UNION
 
     SELECT DISTINCT
         t1.pipeline_id,
         t1.table_name,
-        t2.parent_table_name
+        t1.parent_table_name AS other_table_name
     FROM table_dependency AS t1
     JOIN table_dependency AS t2
-        ON t1.pipeline_id = t2.parent_table_name
-        AND t1.parent_table_name = t2.table_name;
+        ON t1.pipeline_id = t2.pipeline_id
+        AND t1.parent_table_name = t2.table_name
+        AND t1.table_name = t2.parent_table_name;
 
 /*
-table_without_dependencies(pipeline_id:, table_name:) <-
-    rule(pipeline_id:, table_name:, rule_id:)
-    not body_fact(pipeline_id:, rule_id:)
+# a component is named after its smallest table name
+table_component(pipeline_id:, table_name:, component: min<other_table_name>) <-
+    table_same_component(pipeline_id:, table_name:, other_table_name:)
 */
-CREATE MATERIALIZED VIEW table_without_dependencies AS
+CREATE MATERIALIZED VIEW table_component AS
     SELECT DISTINCT
-        rule.pipeline_id,
-        rule.table_name
-    FROM rule
-    WHERE NOT EXISTS (
-        SELECT 1
-        FROM body_fact
-        WHERE rule.pipeline_id = body_fact.pipeline_id
-        AND rule.rule_id = body_fact.rule_id
-    );
+        table_same_component.pipeline_id,
+        table_same_component.table_name,
+        MIN(table_same_component.other_table_name) AS component
+    FROM table_same_component
+    GROUP BY table_same_component.pipeline_id, table_same_component.table_name;
 
 /*
+# tables that depend on themselves, alone or with other tables of their
+# component, are generated as recursive views
+recursive_table(pipeline_id:, table_name:) <-
+    table_dependency(pipeline_id:, table_name:, parent_table_name: table_name)
+*/
+CREATE MATERIALIZED VIEW recursive_table AS
+    SELECT DISTINCT
+        table_dependency.pipeline_id,
+        table_dependency.table_name
+    FROM table_dependency
+    WHERE table_dependency.table_name = table_dependency.parent_table_name;
+
+/*
+# the order of a table that depends on anything is one more than the number
+# of other components it depends on, 1 for a table that only depends on
+# itself. It is greater than the order of each of them, is the same for all
+# tables of a component and needs no recursion, so cycles cannot loop.
+# Tables of order 0 depend on nothing and are not generated
 table_output_order(pipeline_id:, table_name:, order: 0) <-
-    schema_table(pipeline_id:, table_name:)
-table_output_order(pipeline_id:, table_name:, order: 0) <-
-    table_without_dependencies(pipeline_id:, table_name:)
-table_output_order(pipeline_id:, table_name:, order: max<order>+1) <-
+    table_component(pipeline_id:, table_name:)
+table_output_order(pipeline_id:, table_name:, order: 1) <-
+    recursive_table(pipeline_id:, table_name:)
+table_output_order(pipeline_id:, table_name:, order: count<distinct parent_component> + 1) <-
+    table_component(pipeline_id:, table_name:, component:)
     table_dependency(pipeline_id:, table_name:, parent_table_name:)
-    table_output_order(pipeline_id:, table_name: parent_table_name, order:)
-    table_name != parent_table_name
+    table_component(pipeline_id:, table_name: parent_table_name, component: parent_component)
+    parent_component != component
 */
-DECLARE RECURSIVE VIEW table_output_order (pipeline_id TEXT, table_name TEXT, "order" INTEGER);
 CREATE MATERIALIZED VIEW table_output_order AS
     SELECT DISTINCT
-        pipeline_id,
-        table_name,
+        table_component.pipeline_id,
+        table_component.table_name,
         0 AS "order"
-    FROM schema_table
+    FROM table_component
 
     UNION
 
     SELECT DISTINCT
-        table_without_dependencies.pipeline_id,
-        table_without_dependencies.table_name,
-        0 AS "order"
-    FROM table_without_dependencies
+        recursive_table.pipeline_id,
+        recursive_table.table_name,
+        1 AS "order"
+    FROM recursive_table
 
     UNION
 
     SELECT DISTINCT
-        table_dependency.pipeline_id,
-        table_dependency.table_name,
-        MAX(table_output_order."order")+1 AS "order"
-    FROM table_output_order
+        table_component.pipeline_id,
+        table_component.table_name,
+        CAST(COUNT(DISTINCT parent_component.component) + 1 AS INTEGER) AS "order"
+    FROM table_component
     JOIN table_dependency
-        ON table_dependency.pipeline_id = table_output_order.pipeline_id
-        AND table_dependency.parent_table_name = table_output_order.table_name
-    WHERE table_dependency.parent_table_name != table_dependency.table_name
-    GROUP BY table_dependency.pipeline_id, table_dependency.table_name;
+        ON table_component.pipeline_id = table_dependency.pipeline_id
+        AND table_component.table_name = table_dependency.table_name
+    JOIN table_component AS parent_component
+        ON table_dependency.pipeline_id = parent_component.pipeline_id
+        AND table_dependency.parent_table_name = parent_component.table_name
+    WHERE parent_component.component != table_component.component
+    GROUP BY table_component.pipeline_id, table_component.table_name;
 
 /*
-first_table(pipeline_id:, table_name: min<table_name>, order:) <-
-    table_output_order(pipeline_id:, table_name:, order:)
-    #all_records_inserted(pipeline_id:)
+# column types of generated tables, as far as they can be told from the
+# schema, literals and columns of other tables bound to the same variable
+table_column_type(pipeline_id:, table_name:, column_name:, data_type:) <-
+    schema_table_column(pipeline_id:, table_name:, column_name:, data_type:)
+table_column_type(pipeline_id:, table_name:, column_name:, data_type: "BIGINT") <-
+    rule(pipeline_id:, table_name:, rule_id:)
+    rule_param(pipeline_id:, rule_id:, key: column_name, expr_type: "int_expr")
+table_column_type(pipeline_id:, table_name:, column_name:, data_type: "TEXT") <-
+    rule(pipeline_id:, table_name:, rule_id:)
+    rule_param(pipeline_id:, rule_id:, key: column_name, expr_type: "str_expr")
+table_column_type(pipeline_id:, table_name:, column_name:, data_type:) <-
+    rule(pipeline_id:, table_name:, rule_id:)
+    rule_param(pipeline_id:, rule_id:, key: column_name, expr_id: param_expr_id, expr_type: "var_expr")
+    var_expr(pipeline_id:, rule_id:, expr_id: param_expr_id, var_name:)
+    fact_arg(pipeline_id:, rule_id:, fact_id:, key: fact_key, expr_id: arg_expr_id, expr_type: "var_expr")
+    var_expr(pipeline_id:, rule_id:, expr_id: arg_expr_id, var_name:)
+    body_fact(pipeline_id:, rule_id:, fact_id:, table_name: fact_table_name, negated: false)
+    table_column_type(pipeline_id:, table_name: fact_table_name, column_name: fact_key, data_type:)
 */
-CREATE MATERIALIZED VIEW first_table AS
+DECLARE RECURSIVE VIEW table_column_type (pipeline_id TEXT, table_name TEXT, column_name TEXT, data_type TEXT);
+CREATE MATERIALIZED VIEW table_column_type AS
     SELECT DISTINCT
-        table_output_order.pipeline_id,
-        MIN(table_output_order.table_name) AS table_name,
-        table_output_order."order"
-    FROM table_output_order
-    -- JOIN all_records_inserted
-    --     ON table_output_order.pipeline_id = all_records_inserted.pipeline_id
-    GROUP BY table_output_order.pipeline_id, table_output_order."order";
+        schema_table_column.pipeline_id,
+        schema_table_column.table_name,
+        schema_table_column.column_name,
+        schema_table_column.data_type
+    FROM schema_table_column
+
+    UNION
 
-/*
-only_one_table_in_group(pipeline_id:, order:) <-
-    table_output_order(pipeline_id:, table_name:, order:)
-    count<> = 1
-*/
-CREATE MATERIALIZED VIEW only_one_table_in_group AS
     SELECT DISTINCT
-        table_output_order.pipeline_id,
-        table_output_order."order"
-    FROM table_output_order
-    GROUP BY table_output_order.pipeline_id, table_output_order."order"
-    HAVING COUNT(DISTINCT table_output_order.table_name) = 1;
+        rule.pipeline_id,
+        rule.table_name,
+        rule_param.key AS column_name,
+        CASE rule_param.expr_type WHEN 'int_expr' THEN 'BIGINT' ELSE 'TEXT' END AS data_type
+    FROM rule
+    JOIN rule_param
+        ON rule.pipeline_id = rule_param.pipeline_id
+        AND rule.rule_id = rule_param.rule_id
+    WHERE rule_param.expr_type IN ('int_expr', 'str_expr')
 
-/*
-next_table_within_same_order(pipeline_id:, prev_table_name:, next_table_name:) <-
-    table_output_order(pipeline_id:, table_name: prev_table_name, order:)
-    table_output_order(pipeline_id:, table_name:, order:)
-    next_table_name := min<table_name>
-    prev_table_name < table_name
-*/
-CREATE MATERIALIZED VIEW next_table_within_same_order AS
-    SELECT DISTINCT
-        prev.pipeline_id,
-        prev.table_name AS prev_table_name,
-        MIN("next".table_name) AS next_table_name
-    FROM table_output_order AS prev
-    JOIN table_output_order AS "next"
-        ON prev.pipeline_id = "next".pipeline_id
-        AND prev."order" = "next"."order"
-    WHERE prev.table_name < "next".table_name
-    GROUP BY prev.pipeline_id, prev.table_name;
+    UNION
+
+    SELECT DISTINCT
+        rule.pipeline_id,
+        rule.table_name,
+        rule_param.key AS column_name,
+        table_column_type.data_type
+    FROM rule
+    JOIN rule_param
+        ON rule.pipeline_id = rule_param.pipeline_id
+        AND rule.rule_id = rule_param.rule_id
+    JOIN var_expr AS param_var
+        ON rule_param.pipeline_id = param_var.pipeline_id
+        AND rule_param.rule_id = param_var.rule_id
+        AND rule_param.expr_id = param_var.expr_id
+    JOIN fact_arg
+        ON rule_param.pipeline_id = fact_arg.pipeline_id
+        AND rule_param.rule_id = fact_arg.rule_id
+    JOIN var_expr AS arg_var
+        ON fact_arg.pipeline_id = arg_var.pipeline_id
+        AND fact_arg.rule_id = arg_var.rule_id
+        AND fact_arg.expr_id = arg_var.expr_id
+        AND param_var.var_name = arg_var.var_name
+    JOIN body_fact
+        ON fact_arg.pipeline_id = body_fact.pipeline_id
+        AND fact_arg.rule_id = body_fact.rule_id
+        AND fact_arg.fact_id = body_fact.fact_id
+    JOIN table_column_type
+        ON body_fact.pipeline_id = table_column_type.pipeline_id
+        AND body_fact.table_name = table_column_type.table_name
+        AND fact_arg.key = table_column_type.column_name
+    WHERE rule_param.expr_type = 'var_expr'
+    AND fact_arg.expr_type = 'var_expr'
+    AND NOT body_fact.negated;
 
 /*
-next_table(pipeline_id:, prev_table_name:, next_table_name:) <-
-    first_table(pipeline_id:, table_name: prev_table_name, order: 0)
-    next_table_within_same_order(pipeline_id:, prev_table_name:, next_table_name:)
-next_table(pipeline_id:, prev_table_name:, next_table_name:) <-
-    first_table(pipeline_id:, table_name: prev_table_name, order: 0)
-    first_table(pipeline_id:, table_name: next_table_name, order: 1)
-    not next_table_within_same_order(pipeline_id:, prev_table_name:)
-next_table(pipeline_id:, prev_table_name:, next_table_name:) <-
-    next_table(pipeline_id:, next_table_name: prev_table_name)
-    next_table_within_same_order(pipeline_id:, prev_table_name:, next_table_name:)
-next_table(pipeline_id:, prev_table_name:, next_table_name:) <-
-    next_table(pipeline_id:, next_table_name: prev_table_name)
-    table_output_order(pipeline_id:, table_name: prev_table_name, order:)
-    first_table(pipeline_id:, table_name: next_table_name, order: order+1)
-    not next_table_within_same_order(pipeline_id:, prev_table_name:)
+# tables the generated pipeline is there for: declared outputs
+# and the tables the schema asks to materialize
+output_root(pipeline_id:, table_name:) <-
+    declared_output(pipeline_id:, table_name:)
+output_root(pipeline_id:, table_name:) <-
+    schema_table(pipeline_id:, table_name:, materialized: true)
 */
-DECLARE RECURSIVE VIEW next_table (pipeline_id TEXT, prev_table_name TEXT, next_table_name TEXT);
-CREATE MATERIALIZED VIEW next_table AS
-    SELECT DISTINCT
-        first_table.pipeline_id,
-        next_table_within_same_order.prev_table_name,
-        next_table_within_same_order.next_table_name
-    FROM first_table
-    JOIN next_table_within_same_order
-        ON first_table.pipeline_id = next_table_within_same_order.pipeline_id
-        AND first_table.table_name = next_table_within_same_order.prev_table_name
-    WHERE first_table."order" = 0
-    
+CREATE MATERIALIZED VIEW output_root AS
+    SELECT DISTINCT
+        declared_output.pipeline_id,
+        declared_output.table_name
+    FROM declared_output
+
     UNION
 
     SELECT DISTINCT
-        prev.pipeline_id,
-        prev.table_name AS prev_table_name,
-        "next".table_name AS next_table_name
-    FROM first_table AS prev
-    JOIN first_table AS "next"
-        ON prev.pipeline_id = "next".pipeline_id
-    WHERE prev."order" = 0 AND "next"."order" = 1
-    AND NOT EXISTS (
-        SELECT 1
-        FROM next_table_within_same_order
-        WHERE prev.pipeline_id = next_table_within_same_order.pipeline_id
-        AND prev.table_name = next_table_within_same_order.prev_table_name
-    )
+        schema_table.pipeline_id,
+        schema_table.table_name
+    FROM schema_table
+    WHERE schema_table."materialized";
+
+/*
+# table_dependency is already the full closure,
+# so reachability from the roots needs no recursion
+live_table(pipeline_id:, table_name:) <-
+    output_root(pipeline_id:, table_name:)
+live_table(pipeline_id:, table_name: parent_table_name) <-
+    output_root(pipeline_id:, table_name:)
+    table_dependency(pipeline_id:, table_name:, parent_table_name:)
+*/
+CREATE MATERIALIZED VIEW live_table AS
+    SELECT DISTINCT
+        output_root.pipeline_id,
+        output_root.table_name
+    FROM output_root
 
     UNION
 
     SELECT DISTINCT
-        next_table.pipeline_id,
-        next_table_within_same_order.prev_table_name,
-        next_table_within_same_order.next_table_name
-    FROM next_table
-    JOIN next_table_within_same_order
-        ON next_table.pipeline_id = next_table_within_same_order.pipeline_id
-        AND next_table.next_table_name = next_table_within_same_order.prev_table_name
-    
-    UNION
+        table_dependency.pipeline_id,
+        table_dependency.parent_table_name AS table_name
+    FROM output_root
+    JOIN table_dependency
+        ON output_root.pipeline_id = table_dependency.pipeline_id
+        AND output_root.table_name = table_dependency.table_name;
 
+/*
+# tables no root depends on are not generated. A program without
+# any root keeps all of its tables
+pruned_table(pipeline_id:, table_name:) <-
+    rule(pipeline_id:, table_name:)
+    output_root(pipeline_id:)
+    not live_table(pipeline_id:, table_name:)
+*/
+CREATE MATERIALIZED VIEW pruned_table AS
     SELECT DISTINCT
-        next_table.pipeline_id,
-        next_table.next_table_name AS prev_table_name,
-        first_table.table_name AS next_table_name
-    FROM next_table
-    JOIN table_output_order
-        ON next_table.pipeline_id = table_output_order.pipeline_id
-        AND next_table.next_table_name = table_output_order.table_name
-    JOIN first_table
-        ON next_table.pipeline_id = first_table.pipeline_id
-        AND table_output_order."order"+1 = first_table."order"
-    WHERE NOT EXISTS (
+        rule.pipeline_id,
+        rule.table_name
+    FROM rule
+    WHERE EXISTS (
+        SELECT 1
+        FROM output_root
+        WHERE output_root.pipeline_id = rule.pipeline_id
+    )
+    AND NOT EXISTS (
         SELECT 1
-        FROM next_table_within_same_order
-        WHERE next_table.pipeline_id = next_table_within_same_order.pipeline_id
-        AND next_table.next_table_name = next_table_within_same_order.prev_table_name
+        FROM live_table
+        WHERE live_table.pipeline_id = rule.pipeline_id
+        AND live_table.table_name = rule.table_name
     );
 
--- /*
--- next_table(pipeline_id:, prev_table_name:, next_table_name:, order:) <-
---     first_table(pipeline_id:, table_name: prev_table_name, order:)
---     not only_one_table_in_group(pipeline_id:, order:)
---     table_output_order(pipeline_id:, table_name:, order:)
---     next_table_name := min<table_name>
---     prev_table_name < table_name
--- next_table(pipeline_id:, prev_table_name:, next_table_name:, order:) <-
---     first_table(pipeline_id:, table_name: prev_table_name, order: prev_order)
---     only_one_table_in_group(pipeline_id:, order: prev_order)
---     order := prev_order+1
---     table_output_order(pipeline_id:, table_name:, order:)
---     next_table_name := min<table_name>
--- next_table(pipeline_id:, prev_table_name:, next_table_name:, order:) <-
---     next_table(pipeline_id:, next_table_name: prev_table_name, order:)
---     not only_one_table_in_group(pipeline_id:, order:)
---     table_output_order(pipeline_id:, table_name:, order:)
---     next_table_name := min<table_name>
---     prev_table_name < table_name
--- next_table(pipeline_id:, prev_table_name:, next_table_name:, order:) <-
---     next_table(pipeline_id:, next_table_name: prev_table_name, order: prev_order)
---     only_one_table_in_group(pipeline_id:, order: prev_order)
---     order := prev_order+1
---     table_output_order(pipeline_id:, table_name:, order:)
---     next_table_name := min<table_name>
--- */
--- DECLARE RECURSIVE VIEW next_table (pipeline_id TEXT, prev_table_name TEXT, next_table_name TEXT, "order" INTEGER);
--- CREATE MATERIALIZED VIEW next_table AS
---     SELECT DISTINCT
---         first_table.pipeline_id,
---         first_table.table_name AS prev_table_name,
---         MIN(table_output_order.table_name) AS next_table_name,
---         first_table."order"
---     FROM first_table
---     JOIN table_output_order
---         ON first_table.pipeline_id = table_output_order.pipeline_id
---         AND first_table."order" = table_output_order."order"
---     WHERE first_table.table_name < table_output_order.table_name
---     AND NOT EXISTS (
---         SELECT 1
---         FROM only_one_table_in_group
---         WHERE first_table.pipeline_id = only_one_table_in_group.pipeline_id
---         AND first_table."order" = only_one_table_in_group."order"
---     )
---     GROUP BY first_table.pipeline_id, first_table.table_name, first_table."order"
-
---     UNION
-
---     SELECT DISTINCT
---         first_table.pipeline_id,
---         first_table.table_name AS prev_table_name,
---         MIN(table_output_order.table_name) AS next_table_name,
---         first_table."order"
---     FROM first_table
---     JOIN only_one_table_in_group
---         ON first_table.pipeline_id = only_one_table_in_group.pipeline_id
---         AND first_table."order" = only_one_table_in_group."order"
---     JOIN table_output_order
---         ON first_table.pipeline_id = table_output_order.pipeline_id
---         AND first_table."order"+1 = table_output_order."order"
---     GROUP BY first_table.pipeline_id, first_table.table_name, first_table."order"
-    
---     UNION
-    
---     SELECT DISTINCT
---         next_table.pipeline_id,
---         next_table.next_table_name AS prev_table_name,
---         MIN(table_output_order.table_name) AS next_table_name,
---         next_table."order"
---     FROM next_table
---     JOIN table_output_order
---         ON next_table.pipeline_id = table_output_order.pipeline_id
---         AND next_table."order" = table_output_order."order"
---     WHERE next_table.next_table_name < table_output_order.table_name
---     AND NOT EXISTS (
---         SELECT 1
---         FROM only_one_table_in_group
---         WHERE next_table.pipeline_id = only_one_table_in_group.pipeline_id
---         AND next_table."order" = only_one_table_in_group."order"
---     )
---     GROUP BY next_table.pipeline_id, next_table.next_table_name, next_table."order"
-    
---     UNION
-    
---     SELECT DISTINCT
---         next_table.pipeline_id,
---         next_table.next_table_name AS prev_table_name,
---         MIN(table_output_order.table_name) AS next_table_name,
---         next_table."order"
---     FROM next_table
---     JOIN only_one_table_in_group
---         ON next_table.pipeline_id = only_one_table_in_group.pipeline_id
---         AND next_table."order" = only_one_table_in_group."order"
---     JOIN table_output_order
---         ON next_table.pipeline_id = table_output_order.pipeline_id
---         AND next_table."order"+1 = table_output_order."order"
---     GROUP BY next_table.pipeline_id, next_table.next_table_name, next_table."order";
+/*
+# (order, table_name) is the output ordering key of a table:
+# tables come out stratum by stratum, by name within a stratum
+table_output_position(pipeline_id:, table_name:, order: max<order>) <-
+    table_output_order(pipeline_id:, table_name:, order:)
+    not pruned_table(pipeline_id:, table_name:)
+    max<order> > 0
+*/
+CREATE MATERIALIZED VIEW table_output_position AS
+    SELECT DISTINCT
+        table_output_order.pipeline_id,
+        table_output_order.table_name,
+        MAX(table_output_order."order") AS "order"
+    FROM table_output_order
+    WHERE NOT EXISTS (
+        SELECT 1
+        FROM pruned_table
+        WHERE pruned_table.pipeline_id = table_output_order.pipeline_id
+        AND pruned_table.table_name = table_output_order.table_name
+    )
+    GROUP BY table_output_order.pipeline_id, table_output_order.table_name
+    HAVING MAX(table_output_order."order") > 0;
 
 /*
 fact_alias(pipeline_id:, rule_id:, table_name:, alias:, negated:, fact_index:) <-
@@ -385,46 +414,6 @@ CREATE MATERIALIZED VIEW table_first_rule AS
     --     ON rule.pipeline_id = all_records_inserted.pipeline_id
     GROUP BY rule.pipeline_id, rule.table_name;
 
-/*
-table_next_rule(pipeline_id:, table_name:, prev_rule_id:, next_rule_id:) <-
-    table_first_rule(pipeline_id:, table_name:, rule_id: prev_rule_id)
-    rule(pipeline_id:, table_name:, rule_id:)
-    next_rule_id := min<rule_id>
-    prev_rule_id < rule_id
-table_next_rule(pipeline_id:, table_name:, prev_rule_id:, next_rule_id:) <-
-    table_next_rule(pipeline_id:, table_name:, next_rule_id: prev_rule_id)
-    rule(pipeline_id:, table_name:, rule_id:)
-    next_rule_id := min<rule_id>
-    prev_rule_id < rule_id
-*/
-DECLARE RECURSIVE VIEW table_next_rule (pipeline_id TEXT, table_name TEXT, prev_rule_id TEXT, next_rule_id TEXT);
-CREATE MATERIALIZED VIEW table_next_rule AS
-    SELECT DISTINCT
-        table_first_rule.pipeline_id,
-        table_first_rule.table_name,
-        table_first_rule.rule_id AS prev_rule_id,
-        MIN(rule.rule_id) AS next_rule_id
-    FROM table_first_rule
-    JOIN rule
-        ON rule.pipeline_id = table_first_rule.pipeline_id
-        AND rule.table_name = table_first_rule.table_name
-    WHERE table_first_rule.rule_id < rule.rule_id
-    GROUP BY table_first_rule.pipeline_id, table_first_rule.table_name, table_first_rule.rule_id
-
-    UNION
-
-    SELECT DISTINCT
-        table_next_rule.pipeline_id,
-        table_next_rule.table_name,
-        table_next_rule.next_rule_id AS prev_rule_id,
-        MIN(rule.rule_id) AS next_rule_id
-    FROM table_next_rule
-    JOIN rule
-        ON rule.pipeline_id = table_next_rule.pipeline_id
-        AND rule.table_name = table_next_rule.table_name
-    WHERE table_next_rule.next_rule_id < rule.rule_id
-    GROUP BY table_next_rule.pipeline_id, table_next_rule.table_name, table_next_rule.next_rule_id;
-
 /*
 array_expr_length(pipeline_id:, rule_id:, expr_id:, length: count<>) <-
     array_expr(pipeline_id:, rule_id:, expr_id:, array_id:)
@@ -739,7 +739,7 @@ select_sql(pipeline_id:, rule_id:, sql_lines:) <-
     substituted_expr(pipeline_id:, rule_id:, expr_id:, expr_type:, sql: expr_sql)
     grouped_by_sql(pipeline_id:, rule_id:, sql: group_by_sql)
     join_sql(pipeline_id:, rule_id:, sql_lines: join_sql_lines)
-    columns_sql := join(array<`{{expr_sql}} AS "{{key}}"`>, ", ")
+    columns_sql := join(array<`{{expr_sql}} AS "{{key}}"`, order_by: [key]>, ", ")
     sql_lines := [
         `SELECT DISTINCT {{columns_sql}}`,
         *join_sql_lines,
@@ -751,7 +751,7 @@ CREATE MATERIALIZED VIEW select_sql AS
         rule_param.pipeline_id,
         rule_param.rule_id,
         ARRAY_CONCAT(
-            ARRAY['SELECT DISTINCT ' || ARRAY_TO_STRING(ARRAY_AGG(substituted_expr.sql || ' AS "' || rule_param.key || '"'), ', ')],
+            ARRAY['SELECT DISTINCT ' || ARRAY_TO_STRING(ARRAY_AGG(substituted_expr.sql || ' AS "' || rule_param.key || '"' ORDER BY rule_param.key), ', ')],
             join_sql.sql_lines,
             ARRAY[grouped_by_sql.sql]
         ) AS sql_lines
@@ -771,164 +771,339 @@ CREATE MATERIALIZED VIEW select_sql AS
     GROUP BY rule_param.pipeline_id, rule_param.rule_id, join_sql.sql_lines, grouped_by_sql.sql;
 
 /*
-table_view_sql(pipeline_id:, table_name:, rule_id:, sql_lines:) <-
-    table_first_rule(pipeline_id:, table_name:, rule_id:)
-    select_sql(pipeline_id:, rule_id:, sql_lines: rule_sql_lines)
-    sql_lines := [
-        `CREATE MATERIALIZED VIEW "{{table_name}}" AS`,
-        *rule_sql_lines,
-    ]
-table_view_sql(pipeline_id:, table_name:, rule_id:, sql_lines:) <-
-    table_view_sql(pipeline_id:, table_name:, rule_id: prev_rule_id, sql_lines: prev_sql_lines)
-    table_next_rule(pipeline_id:, table_name:, prev_rule_id:, next_rule_id:)
-    select_sql(pipeline_id:, rule_id: next_rule_id, sql_lines: next_sql_lines)
-    table_next_rule(pipeline_id:, table_name:, prev_rule_id: next_rule_id)
-    sql_lines := [*prev_sql_lines, "UNION", *next_sql_lines]
-table_view_sql(pipeline_id:, table_name:, rule_id:, sql_lines:) <-
-    table_view_sql(pipeline_id:, table_name:, rule_id: prev_rule_id, sql_lines: prev_sql_lines)
-    table_next_rule(pipeline_id:, table_name:, prev_rule_id:, next_rule_id:)
-    select_sql(pipeline_id:, rule_id: next_rule_id, sql_lines: next_sql_lines)
-    not table_next_rule(pipeline_id:, table_name:, prev_rule_id: next_rule_id)
-    sql_lines := [*prev_sql_lines, "UNION", *next_sql_lines, ";"]
-*/
-DECLARE RECURSIVE VIEW table_view_sql (pipeline_id TEXT, table_name TEXT, rule_id TEXT, sql_lines TEXT ARRAY);
-CREATE MATERIALIZED VIEW table_view_sql AS
-    SELECT DISTINCT
-        table_first_rule.pipeline_id,
-        table_first_rule.table_name,
-        table_first_rule.rule_id,
-        ARRAY_CONCAT(
-            ARRAY['CREATE MATERIALIZED VIEW "' || table_first_rule.table_name || '" AS'],
-            select_sql.sql_lines
-        ) AS sql_lines
-    FROM table_first_rule
-    JOIN select_sql
-        ON table_first_rule.pipeline_id = select_sql.pipeline_id
-        AND table_first_rule.rule_id = select_sql.rule_id
-    
+incomplete_table_view(pipeline_id:, table_name:) <-
+    rule(pipeline_id:, table_name:, rule_id:)
+    not select_sql(pipeline_id:, rule_id:)
+incomplete_table_view(pipeline_id:, table_name:) <-
+    rule(pipeline_id:, table_name:, rule_id:)
+    select_sql(pipeline_id:, rule_id:)
+    count<> > 1
+*/
+CREATE MATERIALIZED VIEW incomplete_table_view AS
+    SELECT DISTINCT
+        rule.pipeline_id,
+        rule.table_name
+    FROM rule
+    WHERE NOT EXISTS (
+        SELECT 1
+        FROM select_sql
+        WHERE select_sql.pipeline_id = rule.pipeline_id
+        AND select_sql.rule_id = rule.rule_id
+    )
+
     UNION
 
     SELECT DISTINCT
-        tn.pipeline_id,
-        tn.table_name,
-        tn.next_rule_id,
-        ARRAY_CONCAT(
-            table_view_sql.sql_lines,
-            ARRAY['UNION'],
-            select_sql.sql_lines
-        ) AS sql_lines
-    FROM table_view_sql
-    JOIN table_next_rule AS tn
-        ON tn.pipeline_id = table_view_sql.pipeline_id
-        AND tn.table_name = table_view_sql.table_name
-        AND tn.prev_rule_id = table_view_sql.rule_id
+        rule.pipeline_id,
+        rule.table_name
+    FROM rule
     JOIN select_sql
-        ON tn.pipeline_id = select_sql.pipeline_id
-        AND tn.next_rule_id = select_sql.rule_id
-    JOIN table_next_rule AS tnn
-        ON tn.pipeline_id = tnn.pipeline_id
-        AND tn.table_name = tnn.table_name
-        AND tn.next_rule_id = tnn.prev_rule_id
+        ON rule.pipeline_id = select_sql.pipeline_id
+        AND rule.rule_id = select_sql.rule_id
+    GROUP BY rule.pipeline_id, rule.table_name, rule.rule_id
+    HAVING COUNT(*) > 1;
+
+/*
+# rules of pruned tables are not assembled into views
+rule_output_line(pipeline_id:, table_name:, rule_id:, index:, line:) <-
+    rule(pipeline_id:, table_name:, rule_id:)
+    not pruned_table(pipeline_id:, table_name:)
+    select_sql(pipeline_id:, rule_id:, sql_lines:)
+    (line, index) <- unnest(sql_lines)
+rule_output_line(pipeline_id:, table_name:, rule_id:, index: 0, line: "UNION") <-
+    rule(pipeline_id:, table_name:, rule_id:)
+    not pruned_table(pipeline_id:, table_name:)
+    table_first_rule(pipeline_id:, table_name:, rule_id: first_rule_id)
+    first_rule_id < rule_id
+*/
+CREATE MATERIALIZED VIEW rule_output_line AS
+    SELECT DISTINCT
+        rule.pipeline_id,
+        rule.table_name,
+        rule.rule_id,
+        t."index",
+        t.line
+    FROM rule
+    JOIN select_sql
+        ON rule.pipeline_id = select_sql.pipeline_id
+        AND rule.rule_id = select_sql.rule_id
+    CROSS JOIN UNNEST(select_sql.sql_lines) WITH ORDINALITY AS t (line, "index")
+    WHERE NOT EXISTS (
+        SELECT 1
+        FROM pruned_table
+        WHERE pruned_table.pipeline_id = rule.pipeline_id
+        AND pruned_table.table_name = rule.table_name
+    )
 
     UNION
 
     SELECT DISTINCT
-        tn.pipeline_id,
-        tn.table_name,
-        tn.next_rule_id,
+        rule.pipeline_id,
+        rule.table_name,
+        rule.rule_id,
+        0 AS "index",
+        'UNION' AS line
+    FROM rule
+    JOIN table_first_rule
+        ON rule.pipeline_id = table_first_rule.pipeline_id
+        AND rule.table_name = table_first_rule.table_name
+    WHERE table_first_rule.rule_id < rule.rule_id
+    AND NOT EXISTS (
+        SELECT 1
+        FROM pruned_table
+        WHERE pruned_table.pipeline_id = rule.pipeline_id
+        AND pruned_table.table_name = rule.table_name
+    );
+
+/*
+# rules of a table are written in rule_id order, all at once,
+# instead of extending the view rule by rule
+view_full_sql(pipeline_id:, table_name:, sql_lines:) <-
+    rule_output_line(pipeline_id:, table_name:, rule_id:, index:, line:)
+    not incomplete_table_view(pipeline_id:, table_name:)
+    sql_lines := [
+        `CREATE MATERIALIZED VIEW "{{table_name}}" AS`,
+        *array<line, order_by: [rule_id, index]>,
+        ";",
+    ]
+*/
+CREATE MATERIALIZED VIEW view_full_sql AS
+    SELECT DISTINCT
+        rule_output_line.pipeline_id,
+        rule_output_line.table_name,
         ARRAY_CONCAT(
-            table_view_sql.sql_lines,
-            ARRAY['UNION'],
-            select_sql.sql_lines,
+            ARRAY['CREATE MATERIALIZED VIEW "' || rule_output_line.table_name || '" AS'],
+            ARRAY_AGG(rule_output_line.line ORDER BY rule_output_line.rule_id, rule_output_line."index"),
             ARRAY[';']
         ) AS sql_lines
-    FROM table_view_sql
-    JOIN table_next_rule AS tn
-        ON tn.pipeline_id = table_view_sql.pipeline_id
-        AND tn.table_name = table_view_sql.table_name
-        AND tn.prev_rule_id = table_view_sql.rule_id
-    JOIN select_sql
-        ON tn.pipeline_id = select_sql.pipeline_id
-        AND tn.next_rule_id = select_sql.rule_id
+    FROM rule_output_line
     WHERE NOT EXISTS (
         SELECT 1
-        FROM table_next_rule AS tnn
-        WHERE tn.pipeline_id = tnn.pipeline_id
-        AND tn.table_name = tnn.table_name
-        AND tn.next_rule_id = tnn.prev_rule_id
+        FROM incomplete_table_view
+        WHERE incomplete_table_view.pipeline_id = rule_output_line.pipeline_id
+        AND incomplete_table_view.table_name = rule_output_line.table_name
+    )
+    GROUP BY rule_output_line.pipeline_id, rule_output_line.table_name;
+
+/*
+# pruned tables are not generated, so they need no declaration
+recursive_view_column(pipeline_id:, table_name:, column_name:) <-
+    recursive_table(pipeline_id:, table_name:)
+    not pruned_table(pipeline_id:, table_name:)
+    rule(pipeline_id:, table_name:, rule_id:)
+    rule_param(pipeline_id:, rule_id:, key: column_name)
+*/
+CREATE MATERIALIZED VIEW recursive_view_column AS
+    SELECT DISTINCT
+        recursive_table.pipeline_id,
+        recursive_table.table_name,
+        rule_param.key AS column_name
+    FROM recursive_table
+    JOIN rule
+        ON recursive_table.pipeline_id = rule.pipeline_id
+        AND recursive_table.table_name = rule.table_name
+    JOIN rule_param
+        ON rule.pipeline_id = rule_param.pipeline_id
+        AND rule.rule_id = rule_param.rule_id
+    WHERE NOT EXISTS (
+        SELECT 1
+        FROM pruned_table
+        WHERE pruned_table.pipeline_id = recursive_table.pipeline_id
+        AND pruned_table.table_name = recursive_table.table_name
     );
 
 /*
-view_full_sql(pipeline_id:, table_name:, sql_lines:) <-
-    table_view_sql(pipeline_id:, table_name:, rule_id:, sql_lines:)
-    not table_next_rule(pipeline_id:, table_name:, prev_rule_id: rule_id)
+# a column is unresolved without a type, or with more than one
+unresolved_recursive_view_column(pipeline_id:, table_name:, column_name:) <-
+    recursive_view_column(pipeline_id:, table_name:, column_name:)
+    not table_column_type(pipeline_id:, table_name:, column_name:)
+unresolved_recursive_view_column(pipeline_id:, table_name:, column_name:) <-
+    recursive_view_column(pipeline_id:, table_name:, column_name:)
+    table_column_type(pipeline_id:, table_name:, column_name:, data_type:)
+    count<distinct data_type> > 1
 */
-CREATE MATERIALIZED VIEW view_full_sql AS
+CREATE MATERIALIZED VIEW unresolved_recursive_view_column AS
+    SELECT DISTINCT
+        recursive_view_column.pipeline_id,
+        recursive_view_column.table_name,
+        recursive_view_column.column_name
+    FROM recursive_view_column
+    WHERE NOT EXISTS (
+        SELECT 1
+        FROM table_column_type
+        WHERE table_column_type.pipeline_id = recursive_view_column.pipeline_id
+        AND table_column_type.table_name = recursive_view_column.table_name
+        AND table_column_type.column_name = recursive_view_column.column_name
+    )
+
+    UNION
+
+    SELECT DISTINCT
+        recursive_view_column.pipeline_id,
+        recursive_view_column.table_name,
+        recursive_view_column.column_name
+    FROM recursive_view_column
+    JOIN table_column_type
+        ON recursive_view_column.pipeline_id = table_column_type.pipeline_id
+        AND recursive_view_column.table_name = table_column_type.table_name
+        AND recursive_view_column.column_name = table_column_type.column_name
+    GROUP BY recursive_view_column.pipeline_id, recursive_view_column.table_name, recursive_view_column.column_name
+    HAVING COUNT(DISTINCT table_column_type.data_type) > 1;
+
+/*
+# resolved columns have exactly one type
+recursive_view_column_type(pipeline_id:, table_name:, column_name:, data_type:) <-
+    recursive_view_column(pipeline_id:, table_name:, column_name:)
+    not unresolved_recursive_view_column(pipeline_id:, table_name:, column_name:)
+    table_column_type(pipeline_id:, table_name:, column_name:, data_type:)
+*/
+CREATE MATERIALIZED VIEW recursive_view_column_type AS
     SELECT DISTINCT
-        table_view_sql.pipeline_id,
-        table_view_sql.table_name,
-        table_view_sql.sql_lines
-    FROM table_view_sql
+        recursive_view_column.pipeline_id,
+        recursive_view_column.table_name,
+        recursive_view_column.column_name,
+        table_column_type.data_type
+    FROM recursive_view_column
+    JOIN table_column_type
+        ON recursive_view_column.pipeline_id = table_column_type.pipeline_id
+        AND recursive_view_column.table_name = table_column_type.table_name
+        AND recursive_view_column.column_name = table_column_type.column_name
     WHERE NOT EXISTS (
         SELECT 1
-        FROM table_next_rule AS tn
-        WHERE tn.pipeline_id = table_view_sql.pipeline_id
-        AND tn.table_name = table_view_sql.table_name
-        AND tn.prev_rule_id = table_view_sql.rule_id
+        FROM unresolved_recursive_view_column
+        WHERE unresolved_recursive_view_column.pipeline_id = recursive_view_column.pipeline_id
+        AND unresolved_recursive_view_column.table_name = recursive_view_column.table_name
+        AND unresolved_recursive_view_column.column_name = recursive_view_column.column_name
     );
 
 /*
-pipeline_views_sql(pipeline_id:, table_name:, sql_lines:) <-
-    first_table(pipeline_id:, table_name:, order: 1)
+# columns are declared in the order select_sql writes them in
+recursive_view_declaration(pipeline_id:, table_name:, sql_line:) <-
+    recursive_view_column_type(pipeline_id:, table_name:, column_name:, data_type:)
+    not unresolved_recursive_view_column(pipeline_id:, table_name:)
+    columns_sql := join(array<`"{{column_name}}" {{data_type}}`, order_by: [column_name]>, ", ")
+    sql_line := `DECLARE RECURSIVE VIEW "{{table_name}}" ({{columns_sql}});`
+*/
+CREATE MATERIALIZED VIEW recursive_view_declaration AS
+    SELECT DISTINCT
+        recursive_view_column_type.pipeline_id,
+        recursive_view_column_type.table_name,
+        ('DECLARE RECURSIVE VIEW "' || recursive_view_column_type.table_name || '" ('
+            || ARRAY_TO_STRING(ARRAY_AGG('"' || recursive_view_column_type.column_name || '" ' || recursive_view_column_type.data_type ORDER BY recursive_view_column_type.column_name), ', ')
+            || ');') AS sql_line
+    FROM recursive_view_column_type
+    WHERE NOT EXISTS (
+        SELECT 1
+        FROM unresolved_recursive_view_column
+        WHERE unresolved_recursive_view_column.pipeline_id = recursive_view_column_type.pipeline_id
+        AND unresolved_recursive_view_column.table_name = recursive_view_column_type.table_name
+    )
+    GROUP BY recursive_view_column_type.pipeline_id, recursive_view_column_type.table_name;
+
+/*
+incomplete_output_table(pipeline_id:, table_name:) <-
+    table_output_position(pipeline_id:, table_name:)
+    not view_full_sql(pipeline_id:, table_name:)
+incomplete_output_table(pipeline_id:, table_name:) <-
+    view_full_sql(pipeline_id:, table_name:)
+    count<> > 1
+incomplete_output_table(pipeline_id:, table_name:) <-
+    table_output_position(pipeline_id:, table_name:)
+    recursive_table(pipeline_id:, table_name:)
+    not recursive_view_declaration(pipeline_id:, table_name:)
+*/
+CREATE MATERIALIZED VIEW incomplete_output_table AS
+    SELECT DISTINCT
+        table_output_position.pipeline_id,
+        table_output_position.table_name
+    FROM table_output_position
+    WHERE NOT EXISTS (
+        SELECT 1
+        FROM view_full_sql
+        WHERE view_full_sql.pipeline_id = table_output_position.pipeline_id
+        AND view_full_sql.table_name = table_output_position.table_name
+    )
+
+    UNION
+
+    SELECT DISTINCT
+        view_full_sql.pipeline_id,
+        view_full_sql.table_name
+    FROM view_full_sql
+    GROUP BY view_full_sql.pipeline_id, view_full_sql.table_name
+    HAVING COUNT(*) > 1
+
+    UNION
+
+    SELECT DISTINCT
+        table_output_position.pipeline_id,
+        table_output_position.table_name
+    FROM table_output_position
+    JOIN recursive_table
+        ON table_output_position.pipeline_id = recursive_table.pipeline_id
+        AND table_output_position.table_name = recursive_table.table_name
+    WHERE NOT EXISTS (
+        SELECT 1
+        FROM recursive_view_declaration
+        WHERE recursive_view_declaration.pipeline_id = table_output_position.pipeline_id
+        AND recursive_view_declaration.table_name = table_output_position.table_name
+    );
+
+/*
+# the recursive views of an order are all declared (section 0)
+# before any of them is created (section 1)
+view_output_line(pipeline_id:, table_name:, order:, section: 0, index: 1, line:) <-
+    table_output_position(pipeline_id:, table_name:, order:)
+    recursive_view_declaration(pipeline_id:, table_name:, sql_line: line)
+view_output_line(pipeline_id:, table_name:, order:, section: 1, index:, line:) <-
+    table_output_position(pipeline_id:, table_name:, order:)
     view_full_sql(pipeline_id:, table_name:, sql_lines:)
-pipeline_views_sql(pipeline_id:, table_name:, sql_lines:) <-
-    pipeline_views_sql(pipeline_id:, table_name: prev_table_name, sql_lines: prev_sql_lines)
-    next_table(pipeline_id:, prev_table_name:, next_table_name: table_name)
-    view_full_sql(pipeline_id:, table_name:, sql_lines: next_sql_lines)
-    sql_lines := [*prev_sql_lines, *next_sql_lines]
-*/
-DECLARE RECURSIVE VIEW pipeline_views_sql (pipeline_id TEXT, table_name TEXT, sql_lines TEXT ARRAY);
-CREATE MATERIALIZED VIEW pipeline_views_sql AS
-    SELECT DISTINCT
-        first_table.pipeline_id,
-        first_table.table_name,
-        view_full_sql.sql_lines
-    FROM first_table
-    JOIN view_full_sql
-        ON first_table.pipeline_id = view_full_sql.pipeline_id
-        AND first_table.table_name = view_full_sql.table_name
-    WHERE first_table."order" = 1
+    (line, index) <- unnest(sql_lines)
+*/
+CREATE MATERIALIZED VIEW view_output_line AS
+    SELECT DISTINCT
+        recursive_view_declaration.pipeline_id,
+        recursive_view_declaration.table_name,
+        table_output_position."order",
+        0 AS section,
+        1 AS "index",
+        recursive_view_declaration.sql_line AS line
+    FROM recursive_view_declaration
+    JOIN table_output_position
+        ON recursive_view_declaration.pipeline_id = table_output_position.pipeline_id
+        AND recursive_view_declaration.table_name = table_output_position.table_name
 
     UNION
 
     SELECT DISTINCT
-        next_table.pipeline_id,
-        next_table.next_table_name,
-        ARRAY_CONCAT(
-            pipeline_views_sql.sql_lines,
-            view_full_sql.sql_lines
-        ) AS sql_lines
-    FROM pipeline_views_sql
-    JOIN next_table
-        ON next_table.pipeline_id = pipeline_views_sql.pipeline_id
-        AND next_table.prev_table_name = pipeline_views_sql.table_name
-    JOIN view_full_sql
-        ON next_table.pipeline_id = view_full_sql.pipeline_id
-        AND next_table.next_table_name = view_full_sql.table_name;
+        view_full_sql.pipeline_id,
+        view_full_sql.table_name,
+        table_output_position."order",
+        1 AS section,
+        t."index",
+        t.line
+    FROM view_full_sql
+    JOIN table_output_position
+        ON view_full_sql.pipeline_id = table_output_position.pipeline_id
+        AND view_full_sql.table_name = table_output_position.table_name
+    CROSS JOIN UNNEST(view_full_sql.sql_lines) WITH ORDINALITY AS t (line, "index");
 
 /*
+# views are written in (order, table_name) order, all at once,
+# instead of concatenating a growing prefix of them table by table
 full_pipeline_sql(pipeline_id:, sql_lines:) <-
-    pipeline_views_sql(pipeline_id:, table_name:, sql_lines:)
-    not next_table(pipeline_id:, prev_table_name: table_name)
+    view_output_line(pipeline_id:, table_name:, order:, section:, index:, line:)
+    not incomplete_output_table(pipeline_id:)
+    sql_lines := array<line, order_by: [order, section, table_name, index]>
 */
 CREATE MATERIALIZED VIEW full_pipeline_sql AS
     SELECT DISTINCT
-        pipeline_views_sql.pipeline_id,
-        pipeline_views_sql.sql_lines
-    FROM pipeline_views_sql
+        view_output_line.pipeline_id,
+        ARRAY_AGG(view_output_line.line ORDER BY view_output_line."order", view_output_line.section, view_output_line.table_name, view_output_line."index") AS sql_lines
+    FROM view_output_line
     WHERE NOT EXISTS (
         SELECT 1
-        FROM next_table
-        WHERE next_table.pipeline_id = pipeline_views_sql.pipeline_id
-        AND next_table.prev_table_name = pipeline_views_sql.table_name
-    );
+        FROM incomplete_output_table
+        WHERE incomplete_output_table.pipeline_id = view_output_line.pipeline_id
+    )
+    GROUP BY view_output_line.pipeline_id;
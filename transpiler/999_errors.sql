@@ -65,6 +65,40 @@ CREATE MATERIALIZED VIEW "error:match_right_expr_unresolved" AS
         AND expr_type = body_match.left_expr_type
     );
 
+/*
+# a table that negates a table of its own component would have to be
+# computed before itself
+error:cycle_through_negation(pipeline_id:, table_name:, parent_table_name:) <-
+    table_direct_dependency(pipeline_id:, table_name:, parent_table_name:, negated: true)
+    table_component(pipeline_id:, table_name:, component:)
+    table_component(pipeline_id:, table_name: parent_table_name, component:)
+*/
+CREATE MATERIALIZED VIEW "error:cycle_through_negation" AS
+    SELECT DISTINCT
+        table_direct_dependency.pipeline_id,
+        table_direct_dependency.table_name,
+        table_direct_dependency.parent_table_name
+    FROM table_direct_dependency
+    JOIN table_component
+        ON table_direct_dependency.pipeline_id = table_component.pipeline_id
+        AND table_direct_dependency.table_name = table_component.table_name
+    JOIN table_component AS parent_component
+        ON table_direct_dependency.pipeline_id = parent_component.pipeline_id
+        AND table_direct_dependency.parent_table_name = parent_component.table_name
+    WHERE table_direct_dependency.negated
+    AND table_component.component = parent_component.component;
+
+/*
+error:recursive_view_column_type_unresolved(pipeline_id:, table_name:, column_name:) <-
+    unresolved_recursive_view_column(pipeline_id:, table_name:, column_name:)
+*/
+CREATE MATERIALIZED VIEW "error:recursive_view_column_type_unresolved" AS
+    SELECT DISTINCT
+        unresolved_recursive_view_column.pipeline_id,
+        unresolved_recursive_view_column.table_name,
+        unresolved_recursive_view_column.column_name
+    FROM unresolved_recursive_view_column;
+
 
 
 /*
@@ -72,6 +106,10 @@ error(pipeline_id:, error_type: "unbound_var_in_negative_fact") <-
     error:unbound_var_in_negative_fact(pipeline_id:)
 error(pipeline_id:, error_type: "neg_fact_sql_unresolved") <-
     error:neg_fact_sql_unresolved(pipeline_id:)
+error(pipeline_id:, error_type: "cycle_through_negation") <-
+    error:cycle_through_negation(pipeline_id:)
+error(pipeline_id:, error_type: "recursive_view_column_type_unresolved") <-
+    error:recursive_view_column_type_unresolved(pipeline_id:)
 */
 CREATE MATERIALIZED VIEW "error" AS
     SELECT DISTINCT
@@ -91,5 +129,19 @@ CREATE MATERIALIZED VIEW "error" AS
     SELECT DISTINCT
         "error:match_right_expr_unresolved".pipeline_id AS pipeline_id,
         'match_right_expr_unresolved' AS error_type
-    FROM "error:match_right_expr_unresolved";
+    FROM "error:match_right_expr_unresolved"
+
+    UNION
+
+    SELECT DISTINCT
+        "error:cycle_through_negation".pipeline_id AS pipeline_id,
+        'cycle_through_negation' AS error_type
+    FROM "error:cycle_through_negation"
+
+    UNION
+
+    SELECT DISTINCT
+        "error:recursive_view_column_type_unresolved".pipeline_id AS pipeline_id,
+        'recursive_view_column_type_unresolved' AS error_type
+    FROM "error:recursive_view_column_type_unresolved";
 
@@ -0,0 +1,210 @@
+import os
+import sys
+import errno
+import struct
+import asyncio
+import ctypes
+import ctypes.util
+
+from file_hashes import scan_files
+
+
+
+class Watcher:
+    """
+    Changed files among `paths` (files, or directories searched for files
+    ending with `suffix`), in batches.
+
+    changes() waits for a change, then keeps collecting until nothing else
+    changes for `debounce` seconds, so a burst of edits (an editor saving
+    through a temp file, a formatter, a git checkout) becomes one batch.
+    Deleted files are reported as changed too.
+    """
+
+    def __init__(self, paths, suffix, debounce=0.05):
+        self.paths = [os.path.abspath(path) for path in paths]
+        self.suffix = suffix
+        self.debounce = debounce
+        self.files = {path for path in self.paths if not os.path.isdir(path)}
+        self.dirs = [path for path in self.paths if os.path.isdir(path)]
+        self.pending = set()
+        self.changed = asyncio.Event()
+
+    def is_watched(self, path):
+        if path in self.files:
+            return True
+        if not path.endswith(self.suffix) or os.path.basename(path).startswith('.'):
+            return False
+        return any(path.startswith(d + os.sep) for d in self.dirs)
+
+    def notify(self, path):
+        if self.is_watched(path):
+            self.pending.add(path)
+            self.changed.set()
+
+    def notify_all(self):
+        # events were lost, report every file that is there now
+        for path, _ in scan_files(self.dirs + [p for p in self.files if os.path.exists(p)], self.suffix):
+            self.pending.add(path)
+        self.pending |= self.files
+        self.changed.set()
+
+    async def changes(self):
+        while True:
+            await self.changed.wait()
+            while True:
+                self.changed.clear()
+                try:
+                    await asyncio.wait_for(self.changed.wait(), timeout=self.debounce)
+                except asyncio.TimeoutError:
+                    break
+            (changed, self.pending) = (self.pending, set())
+            if changed:
+                return changed
+
+
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+INOTIFY_EVENT = struct.Struct('iIII')
+
+def load_inotify():
+    # libc functions, None where inotify is not available
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+class InotifyWatcher(Watcher):
+    """
+    Watcher fed by inotify events of the watched directories (and of the
+    directories of the watched files), read on the asyncio loop.
+    Directories created later are watched as they appear.
+    """
+
+    MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+
+    def __init__(self, libc, paths, suffix, debounce=0.05):
+        super().__init__(paths, suffix, debounce)
+        self.libc = libc
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        # watch descriptor -> directory
+        self.watches = {}
+        for d in self.dirs:
+            self.add_tree(d)
+        for path in self.files:
+            self.add_watch(os.path.dirname(path))
+
+    def add_watch(self, directory):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), self.MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {directory}")
+        self.watches[wd] = directory
+
+    def add_tree(self, directory):
+        self.add_watch(directory)
+        for root, dirnames, _ in os.walk(directory):
+            dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+            for d in dirnames:
+                self.add_watch(os.path.join(root, d))
+
+    def start(self):
+        asyncio.get_running_loop().add_reader(self.fd, self.read_events)
+        return self
+
+    def read_events(self):
+        try:
+            buf = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(buf):
+            (wd, mask, _, name_len) = INOTIFY_EVENT.unpack_from(buf, offset)
+            name = buf[offset + INOTIFY_EVENT.size:offset + INOTIFY_EVENT.size + name_len].rstrip(b'\0')
+            offset += INOTIFY_EVENT.size + name_len
+            if mask & IN_Q_OVERFLOW:
+                self.notify_all()
+                continue
+            directory = self.watches.get(wd)
+            if directory is None:
+                continue
+            if mask & IN_IGNORED:
+                del self.watches[wd]
+                continue
+            path = os.path.join(directory, os.fsdecode(name))
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO) and not os.path.basename(path).startswith('.'):
+                    # files written before the watch was added have no event
+                    try:
+                        self.add_tree(path)
+                    except OSError as e:
+                        if e.errno != errno.ENOENT:
+                            raise
+                    for file_path, _ in scan_files([path], self.suffix):
+                        self.notify(file_path)
+                continue
+            if mask & (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE):
+                self.notify(path)
+
+    def close(self):
+        asyncio.get_running_loop().remove_reader(self.fd)
+        os.close(self.fd)
+
+class PollingWatcher(Watcher):
+    """
+    Watcher that rescans the watched paths every `interval` seconds and
+    compares (size, mtime_ns, inode), for platforms without inotify.
+    """
+
+    def __init__(self, paths, suffix, debounce=0.05, interval=0.25):
+        super().__init__(paths, suffix, debounce)
+        self.interval = interval
+        self.signatures = self.scan()
+        self.task = None
+
+    def scan(self):
+        existing = self.dirs + [p for p in self.files if os.path.exists(p)]
+        return {
+            path: (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+            for path, stat in scan_files(existing, self.suffix)
+        }
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+        return self
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            signatures = self.scan()
+            for path in signatures.keys() | self.signatures.keys():
+                if signatures.get(path) != self.signatures.get(path):
+                    self.notify(path)
+            self.signatures = signatures
+
+    def close(self):
+        if self.task:
+            self.task.cancel()
+
+def open_watcher(paths, suffix, debounce=0.05, polling=False):
+    libc = None if polling else load_inotify()
+    if libc is None:
+        return PollingWatcher(paths, suffix, debounce).start()
+    return InotifyWatcher(libc, paths, suffix, debounce).start()
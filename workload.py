@@ -0,0 +1,113 @@
+import random
+
+from dsl import rule, fact, neg_fact, sql_cond, strval, dictval, array
+
+
+
+# Synthetic Grasp programs for benchmarks. Tables are layered in strata:
+# stratum 0 holds schema tables, every derived table of stratum k reads
+# one table of stratum k-1 and any number of lower tables, so a program
+# has as many strata as its derived tables need at tables_per_stratum each.
+
+DEFAULT_SHAPE = {
+    'num_rules': 100,
+    'body_len': 2,
+    'tables_per_stratum': 5,
+    'rules_per_table': 2,
+    'negation_ratio': 0.0,
+    'expr_depth': 0,
+    'sql_cond_ratio': 0.0,
+}
+
+
+
+def program_shape(**overrides):
+    unknown = set(overrides) - set(DEFAULT_SHAPE)
+    if unknown:
+        raise Exception(f"Unknown workload parameters: {sorted(unknown)}")
+    return {**DEFAULT_SHAPE, **overrides}
+
+def table_name(stratum, index):
+    return f's{stratum}_t{index}'
+
+def program_tables(shape):
+    # [[table_name]] per stratum, stratum 0 being the schema tables
+    num_tables = -(-shape['num_rules'] // shape['rules_per_table'])
+    strata = [[table_name(0, i) for i in range(shape['tables_per_stratum'])]]
+    for i in range(num_tables):
+        if i % shape['tables_per_stratum'] == 0:
+            strata.append([])
+        strata[-1].append(table_name(len(strata) - 1, len(strata[-1])))
+    return strata
+
+def nested_expr(depth, var_name):
+    # dict and array expressions nested `depth` levels around a variable
+    if depth == 0:
+        return var_name
+    return dictval(('level', strval(str(depth))), ('items', array(nested_expr(depth - 1, var_name))))
+
+def generate_schemas(shape):
+    return {
+        name: {
+            'has_tenant': False,
+            'columns': {'id': {'type': 'TEXT'}, 'value': {'type': 'BIGINT'}},
+        }
+        for name in program_tables(shape)[0]
+    }
+
+def generate_rules(shape, seed=0):
+    rng = random.Random(seed)
+    strata = program_tables(shape)
+    derived_tables = [(stratum, name) for stratum, names in enumerate(strata) if stratum for name in names]
+    rules = []
+    for i in range(shape['num_rules']):
+        (stratum, name) = derived_tables[i // shape['rules_per_table']]
+        lower_tables = [t for names in strata[:stratum] for t in names]
+        # every fact joins on id, the first one comes from the stratum
+        # right below, so the table really belongs to its stratum
+        parents = [rng.choice(strata[stratum - 1])]
+        parents += [rng.choice(lower_tables) for _ in range(shape['body_len'] - 1)]
+        body = [fact(parent, 'id', ('value', f'v{j}')) for j, parent in enumerate(parents)]
+        if rng.random() < shape['negation_ratio']:
+            body.append(neg_fact(rng.choice(lower_tables), 'id'))
+        if rng.random() < shape['sql_cond_ratio']:
+            body.append(sql_cond(['{{v0}}', ' > 0']))
+        params = ['id', ('value', 'v0')]
+        if shape['expr_depth']:
+            params.append(('payload', nested_expr(shape['expr_depth'], 'v0')))
+        rules.append(rule(name, params, body))
+    return rules
+
+def grasp_expressible(shape):
+    # parser.py has no syntax for sql conditions and nested expressions
+    return shape['sql_cond_ratio'] == 0 and shape['expr_depth'] == 0
+
+def grasp_arg(arg):
+    match arg:
+        case _ if type(arg) == str:
+            return f'{arg}:'
+        case (key, var_name) if type(var_name) == str:
+            return f'{key}: {var_name}'
+        case _:
+            raise Exception(f"Invalid grasp arg {arg}")
+
+def grasp_fact(body_stmt):
+    match body_stmt:
+        case {'type': 'fact', 'table_name': table_name, 'args': args, 'negated': negated}:
+            prefix = 'not ' if negated else ''
+            return f"{prefix}{table_name}({', '.join(grasp_arg(arg) for arg in args)})"
+        case _:
+            raise Exception(f"Invalid grasp body stmt {body_stmt}")
+
+def generate_grasp_text(shape, seed=0):
+    # the same program in the syntax parser.py understands, every rule
+    # with a multiline body so body_len and negation_ratio reach the parser
+    if not grasp_expressible(shape):
+        raise Exception(f"Workload not expressible in grasp syntax: {shape}")
+    rules = generate_rules(shape, seed)
+    lines = [f'{name}(id: {i}, value: {i})' for i, name in enumerate(program_tables(shape)[0])]
+    lines.append('')
+    for r in rules:
+        lines.append(f"{r['table_name']}({', '.join(grasp_arg(param) for param in r['params'])}) <-")
+        lines += [f'\t{grasp_fact(body_stmt)}' for body_stmt in r['body']]
+    return '\n'.join(lines) + '\n'